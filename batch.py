@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+DEFAULT_CONCURRENCY = 16
+MAX_CONCURRENCY = 256
+# Finished jobs kept in memory; older ones are reloaded from disk on demand.
+MAX_FINISHED_JOBS = 64
+
+# run_item(job, item) -> (final text, usage)
+RunItem = Callable[["BatchJob", dict[str, Any]], Awaitable[tuple[str, dict[str, int]]]]
+
+
+def parse_items(lines: list[Any]) -> list[dict[str, Any]]:
+    # Each entry is a prompt string or an object with "prompt" and optional
+    # "id", "model", "system", "max_tokens". Raises ValueError naming the
+    # offending entry.
+    items = []
+    for i, entry in enumerate(lines):
+        if isinstance(entry, str):
+            entry = {"prompt": entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get("prompt"), str) or not entry["prompt"]:
+            raise ValueError(f"item {i}: expected a prompt string or an object with a 'prompt' field")
+        item = {key: entry[key] for key in ("model", "system", "max_tokens") if entry.get(key) is not None}
+        item["id"] = str(entry.get("id", i))
+        item["prompt"] = entry["prompt"]
+        items.append(item)
+    return items
+
+
+def parse_jsonl(text: str) -> list[Any]:
+    entries = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"line {number}: {e.msg}") from None
+    return entries
+
+
+class BatchJob:
+    # A set of independent prompts run through run_until_done, at most
+    # `concurrency` at a time. Results are appended in completion order to
+    # the job's file and then to `finished`, so a reader that reconnects (or
+    # a restarted server) carries on from where it was instead of re-running
+    # finished items. The file is written off the event loop, with the
+    # results that finished during the previous write appended together.
+    def __init__(
+        self,
+        job_id: str,
+        items: list[dict[str, Any]],
+        concurrency: int,
+        path: str,
+        created_at: str | None = None,
+    ) -> None:
+        self.id = job_id
+        self.items = items
+        self.concurrency = max(1, min(concurrency, MAX_CONCURRENCY))
+        self.created_at = created_at or datetime.now(timezone.utc).isoformat()
+        self.finished: list[dict[str, Any]] = []
+        self.failed = 0
+        # Set when results could not be written; the job stops there.
+        self.error: str | None = None
+        self._path = path
+        self._task: asyncio.Task[None] | None = None
+        self._unwritten: list[dict[str, Any]] = []
+        self._writer: asyncio.Task[None] | None = None
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.error is not None or len(self.finished) >= len(self.items)
+
+    def header(self) -> dict[str, Any]:
+        header = {
+            "job_id": self.id,
+            "total": len(self.items),
+            "finished": len(self.finished),
+            "failed": self.failed,
+            "done": self.done,
+        }
+        if self.error is not None:
+            header["error"] = self.error
+        return header
+
+    def start(self, run_item: RunItem) -> None:
+        if self._task is None and not self.done:
+            self._task = asyncio.create_task(self._run(run_item))
+
+    async def _run(self, run_item: RunItem) -> None:
+        seen = {record["index"] for record in self.finished}
+        pending = iter([i for i in range(len(self.items)) if i not in seen])
+
+        async def _worker() -> None:
+            # Workers pull from the shared iterator, so thousands of items
+            # never mean thousands of tasks.
+            for index in pending:
+                if self.error is not None:
+                    return
+                item = self.items[index]
+                try:
+                    result, usage = await run_item(self, item)
+                    record = {"index": index, "id": item["id"], "result": result, "usage": usage}
+                except Exception as e:
+                    record = {"index": index, "id": item["id"], "error": f"{type(e).__name__}: {e}"}
+                self._record(record)
+
+        await asyncio.gather(*(_worker() for _ in range(self.concurrency)))
+        if self._writer is not None:
+            await self._writer
+
+    def _record(self, record: dict[str, Any]) -> None:
+        if self.error is not None:
+            return
+        self._unwritten.append(record)
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write())
+
+    async def _write(self) -> None:
+        # Readers only see results that are on disk, so a position they
+        # resume from never counts an item a restart would run again. If a
+        # write fails, the results not on disk are dropped and the job ends
+        # with an error; loading it again resumes from what was written.
+        try:
+            while self._unwritten:
+                records, self._unwritten = self._unwritten, []
+                try:
+                    await asyncio.to_thread(self._append, records)
+                except Exception as e:
+                    self.error = f"writing results failed: {type(e).__name__}: {e}"
+                    self._unwritten.clear()
+                    print(f"Batch {self.id}: {self.error}")
+                    return
+                for record in records:
+                    if "error" in record:
+                        self.failed += 1
+                    self.finished.append(record)
+                self._notify()
+        finally:
+            self._writer = None
+            self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _append(self, records: list[dict[str, Any]]) -> None:
+        with open(self._path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    async def results(self, after: int = 0):
+        # Yields finished records from position `after` on, waiting for new
+        # ones until the job is done. Disconnecting readers do not affect
+        # the job.
+        sent = max(0, after)
+        while True:
+            while sent < len(self.finished):
+                yield self.finished[sent]
+                sent += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+class BatchStore:
+    # Jobs live in memory while running and on disk as one JSONL file each:
+    # a header line with the items, then one line per finished item.
+    def __init__(
+        self,
+        run_item: RunItem,
+        directory: str = "batches",
+    ) -> None:
+        self._run_item = run_item
+        self._dir = directory
+        self._jobs: dict[str, BatchJob] = {}
+        os.makedirs(self._dir, exist_ok=True)
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self._dir, f"{job_id}.jsonl")
+
+    async def create(self, items: list[dict[str, Any]], concurrency: int = DEFAULT_CONCURRENCY) -> BatchJob:
+        job_id = uuid.uuid4().hex
+        job = BatchJob(job_id, items, concurrency, self._path(job_id))
+        # The header holds every item (up to the request size limit), so it
+        # is encoded and written off the event loop.
+        await asyncio.to_thread(self._write_header, job)
+        self._add(job)
+        job.start(self._run_item)
+        return job
+
+    def _write_header(self, job: BatchJob) -> None:
+        # Item by item: encoding them in one call would hold the GIL, and
+        # so stall the event loop, for the whole batch.
+        head = json.dumps({"job_id": job.id, "created_at": job.created_at, "concurrency": job.concurrency})
+        with open(job._path, "w") as f:
+            f.write(head[:-1] + ', "items": [')
+            for i, item in enumerate(job.items):
+                f.write((", " if i else "") + json.dumps(item))
+            f.write("]}\n")
+
+    async def get(self, job_id: str) -> BatchJob | None:
+        job = self._jobs.get(job_id)
+        if job is not None and job.error is not None:
+            # Stopped by a failed write: load what reached the disk and
+            # run the rest again.
+            del self._jobs[job_id]
+            job = None
+        if job is None:
+            loaded = await asyncio.to_thread(self._load, job_id)
+            # Another request may have loaded it meanwhile.
+            job = self._jobs.get(job_id)
+            if job is None:
+                if loaded is None:
+                    return None
+                job = loaded
+                self._add(job)
+        # Picks up jobs interrupted by a restart; finished items are kept.
+        job.start(self._run_item)
+        return job
+
+    def _add(self, job: BatchJob) -> None:
+        self._jobs[job.id] = job
+        finished = [j for j in self._jobs.values() if j.done]
+        for old in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[old.id]
+
+    def _load(self, job_id: str) -> BatchJob | None:
+        try:
+            if uuid.UUID(hex=job_id).hex != job_id:
+                return None
+        except ValueError:
+            return None
+        path = self._path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            text = f.read()
+        if not text.endswith("\n"):
+            # Cut off by a crash mid-write; that item runs again, and the
+            # next record must start on a line of its own.
+            with open(path, "a") as f:
+                f.write("\n")
+        lines = text.splitlines()
+        header = json.loads(lines[0])
+        job = BatchJob(job_id, header["items"], header["concurrency"], path, header.get("created_at"))
+        done: set[int] = set()
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record["index"] in done:
+                continue
+            done.add(record["index"])
+            job.finished.append(record)
+            if "error" in record:
+                job.failed += 1
+        return job
+
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Benchmark: per-conversation Anthropic clients vs. the shared pooled client.
+
+Starts a local stub of the Messages API (fixed latency, no TLS, in its own
+process so it doesn't compete for the client's CPU) and runs many concurrent
+sessions against it, each creating a Conversation and taking a few
+turns, once with a fresh client per Conversation (the old behaviour) and once
+with the process-wide client from clients.py. Reports wall time, per-turn
+latency and how many TCP connections the stub saw.
+
+Run: python bench_clients.py [sessions] [turns]
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+import anthropic
+from aiohttp import web
+
+from clients import close_clients
+from conversation import Conversation
+
+STUB_PORT = 18990
+STUB_LATENCY = 0.02
+REPLY = {
+    "id": "msg_bench",
+    "type": "message",
+    "role": "assistant",
+    "model": "stub",
+    "content": [{"type": "text", "text": "ok"}],
+    "stop_reason": "end_turn",
+    "stop_sequence": None,
+    "usage": {"input_tokens": 10, "output_tokens": 1},
+}
+
+
+def _serve_stub() -> None:
+    connections: set[int] = set()
+
+    async def messages(request: web.Request) -> web.Response:
+        connections.add(id(request.transport))
+        await asyncio.sleep(STUB_LATENCY)
+        return web.json_response(REPLY)
+
+    async def stats(request: web.Request) -> web.Response:
+        count = len(connections)
+        connections.clear()
+        return web.json_response({"connections": count})
+
+    app = web.Application()
+    app.router.add_post("/v1/messages", messages)
+    app.router.add_get("/connections", stats)
+    web.run_app(app, host="127.0.0.1", port=STUB_PORT, backlog=4096, access_log=None, print=None)
+
+
+async def _stub_connections() -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", STUB_PORT)
+    writer.write(b"GET /connections HTTP/1.0\r\n\r\n")
+    raw = await reader.read()
+    writer.close()
+    return json.loads(raw.split(b"\r\n\r\n", 1)[1])["connections"]
+
+
+async def _session(shared: bool, turns: int, latencies: list[float]) -> None:
+    client = None if shared else anthropic.AsyncAnthropic()
+    start = time.perf_counter()
+    conv = Conversation(client=client)
+    for i in range(turns):
+        await conv.send(f"turn {i}")
+        now = time.perf_counter()
+        latencies.append(now - start)
+        start = now
+    if client is not None:
+        await client.close()
+
+
+async def _run(shared: bool, sessions: int, turns: int) -> None:
+    latencies: list[float] = []
+    await _stub_connections()
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(_session(shared, turns, latencies) for _ in range(sessions)))
+        wall = time.perf_counter() - start
+    finally:
+        await close_clients()
+    connections = await _stub_connections()
+    latencies.sort()
+    overhead = (statistics.mean(latencies) - STUB_LATENCY) * 1000
+    print(
+        f"{'shared' if shared else 'per-conversation':>17} {wall:>8.2f} "
+        f"{latencies[len(latencies) // 2] * 1000:>9.1f} {latencies[int(len(latencies) * 0.99)] * 1000:>9.1f} "
+        f"{overhead:>12.1f} {connections:>6}"
+    )
+
+
+def main() -> None:
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    os.environ["ANTHROPIC_BASE_URL"] = f"http://127.0.0.1:{STUB_PORT}"
+    os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+    stub = multiprocessing.Process(target=_serve_stub, daemon=True)
+    stub.start()
+    time.sleep(1.0)
+    print(f"{sessions} concurrent sessions x {turns} turns, stub latency {STUB_LATENCY * 1000:.0f} ms")
+    print(f"{'client':>17} {'wall s':>8} {'p50 ms':>9} {'p99 ms':>9} {'overhead ms':>12} {'conns':>6}")
+    try:
+        for shared in (False, True):
+            asyncio.run(_run(shared, sessions, turns))
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Microbenchmark for Hub dispatch/result bookkeeping.
+
+Drives Hub._dispatch and Hub._process_message against in-process fake workers
+(no sockets) and reports the per-call cost while varying the number of
+concurrently pending calls, the number of connected workers, and the wire
+encoding (with a large result payload, where encoding cost dominates).
+
+Run: python bench_hub.py
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import io
+import os
+import time
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+
+from conversation import Conversation
+from hub import Hub
+from wire import JSON, Codec, available_encodings, decode
+
+TOOL = {"name": "echo", "description": "bench", "input_schema": {"type": "object", "properties": {}}}
+ROUNDS = 2000
+LARGE_RESULT = "\n".join(f"{i:06d}: lorem ipsum dolor sit amet" for i in range(1500))
+
+
+def _add_worker(hub: Hub, wid: str, outbox: list[tuple[str, str]], encoding: str = JSON) -> None:
+    async def _send(raw: str | bytes) -> None:
+        outbox.append((wid, decode(raw)["call_id"]))
+
+    hub._worker_senders[wid] = _send
+    hub._codecs[wid] = Codec(encoding)
+    hub._process_message(wid, Codec(encoding).encode({"type": "register", "tools": [TOOL], "capacity": 1_000_000}))
+
+
+async def _measure(n_workers: int, n_pending: int, encoding: str = JSON, content: str = "ok") -> float:
+    hub = Hub(Conversation())
+    codec = Codec(encoding)
+    outbox: list[tuple[str, str]] = []
+    for i in range(1, n_workers):
+        _add_worker(hub, f"w{i}", outbox, encoding)
+
+    # Park the background calls on the other workers, then connect w0 so the
+    # timed calls land on a worker with no other in-flight work (the worst
+    # case for any scan over pending calls).
+    background = [asyncio.create_task(hub._dispatch("echo", {})) for _ in range(n_pending)]
+    await asyncio.sleep(0)
+    _add_worker(hub, "w0", outbox, encoding)
+    outbox.clear()
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        task = asyncio.create_task(hub._dispatch("echo", {}))
+        await asyncio.sleep(0)
+        wid, call_id = outbox.pop()
+        frame = codec.encode({"type": "tool_result", "call_id": call_id, "content": content})
+        hub._process_message(wid, frame)
+        await task
+    elapsed = time.perf_counter() - start
+
+    for t in background:
+        t.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    return elapsed / ROUNDS * 1e6
+
+
+async def main() -> None:
+    print(f"{'workers':>8} {'pending':>8} {'us/call':>10}")
+    for n_workers, n_pending in [(3, 10), (3, 100), (3, 1_000), (3, 10_000),
+                                 (10, 10), (100, 10), (1_000, 10)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            us = await _measure(n_workers, n_pending)
+        print(f"{n_workers:>8} {n_pending:>8} {us:>10.1f}")
+
+    print()
+    print(f"{'encoding':>14} {'bytes':>8} {'us/call':>10}")
+    for encoding in available_encodings():
+        frame = Codec(encoding).encode({"type": "tool_result", "call_id": "x" * 36, "content": LARGE_RESULT})
+        with contextlib.redirect_stdout(io.StringIO()):
+            us = await _measure(3, 10, encoding, LARGE_RESULT)
+        print(f"{encoding:>14} {len(frame):>8} {us:>10.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
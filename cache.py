@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import json
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+def cache_key(tool_name: str, tool_input: dict[str, Any]) -> str:
+    # Hub and workers must agree on this: invalidations refer to entries by key.
+    return tool_name + ":" + json.dumps(tool_input, sort_keys=True, separators=(",", ":"))
+
+
+class _Entry:
+    __slots__ = ("content", "token", "worker_id", "expires")
+
+    def __init__(self, content: str, token: str, worker_id: str, expires: float):
+        self.content = content
+        self.token = token
+        self.worker_id = worker_id
+        self.expires = expires
+
+
+# LRU over tool results, bounded by total content size. Each entry keeps the
+# validity token its worker reported, so an invalidation for an old token
+# never drops a newer result for the same key.
+class ResultCache:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._by_worker: dict[str, set[str]] = {}
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.content
+
+    def put(self, key: str, content: str, token: str, worker_id: str, ttl: float) -> None:
+        if key in self._entries:
+            self._drop(key)
+        if ttl <= 0 or len(content) > self.max_bytes:
+            return
+        self._entries[key] = _Entry(content, token, worker_id, time.monotonic() + ttl)
+        self._by_worker.setdefault(worker_id, set()).add(key)
+        self._size += len(content)
+        while self._size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, key: str, token: str | None = None) -> bool:
+        entry = self._entries.get(key)
+        if entry is None or (token is not None and entry.token != token):
+            return False
+        self._drop(key)
+        self.invalidations += 1
+        return True
+
+    def drop_worker(self, worker_id: str) -> None:
+        # Nobody will report changes for these any more.
+        for key in self._by_worker.pop(worker_id, set()):
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry.content)
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._size -= len(entry.content)
+        keys = self._by_worker.get(entry.worker_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_worker[entry.worker_id]
+
+    def as_dict(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import os
+from typing import Any
+
+import anthropic
+
+# Pool defaults for the shared clients, overridable from the environment.
+# Every turn of every conversation goes through these pools, so keep-alive
+# connections are reused across sessions.
+MAX_CONNECTIONS = 1000
+MAX_KEEPALIVE_CONNECTIONS = 200
+KEEPALIVE_EXPIRY = 60.0
+# httpx's pool walks all of its connections for every request, which costs
+# more than the request itself once there are hundreds. The limits above are
+# split across this many independent clients instead.
+POOL_SHARDS = 8
+
+# httpx.Limits, taken from the SDK so this follows whichever HTTP library it
+# is built on.
+_Limits = type(anthropic.DEFAULT_CONNECTION_LIMITS)
+
+_clients: dict[str, tuple[asyncio.AbstractEventLoop | None, list[anthropic.AsyncAnthropic]]] = {}
+
+
+def http2_available() -> bool:
+    # HTTP/2 needs the optional h2 package (pip install "httpx[http2]").
+    return importlib.util.find_spec("h2") is not None
+
+
+def _build(
+    max_connections: int | None = None,
+    max_keepalive_connections: int | None = None,
+    keepalive_expiry: float | None = None,
+    http2: bool | None = None,
+    shards: int | None = None,
+    **client_kwargs: Any,
+) -> list[anthropic.AsyncAnthropic]:
+    # Read at build time, after the server has loaded .env.
+    shards = max(1, shards or int(os.environ.get("ANTHROPIC_POOL_SHARDS", POOL_SHARDS)))
+    max_connections = max_connections or int(os.environ.get("ANTHROPIC_MAX_CONNECTIONS", MAX_CONNECTIONS))
+    max_keepalive_connections = max_keepalive_connections or int(
+        os.environ.get("ANTHROPIC_MAX_KEEPALIVE", MAX_KEEPALIVE_CONNECTIONS)
+    )
+    limits = _Limits(
+        max_connections=max(1, max_connections // shards),
+        max_keepalive_connections=max(1, max_keepalive_connections // shards),
+        keepalive_expiry=keepalive_expiry or float(os.environ.get("ANTHROPIC_KEEPALIVE_EXPIRY", KEEPALIVE_EXPIRY)),
+    )
+    if http2 is None:
+        http2 = http2_available()
+    return [
+        anthropic.AsyncAnthropic(
+            http_client=anthropic.DefaultAsyncHttpxClient(limits=limits, http2=http2),
+            **client_kwargs,
+        )
+        for _ in range(shards)
+    ]
+
+
+def get_client(name: str = "default", key: Any = None, **options: Any) -> anthropic.AsyncAnthropic:
+    # One set of pooled clients per name for the whole process; key picks
+    # the shard, so a caller passing the same key keeps its warm connection.
+    # The pools belong to the event loop they were created on, so a
+    # different loop (tests, a second asyncio.run) gets fresh ones. options
+    # only apply on creation.
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    entry = _clients.get(name)
+    if entry is None or entry[0] is not loop:
+        entry = (loop, _build(**options))
+        _clients[name] = entry
+    shards = entry[1]
+    return shards[hash(key) % len(shards)]
+
+
+async def close_clients() -> None:
+    loop = asyncio.get_running_loop()
+    for name, (owner, shards) in list(_clients.items()):
+        if owner is loop:
+            del _clients[name]
+            for client in shards:
+                await client.close()
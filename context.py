@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import json
+from typing import Any
+
+# Rough local estimate, corrected by the ratio observed against real usage.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(value: Any) -> int:
+    if isinstance(value, str):
+        text = value
+    else:
+        text = json.dumps(value, default=_dump, separators=(",", ":"))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _dump(obj: Any) -> Any:
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(exclude_none=True)
+    return str(obj)
+
+
+def _block_type(block: Any) -> str | None:
+    return block.get("type") if isinstance(block, dict) else getattr(block, "type", None)
+
+
+def starts_turn(message: dict[str, Any]) -> bool:
+    # A user message that is not answering tool calls. History may start
+    # here without orphaning a tool_use/tool_result pair.
+    if message["role"] != "user":
+        return False
+    content = message["content"]
+    if isinstance(content, str):
+        return True
+    return not any(_block_type(block) == "tool_result" for block in content)
+
+
+def trim_messages(messages: list[dict[str, Any]], max_messages: int) -> list[dict[str, Any]]:
+    # Keeps at most max_messages, cutting only at turn boundaries. When the
+    # last turn alone is longer than that, all of it is kept.
+    if len(messages) <= max_messages:
+        return messages
+    cut = len(messages) - max_messages
+    for start in range(cut, len(messages)):
+        if starts_turn(messages[start]):
+            return messages[start:]
+    for start in range(cut - 1, 0, -1):
+        if starts_turn(messages[start]):
+            return messages[start:]
+    return messages
+
+
+class ContextManager:
+    # Tracks how much of the context window the history uses and compacts it
+    # once past the budget: first old tool results are elided (oldest first),
+    # then whole turns are dropped from the front. The last keep_recent
+    # messages are never touched, and tool_use/tool_result pairs stay intact.
+    def __init__(
+        self,
+        budget: int = 150_000,
+        target: float = 0.75,
+        keep_recent: int = 10,
+        elide_over: int = 2000,
+    ) -> None:
+        self.budget = budget
+        self.target = target
+        self.keep_recent = keep_recent
+        self.elide_over = elide_over
+        self.ratio = 1.0
+        self.compactions = 0
+        self.elided_results = 0
+        self.dropped_messages = 0
+        self.last_estimate = 0
+        self._raw = 0
+        self._sizes: dict[int, tuple[Any, int]] = {}
+
+    def message_tokens(self, message: dict[str, Any]) -> int:
+        # Messages are only ever replaced, never edited in place, so the
+        # estimate is cached per object.
+        cached = self._sizes.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        return estimate_tokens(message["content"])
+
+    def _measure(self, messages: list[dict[str, Any]], overhead: int) -> int:
+        sizes = [(m, self.message_tokens(m)) for m in messages]
+        self._sizes = {id(m): (m, tokens) for m, tokens in sizes}
+        return overhead + sum(tokens for _, tokens in sizes)
+
+    def measure(self, messages: list[dict[str, Any]]) -> int:
+        # Estimated tokens of the messages, remembered for the next compact().
+        return self._measure(messages, 0)
+
+    def observe(self, usage: dict[str, int]) -> None:
+        # Corrects the estimator with the prompt size the API reported for
+        # the request last passed through compact().
+        actual = (
+            usage.get("input_tokens", 0)
+            + usage.get("cache_read_input_tokens", 0)
+            + usage.get("cache_creation_input_tokens", 0)
+        )
+        if self._raw > 0 and actual > 0:
+            self.ratio = 0.7 * self.ratio + 0.3 * (actual / self._raw)
+
+    def compact(self, messages: list[dict[str, Any]], overhead: int = 0) -> list[dict[str, Any]]:
+        # overhead: estimated tokens for the system prompt and tools.
+        self._raw = self._measure(messages, overhead)
+        self.last_estimate = int(self._raw * self.ratio)
+        if self.last_estimate <= self.budget:
+            return messages
+        self.compactions += 1
+        goal = int(self.budget * self.target)
+        messages = list(messages)
+        total = self.last_estimate
+        protected = max(0, len(messages) - self.keep_recent)
+
+        for i in range(protected):
+            if total <= goal:
+                break
+            message = messages[i]
+            if message["role"] != "user" or isinstance(message["content"], str):
+                continue
+            content = [self._elide(block) for block in message["content"]]
+            if any(new is not old for new, old in zip(content, message["content"])):
+                before = self.message_tokens(message)
+                messages[i] = {**message, "content": content}
+                total -= int((before - self.message_tokens(messages[i])) * self.ratio)
+
+        drop = 0
+        while total > goal:
+            # Find the next turn start after the current cut, within the
+            # messages that may be touched.
+            nxt = next((j for j in range(drop + 1, protected) if starts_turn(messages[j])), None)
+            if nxt is None:
+                break
+            total -= int(sum(self.message_tokens(m) for m in messages[drop:nxt]) * self.ratio)
+            drop = nxt
+        if drop:
+            self.dropped_messages += drop
+            messages = messages[drop:]
+
+        self._raw = self._measure(messages, overhead)
+        self.last_estimate = int(self._raw * self.ratio)
+        return messages
+
+    def _elide(self, block: Any) -> Any:
+        if _block_type(block) != "tool_result" or not isinstance(block, dict):
+            return block
+        content = block.get("content")
+        if not isinstance(content, str) or len(content) <= self.elide_over:
+            return block
+        self.elided_results += 1
+        head = content[:200]
+        return {**block, "content": f"{head}\n[... {len(content) - len(head)} more characters elided to save context ...]"}
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "estimated_tokens": self.last_estimate,
+            "budget": self.budget,
+            "ratio": round(self.ratio, 3),
+            "compactions": self.compactions,
+            "elided_results": self.elided_results,
+            "dropped_messages": self.dropped_messages,
+        }
@@ -1,12 +1,68 @@
 from __future__ import annotations
 
-#import asyncio
+import asyncio
 import inspect
 import json
-from typing import Any, Callable
+import os
+from contextvars import ContextVar
+from typing import Any, Callable, Hashable
 
 import anthropic
 
+from clients import get_client
+from context import ContextManager, estimate_tokens
+from scheduler import LLMScheduler
+
+
+# Set while a tool handler runs so it can tag progress with the tool_use block.
+current_tool_use_id: ContextVar[str | None] = ContextVar("current_tool_use_id", default=None)
+
+# Tool calls from one response that run at once, unless the conversation
+# is given its own limit or MAX_PARALLEL_TOOLS is set.
+MAX_PARALLEL_TOOLS = 8
+
+_CACHE_CONTROL = {"type": "ephemeral"}
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+
+def _cached_block(block: Any) -> dict[str, Any]:
+    if isinstance(block, str):
+        return {"type": "text", "text": block, "cache_control": _CACHE_CONTROL}
+    if not isinstance(block, dict):
+        block = block.model_dump(exclude_none=True)
+    return {**block, "cache_control": _CACHE_CONTROL}
+
+
+def _with_breakpoint(message: dict[str, Any]) -> dict[str, Any]:
+    # Copies the message with a breakpoint on its last block; the history
+    # itself is never modified.
+    content = message["content"]
+    if isinstance(content, str):
+        return {**message, "content": [_cached_block(content)]}
+    return {**message, "content": [*content[:-1], _cached_block(content[-1])]}
+
+
+class _ToolBatch:
+    # The tool calls of one assistant message, keyed by tool_use id. Calls
+    # can be started while the message is still streaming and are collected
+    # by _handle_tool_use.
+    def __init__(self, conv: Conversation) -> None:
+        self._conv = conv
+        self._limit = asyncio.Semaphore(max(1, conv.max_parallel_tools))
+        self.tasks: dict[str, asyncio.Task[dict[str, Any]]] = {}
+
+    def start(self, block: Any) -> None:
+        if block.id not in self.tasks:
+            self.tasks[block.id] = asyncio.ensure_future(self._run(block))
+
+    async def _run(self, block: Any) -> dict[str, Any]:
+        async with self._limit:
+            return await self._conv._run_tool(block)
+
+    def cancel(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+
 
 class Conversation:
     def __init__(
@@ -17,20 +73,130 @@ class Conversation:
         max_tokens: int = 8192,
         tools: list[dict] | None = None,
         tool_handlers: dict[str, Callable[..., Any]] | None = None,
+        max_parallel_tools: int | None = None,
+        prompt_caching: bool = True,
+        context_budget: int = 150_000,
+        client: anthropic.AsyncAnthropic | None = None,
+        scheduler: LLMScheduler | None = None,
     ):
-        self.client = anthropic.AsyncAnthropic()
+        self._client = client
+        # Requests go through the scheduler when there is one, queued under
+        # schedule_key (the conversation itself by default) at priority.
+        self.scheduler = scheduler
+        self.schedule_key: Hashable = None
+        self.priority = 0
         self.model = model
         self.system = system
         self.max_tokens = max_tokens
         self.messages: list[dict] = []
         self.tools: list[dict] = tools or []
         self.tool_handlers: dict[str, Callable[..., Any]] = tool_handlers or {}
+        self.max_parallel_tools = max_parallel_tools or int(os.environ.get("MAX_PARALLEL_TOOLS", MAX_PARALLEL_TOOLS))
+        self._tool_batch: _ToolBatch | None = None
+        self.prompt_caching = prompt_caching
+        self.last_usage: dict[str, int] = {}
+        self.usage: dict[str, int] = {field: 0 for field in USAGE_FIELDS}
+        self.usage["turns"] = 0
+        self.context = ContextManager(budget=context_budget)
+
+    @property
+    def client(self) -> anthropic.AsyncAnthropic:
+        # The process-wide pooled client unless one was injected.
+        return self._client if self._client is not None else get_client(key=id(self))
+
+    @client.setter
+    def client(self, client: anthropic.AsyncAnthropic | None) -> None:
+        self._client = client
 
     def register_tool(self, schema: dict, handler: Callable[..., Any]) -> None:
         self.tools.append(schema)
         self.tool_handlers[schema["name"]] = handler
 
-    async def _create(self) -> anthropic.types.Message:
+    async def _create(
+        self,
+        on_text: Callable[[str], Any] | None = None,
+        on_tool_use: Callable[[Any], Any] | None = None,
+    ) -> anthropic.types.Message:
+        self.cancel_tools()
+        overhead = estimate_tokens(self.tools) + (estimate_tokens(self.system) if self.system else 0)
+        self.messages = self.context.compact(self.messages, overhead)
+        kwargs = self._request_kwargs()
+        if self.scheduler is None:
+            return await self._request(kwargs, on_text, on_tool_use)
+        # Once a streamed attempt has passed anything on, a failure is final:
+        # a retry would generate the reply again and repeat what the caller
+        # already has.
+        delivered = False
+
+        def _deliver(callback: Callable[[Any], Any] | None) -> Callable[[Any], Any] | None:
+            if callback is None:
+                return None
+
+            def _forward(value: Any) -> Any:
+                nonlocal delivered
+                delivered = True
+                return callback(value)
+
+            return _forward
+
+        forward_text, forward_tool_use = _deliver(on_text), _deliver(on_tool_use)
+        return await self.scheduler.run(
+            lambda: self._request(kwargs, forward_text, forward_tool_use),
+            key=self.schedule_key if self.schedule_key is not None else id(self),
+            priority=self.priority,
+            tokens=self.context.last_estimate,
+            retryable=lambda: not delivered,
+        )
+
+    async def _request(
+        self,
+        kwargs: dict[str, Any],
+        on_text: Callable[[str], Any] | None,
+        on_tool_use: Callable[[Any], Any] | None,
+    ) -> anthropic.types.Message:
+        client = self.client
+        if self.scheduler is not None:
+            # The scheduler retries, coordinated across conversations.
+            client = client.with_options(max_retries=0)
+        if on_text is None:
+            raw = await client.messages.with_raw_response.create(**kwargs)
+            if self.scheduler is not None:
+                self.scheduler.observe(raw.headers)
+            response = await raw.parse()
+            self._record_usage(response)
+            return response
+        # Streaming mode: text reaches on_text as it is generated, and the
+        # assembled message is the same one create() would have returned.
+        # Each tool_use block starts running as soon as its input is
+        # complete, overlapping the tools with the rest of the generation.
+        batch = _ToolBatch(self)
+        try:
+            async with client.messages.stream(**kwargs) as stream:
+                if self.scheduler is not None:
+                    self.scheduler.observe(stream.response.headers)
+                async for event in stream:
+                    if event.type == "text":
+                        ack = on_text(event.text)
+                    elif event.type == "content_block_stop" and event.content_block.type == "tool_use":
+                        batch.start(event.content_block)
+                        ack = on_tool_use(event.content_block) if on_tool_use is not None else None
+                    else:
+                        continue
+                    if inspect.isawaitable(ack):
+                        await ack
+                response = await stream.get_final_message()
+        except BaseException:
+            batch.cancel()
+            raise
+        self._record_usage(response)
+        if response.stop_reason == "tool_use":
+            self._tool_batch = batch
+        else:
+            # Cut off (e.g. max_tokens): nobody will collect these results.
+            batch.cancel()
+        return response
+
+    def _request_kwargs(self) -> dict[str, Any]:
         kwargs: dict[str, Any] = {
             "model": self.model,
             "max_tokens": self.max_tokens,
@@ -40,56 +206,134 @@ class Conversation:
             kwargs["system"] = self.system
         if self.tools:
             kwargs["tools"] = self.tools
-        return await self.client.messages.create(**kwargs)
+        if not self.prompt_caching:
+            return kwargs
+        # Breakpoints (at most 4): the end of the tool list, the system
+        # prompt, and the last two user messages. The newest one caches this
+        # turn's prefix; the one before it is where the previous request's
+        # breakpoint was, so that prefix is read back even when a turn adds
+        # more blocks than the cache lookback covers.
+        if self.tools:
+            kwargs["tools"] = [*self.tools[:-1], {**self.tools[-1], "cache_control": _CACHE_CONTROL}]
+        if self.system:
+            kwargs["system"] = [_cached_block(self.system)]
+        messages = list(self.messages)
+        marked = 0
+        for i in range(len(messages) - 1, -1, -1):
+            if marked == 2:
+                break
+            if messages[i]["role"] == "user" and messages[i]["content"]:
+                messages[i] = _with_breakpoint(messages[i])
+                marked += 1
+        kwargs["messages"] = messages
+        return kwargs
+
+    def _record_usage(self, response: anthropic.types.Message) -> None:
+        usage = response.usage
+        self.last_usage = {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+        for field, value in self.last_usage.items():
+            self.usage[field] = self.usage.get(field, 0) + value
+        self.usage["turns"] = self.usage.get("turns", 0) + 1
+        self.context.observe(self.last_usage)
 
-    async def send(self, user_text: str) -> anthropic.types.Message:
+    async def send(
+        self,
+        user_text: str,
+        on_text: Callable[[str], Any] | None = None,
+        on_tool_use: Callable[[Any], Any] | None = None,
+    ) -> anthropic.types.Message:
         self.messages.append({"role": "user", "content": user_text})
-        response = await self._create()
+        response = await self._create(on_text, on_tool_use)
         self.messages.append({"role": "assistant", "content": response.content})
         return response
 
-    async def step(self) -> anthropic.types.Message:
-        response = await self._create()
+    async def step(
+        self,
+        on_text: Callable[[str], Any] | None = None,
+        on_tool_use: Callable[[Any], Any] | None = None,
+    ) -> anthropic.types.Message:
+        response = await self._create(on_text, on_tool_use)
         self.messages.append({"role": "assistant", "content": response.content})
         return response
 
+    def cancel_tools(self) -> None:
+        # Drops tool calls started from a streamed message whose results
+        # were never collected.
+        if self._tool_batch is not None:
+            self._tool_batch.cancel()
+            self._tool_batch = None
+
     async def _call_handler(self, handler: Callable[..., Any], **kwargs: Any) -> Any:
-        result = handler(**kwargs)
+        if inspect.iscoroutinefunction(handler):
+            return await handler(**kwargs)
+        # Plain functions (the local tools) block, so they get a thread to
+        # let the rest of the turn's calls run alongside.
+        result = await asyncio.to_thread(handler, **kwargs)
         if inspect.isawaitable(result):
             result = await result
         return result
 
-    async def _handle_tool_use(self, response: anthropic.types.Message) -> None:
-        tool_results = []
-        for block in response.content:
-            if block.type != "tool_use":
-                continue
-            handler = self.tool_handlers.get(block.name)
-            if handler is None:
-                result = f"Error: no handler registered for tool '{block.name}'"
-            else:
-                try:
-                    result = await self._call_handler(handler, **block.input)
-                except Exception as e:
-                    result = f"Error: {e}"
-            if not isinstance(result, str):
-                result = json.dumps(result)
-            tool_results.append(
-                {
-                    "type": "tool_result",
-                    "tool_use_id": block.id,
-                    "content": result,
-                }
-            )
-        if tool_results:
-            self.messages.append({"role": "user", "content": tool_results})
-
-    async def run_until_done(self, user_text: str) -> str:
-        response = await self.send(user_text)
+    async def _run_tool(self, block: Any) -> dict[str, Any]:
+        handler = self.tool_handlers.get(block.name)
+        if handler is None:
+            result = f"Error: no handler registered for tool '{block.name}'"
+        else:
+            token = current_tool_use_id.set(block.id)
+            try:
+                result = await self._call_handler(handler, **block.input)
+            except Exception as e:
+                result = f"Error: {e}"
+            finally:
+                current_tool_use_id.reset(token)
+        if not isinstance(result, str):
+            result = json.dumps(result)
+        return {
+            "type": "tool_result",
+            "tool_use_id": block.id,
+            "content": result,
+        }
+
+    async def _handle_tool_use(
+        self,
+        response: anthropic.types.Message,
+        on_result: Callable[[dict[str, Any]], Any] | None = None,
+    ) -> None:
+        # A turn's tool calls run concurrently (up to max_parallel_tools);
+        # on_result sees each one as it finishes, while the message keeps
+        # the order Claude asked for them in. Calls already started while
+        # the message streamed are picked up rather than run again.
+        batch, self._tool_batch = self._tool_batch or _ToolBatch(self), None
+        blocks = [block for block in response.content if block.type == "tool_use"]
+        if not blocks:
+            batch.cancel()
+            return
+        for block in blocks:
+            batch.start(block)
+
+        async def _collect(block: Any) -> dict[str, Any]:
+            tool_result = await batch.tasks[block.id]
+            if on_result is not None:
+                ack = on_result(tool_result)
+                if inspect.isawaitable(ack):
+                    await ack
+            return tool_result
+
+        tasks = [asyncio.ensure_future(_collect(block)) for block in blocks]
+        try:
+            tool_results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            batch.cancel()
+            raise
+        self.messages.append({"role": "user", "content": list(tool_results)})
+
+    async def run_until_done(self, user_text: str, on_text: Callable[[str], Any] | None = None) -> str:
+        response = await self.send(user_text, on_text)
 
         while response.stop_reason == "tool_use":
             await self._handle_tool_use(response)
-            response = await self.step()
+            response = await self.step(on_text)
 
         text_parts = [b.text for b in response.content if b.type == "text"]
         return "\n".join(text_parts)
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable
+
+from context import CHARS_PER_TOKEN
+from conversation import Conversation
+from hub import Hub
+from sessions import AsyncSessionStore
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class _Entry:
+    __slots__ = ("conv", "lock", "users", "size", "tools_version", "on_progress")
+
+    def __init__(self, conv: Conversation) -> None:
+        self.conv = conv
+        # One run at a time per session: they all share this conversation.
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.size = 0
+        self.tools_version = -1
+        self.on_progress: Callable[[str | None, str, str], Any] | None = None
+
+
+class _Loading:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self, future: asyncio.Future[_Entry]) -> None:
+        self.future = future
+        # Callers waiting for this load; the entry starts with their users
+        # counted, so it cannot be evicted before they resume.
+        self.waiters = 0
+
+
+# Live Conversations by session id, so requests to an active session skip
+# loading the history and registering tools. LRU, bounded by count and by
+# estimated size; entries in use are never evicted, and an evicted one has
+# its pending save written first. Tools are registered once per entry (again
+# if the hub's tool set changes), with the priority and progress callback of
+# whoever is using it at the time.
+class ConversationCache:
+    def __init__(
+        self,
+        store: AsyncSessionStore,
+        hub: Hub,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ) -> None:
+        self.store = store
+        self.hub = hub
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._loading: dict[str, _Loading] = {}
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @contextlib.asynccontextmanager
+    async def use(
+        self,
+        session_id: str,
+        on_progress: Callable[[str | None, str, str], Any] | None = None,
+    ) -> AsyncIterator[Conversation]:
+        # Waits for other runs on the session to finish. If the run fails,
+        # the conversation may hold a half-finished turn, so the entry is
+        # dropped and the next use reloads what was saved.
+        entry = await self._get(session_id)
+        try:
+            async with entry.lock:
+                if entry.tools_version != self.hub.tools_version:
+                    self._bind(session_id, entry)
+                entry.on_progress = on_progress
+                try:
+                    yield entry.conv
+                except BaseException:
+                    self.discard(session_id)
+                    raise
+                finally:
+                    entry.on_progress = None
+        finally:
+            entry.users -= 1
+            if self._entries.get(session_id) is entry:
+                self._resize(entry)
+        await self._evict()
+
+    async def _get(self, session_id: str) -> _Entry:
+        # Returns the entry with a user counted for the caller.
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            entry.users += 1
+            return entry
+        loading = self._loading.get(session_id)
+        if loading is not None:
+            self.hits += 1
+            loading.waiters += 1
+            try:
+                return await asyncio.shield(loading.future)
+            except asyncio.CancelledError:
+                if loading.future.done() and not loading.future.cancelled() and loading.future.exception() is None:
+                    loading.future.result().users -= 1
+                else:
+                    loading.waiters -= 1
+                raise
+        self.misses += 1
+        future: asyncio.Future[_Entry] = asyncio.get_running_loop().create_future()
+        loading = self._loading[session_id] = _Loading(future)
+        try:
+            entry = _Entry(await self.store.load(session_id))
+            # Sizing a long history is too slow for the event loop; the
+            # estimates are kept for the first model request anyway.
+            await asyncio.to_thread(entry.conv.context.measure, entry.conv.messages)
+        except BaseException as e:
+            future.set_exception(e)
+            # Marks the exception retrieved when nobody else was waiting.
+            future.exception()
+            raise
+        finally:
+            del self._loading[session_id]
+        entry.users = 1 + loading.waiters
+        future.set_result(entry)
+        self._entries[session_id] = entry
+        self._resize(entry)
+        return entry
+
+    def _bind(self, session_id: str, entry: _Entry) -> None:
+        async def _progress(tool_use_id: str | None, name: str, chunk: str) -> None:
+            if entry.on_progress is not None:
+                await entry.on_progress(tool_use_id, name, chunk)
+
+        entry.conv.tools = []
+        entry.conv.tool_handlers = {}
+        self.hub.register_tools_on(entry.conv, session_id=session_id, priority=None, on_progress=_progress)
+        entry.tools_version = self.hub.tools_version
+
+    def _resize(self, entry: _Entry) -> None:
+        # Per-message estimates are cached by the context manager (from the
+        # last model request), so only messages added since are measured.
+        size = sum(entry.conv.context.message_tokens(m) for m in entry.conv.messages) * CHARS_PER_TOKEN
+        self._size += size - entry.size
+        entry.size = size
+
+    async def _evict(self) -> None:
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            session_id = next((sid for sid, e in self._entries.items() if e.users == 0), None)
+            if session_id is None:
+                return
+            self.discard(session_id)
+            self.evictions += 1
+            await self.store.flush(session_id)
+
+    def discard(self, session_id: str) -> None:
+        # Call before clearing or deleting a session, so nobody picks up the
+        # old history. A run still holding the conversation keeps it.
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def as_dict(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
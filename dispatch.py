@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import math
+from abc import ABC, abstractmethod
+
+
+DEFAULT_CAPACITY = 4
+
+
+class DispatchPolicy(ABC):
+    @abstractmethod
+    def add_worker(self, worker_id: str, tools: list[str], capacity: int = DEFAULT_CAPACITY) -> None:
+        ...
+
+    @abstractmethod
+    def remove_worker(self, worker_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def pick(self, tool_name: str, preferred: str | None = None, exclude: str | None = None) -> str | None:
+        ...
+
+    @abstractmethod
+    def acquire(self, worker_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def release(self, worker_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def outstanding(self, worker_id: str) -> int:
+        ...
+
+    @abstractmethod
+    def capacity(self, worker_id: str) -> int:
+        ...
+
+    def observe_rtt(self, worker_id: str, rtt: float) -> None:
+        pass
+
+    def has_capacity(self, worker_id: str) -> bool:
+        return self.outstanding(worker_id) < self.capacity(worker_id)
+
+
+class _FreeSlotIndex:
+    # Workers bucketed by free slots. Loads only ever move by one, so the
+    # emptiest worker is found without scanning the pool. Buckets are ordered
+    # dicts: a worker re-entering a bucket goes to the back, which spreads
+    # ties round-robin.
+    def __init__(self) -> None:
+        self._buckets: dict[int, dict[str, None]] = {}
+        self._free: dict[str, int] = {}
+        self._top: int | None = None
+
+    def __len__(self) -> int:
+        return len(self._free)
+
+    def __contains__(self, worker_id: object) -> bool:
+        return worker_id in self._free
+
+    def add(self, worker_id: str, free: int) -> None:
+        self._free[worker_id] = free
+        self._buckets.setdefault(free, {})[worker_id] = None
+        if self._top is None or free > self._top:
+            self._top = free
+
+    def remove(self, worker_id: str) -> None:
+        free = self._free.pop(worker_id)
+        bucket = self._buckets[free]
+        del bucket[worker_id]
+        if not bucket:
+            del self._buckets[free]
+            if free == self._top:
+                # Bounded by the number of distinct free-slot values, not by
+                # the number of workers or calls.
+                self._top = max(self._buckets) if self._buckets else None
+
+    def shift(self, worker_id: str, delta: int) -> None:
+        free = self._free[worker_id]
+        self.remove(worker_id)
+        self.add(worker_id, free + delta)
+
+    def best(self, exclude: str | None = None, rtt: dict[str, float] | None = None) -> str | None:
+        if self._top is None:
+            return None
+        # Among equally loaded workers, compare the next two in rotation and
+        # take the closer one, so nearby workers win ties without a full scan.
+        candidates: list[str] = []
+        for wid in self._buckets[self._top]:
+            if wid != exclude:
+                candidates.append(wid)
+                if len(candidates) == 2 or not rtt:
+                    break
+        if candidates:
+            return min(candidates, key=lambda w: rtt.get(w, 0.0)) if rtt else candidates[0]
+        lower = [free for free in self._buckets if free != self._top]
+        if not lower:
+            return None
+        return next(iter(self._buckets[max(lower)]))
+
+    def free(self, worker_id: str) -> int:
+        return self._free[worker_id]
+
+
+# Routes to the worker with the most free slots. A preferred (session-affine)
+# worker wins only while it is below its declared capacity.
+class LeastOutstandingPolicy(DispatchPolicy):
+    def __init__(self) -> None:
+        self._capacity: dict[str, int] = {}
+        self._outstanding: dict[str, int] = {}
+        self._worker_tools: dict[str, list[str]] = {}
+        self._tool_index: dict[str, _FreeSlotIndex] = {}
+        self._rtt: dict[str, float] = {}
+
+    def add_worker(self, worker_id: str, tools: list[str], capacity: int = DEFAULT_CAPACITY) -> None:
+        if worker_id in self._capacity:
+            self.remove_worker(worker_id)
+        self._capacity[worker_id] = max(1, capacity)
+        self._outstanding[worker_id] = 0
+        self._worker_tools[worker_id] = list(dict.fromkeys(tools))
+        for name in self._worker_tools[worker_id]:
+            self._tool_index.setdefault(name, _FreeSlotIndex()).add(worker_id, self._capacity[worker_id])
+
+    def remove_worker(self, worker_id: str) -> None:
+        self._capacity.pop(worker_id, None)
+        self._outstanding.pop(worker_id, None)
+        self._rtt.pop(worker_id, None)
+        for name in self._worker_tools.pop(worker_id, []):
+            index = self._tool_index[name]
+            index.remove(worker_id)
+            if not len(index):
+                del self._tool_index[name]
+
+    def pick(self, tool_name: str, preferred: str | None = None, exclude: str | None = None) -> str | None:
+        index = self._tool_index.get(tool_name)
+        if index is None:
+            return None
+        if preferred is not None and preferred != exclude and preferred in index and index.free(preferred) > 0:
+            return preferred
+        return index.best(exclude, self._rtt)
+
+    def _shift(self, worker_id: str, delta: int) -> None:
+        self._outstanding[worker_id] += delta
+        for name in self._worker_tools[worker_id]:
+            self._tool_index[name].shift(worker_id, -delta)
+
+    def acquire(self, worker_id: str) -> None:
+        if worker_id in self._outstanding:
+            self._shift(worker_id, 1)
+
+    def release(self, worker_id: str) -> None:
+        if self._outstanding.get(worker_id, 0) > 0:
+            self._shift(worker_id, -1)
+
+    def outstanding(self, worker_id: str) -> int:
+        return self._outstanding.get(worker_id, 0)
+
+    def capacity(self, worker_id: str) -> int:
+        return self._capacity.get(worker_id, 0)
+
+    def observe_rtt(self, worker_id: str, rtt: float) -> None:
+        if worker_id in self._capacity:
+            self._rtt[worker_id] = rtt
+
+
+class LatencyHistogram:
+    # Log-spaced buckets (~19% wide) from 1 ms up. Counts are halved once the
+    # total passes decay_at, so percentiles follow recent behaviour.
+    _BASE = 1.19
+    _BUCKETS = 80
+
+    def __init__(self, decay_at: int = 2000) -> None:
+        self._counts = [0] * self._BUCKETS
+        self._total = 0
+        self._decay_at = decay_at
+
+    def __len__(self) -> int:
+        return self._total
+
+    def record(self, seconds: float) -> None:
+        ms = max(seconds * 1000, 1.0)
+        idx = min(int(math.log(ms, self._BASE)), self._BUCKETS - 1)
+        self._counts[idx] += 1
+        self._total += 1
+        if self._total >= self._decay_at:
+            self._counts = [c // 2 for c in self._counts]
+            self._total = sum(self._counts)
+
+    def percentile(self, p: float) -> float | None:
+        if not self._total:
+            return None
+        target = p * self._total
+        seen = 0
+        for idx, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return self._BASE ** (idx + 1) / 1000
+        return self._BASE ** self._BUCKETS / 1000
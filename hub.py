@@ -1,32 +1,168 @@
 from __future__ import annotations
 
 import asyncio
+import functools
+import heapq
+import inspect
+import itertools
 import json
+import time
 import uuid
 from typing import Any, Callable, Awaitable
 
 import websockets
 from websockets.asyncio.server import Server, ServerConnection
 
-from conversation import Conversation
+from cache import ResultCache, cache_key
+from conversation import Conversation, current_tool_use_id
+from dispatch import DEFAULT_CAPACITY, DispatchPolicy, LatencyHistogram, LeastOutstandingPolicy
+from wire import JSON, Codec, decode, negotiate
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+class _QueueFull(Exception):
+    pass
+
+
+class _WorkerLost:
+    __slots__ = ("worker_id",)
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+
+
+class _InFlight:
+    __slots__ = (
+        "worker_id", "tool_name", "future", "sent_at", "parts", "size", "truncated", "on_progress", "cache_key",
+    )
+
+    def __init__(
+        self,
+        worker_id: str,
+        tool_name: str,
+        future: asyncio.Future[str | _WorkerLost],
+        on_progress: Callable[[str], Any] | None = None,
+    ):
+        self.worker_id = worker_id
+        self.tool_name = tool_name
+        self.future = future
+        self.sent_at = time.monotonic()
+        self.parts: list[str] = []
+        self.size = 0
+        self.truncated = False
+        self.on_progress = on_progress
+        self.cache_key: str | None = None
+
+
+class _ToolStats:
+    __slots__ = (
+        "calls", "queued", "rejected", "hedged", "hedge_wins", "retried", "cache_hits", "cache_misses",
+        "queue_wait_total", "queue_wait_max", "exec_total", "exec_max",
+    )
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.queued = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.retried = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.exec_total = 0.0
+        self.exec_max = 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "retried": self.retried,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "queue_wait_avg_ms": round(self.queue_wait_total / self.queued * 1000, 1) if self.queued else 0.0,
+            "queue_wait_max_ms": round(self.queue_wait_max * 1000, 1),
+            "exec_avg_ms": round(self.exec_total / self.calls * 1000, 1) if self.calls else 0.0,
+            "exec_max_ms": round(self.exec_max * 1000, 1),
+        }
 
 
 class Hub:
-    def __init__(self, conversation: Conversation, host: str = "0.0.0.0", port: int = 9600):
+    def __init__(
+        self,
+        conversation: Conversation,
+        host: str = "0.0.0.0",
+        port: int = 9600,
+        policy: DispatchPolicy | None = None,
+        max_queue: int = 256,
+        queue_timeout: float = 120.0,
+        tool_traits: dict[str, dict[str, Any]] | None = None,
+        hedge_percentile: float = 0.95,
+        hedge_default_delay: float = 1.0,
+        hedge_min_samples: int = 20,
+        max_retries: int = 2,
+        heartbeat_interval: float = 5.0,
+        heartbeat_misses: int = 3,
+        max_result_bytes: int = 512 * 1024,
+        cache_max_bytes: int = 0,
+        cache_ttl: dict[str, float] | None = None,
+        default_cache_ttl: float = 30.0,
+    ):
         self.conversation = conversation
         self.host = host
         self.port = port
         self._server: Server | None = None
-        self._worker_senders: dict[str, Callable[[str], Awaitable[None]]] = {}
-        self._tool_to_workers: dict[str, list[str]] = {}
-        self._tool_rr_index: dict[str, int] = {}
+        self._policy: DispatchPolicy = policy or LeastOutstandingPolicy()
+        self._worker_senders: dict[str, Callable[[str | bytes], Awaitable[None]]] = {}
+        self._codecs: dict[str, Codec] = {}
+        self._tool_to_workers: dict[str, dict[str, None]] = {}
+        self._worker_tools: dict[str, list[str]] = {}
         self._session_affinity: dict[str, str] = {}
-        self._pending: dict[str, asyncio.Future[str]] = {}
-        self._busy_workers: set[str] = set()
-        self._call_to_worker: dict[str, str] = {}
+        self._worker_sessions: dict[str, set[str]] = {}
+        self._calls: dict[str, _InFlight] = {}
+        self._worker_calls: dict[str, set[str]] = {}
         self._worker_ready = asyncio.Event()
         self._worker_count = 0
-        self._tool_schemas: list[dict] = []
+        self._tool_schemas: dict[str, dict] = {}
+        # Bumped whenever a tool appears or disappears, so conversations
+        # kept between requests know to register the tools again.
+        self.tools_version = 0
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._queues: dict[str, list[tuple[int, int, asyncio.Future[str | None]]]] = {}
+        self._queue_seq = itertools.count()
+        self._stats: dict[str, _ToolStats] = {}
+        self._tool_traits: dict[str, dict[str, Any]] = {}
+        self._trait_overrides: dict[str, dict[str, Any]] = tool_traits or {}
+        self.hedge_percentile = hedge_percentile
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.max_retries = max_retries
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.max_result_bytes = max_result_bytes
+        self._connections: dict[str, Any] = {}
+        self._last_seen: dict[str, float] = {}
+        self._rtt: dict[str, float] = {}
+        # Workers that have answered a ping. Older workers never do, so
+        # silence only marks a worker dead once it is known to answer.
+        self._ponged: set[str] = set()
+        self._background: set[asyncio.Future[Any]] = set()
+        self._latency: dict[str, LatencyHistogram] = {}
+        # Off unless given a size; only tools with the "cacheable" trait use it.
+        self._cache = ResultCache(cache_max_bytes) if cache_max_bytes > 0 else None
+        self._cache_ttl: dict[str, float] = cache_ttl or {}
+        self.default_cache_ttl = default_cache_ttl
+        # Per caller (the session, or the conversation when it has none),
+        # calls of non-cacheable tools (which may change what cached results
+        # describe) that have not returned yet.
+        self._uncached_calls: dict[Any, int] = {}
 
     @property
     def worker_count(self) -> int:
@@ -47,48 +183,77 @@ class Hub:
             await self._worker_ready.wait()
 
     def get_workers_info(self) -> list[dict[str, Any]]:
-        workers: dict[str, list[str]] = {}
-        for tool_name, worker_ids in self._tool_to_workers.items():
-            for wid in worker_ids:
-                if wid in self._worker_senders:
-                    workers.setdefault(wid, []).append(tool_name)
-
-        affinity_reverse: dict[str, list[str]] = {}
-        for sid, wid in self._session_affinity.items():
-            affinity_reverse.setdefault(wid, []).append(sid)
-
+        now = time.monotonic()
         return [
             {
                 "worker_id": wid,
                 "tools": tools,
-                "status": "busy" if wid in self._busy_workers else "idle",
-                "sessions": affinity_reverse.get(wid, []),
+                "status": "busy" if self._policy.outstanding(wid) > 0 else "idle",
+                "outstanding": self._policy.outstanding(wid),
+                "capacity": self._policy.capacity(wid),
+                "sessions": sorted(self._worker_sessions.get(wid, ())),
+                "rtt_ms": round(self._rtt[wid] * 1000, 2) if wid in self._rtt else None,
+                "last_seen_s": round(now - self._last_seen[wid], 1) if wid in self._last_seen else None,
             }
-            for wid, tools in workers.items()
+            for wid, tools in self._worker_tools.items()
+            if wid in self._worker_senders
         ]
 
-    def register_tools_on(self, conv: Conversation, session_id: str | None = None) -> None:
-        for schema in self._tool_schemas:
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            name: {
+                **stats.as_dict(),
+                "queue_depth": self._queue_depth(name),
+                "hedge_delay_ms": round(self._hedge_delay(name) * 1000, 1) if self._trait(name, "idempotent") else None,
+            }
+            for name, stats in self._stats.items()
+        }
+
+    def get_cache_stats(self) -> dict[str, Any] | None:
+        return self._cache.as_dict() if self._cache is not None else None
+
+    def register_tools_on(
+        self,
+        conv: Conversation,
+        session_id: str | None = None,
+        priority: int | None = PRIORITY_INTERACTIVE,
+        on_progress: Callable[[str | None, str, str], Any] | None = None,
+    ) -> None:
+        # on_progress(tool_use_id, tool_name, chunk) sees streamed output
+        # while a tool is still running. With priority None, calls take the
+        # conversation's priority at the time they are made.
+        for schema in self._tool_schemas.values():
             name = schema["name"]
-            async def _handler(__name=name, __sid=session_id, **kwargs: Any) -> str:
-                return await self._dispatch(__name, kwargs, session_id=__sid)
+            async def _handler(__name=name, __sid=session_id, __prio=priority, **kwargs: Any) -> str:
+                progress = None
+                if on_progress is not None:
+                    progress = functools.partial(on_progress, current_tool_use_id.get(), __name)
+                prio = conv.priority if __prio is None else __prio
+                return await self._dispatch(
+                    __name, kwargs, session_id=__sid, priority=prio, on_progress=progress, caller=conv,
+                )
             conv.register_tool(schema, _handler)
 
     async def _handle_worker(self, ws: ServerConnection) -> None:
         first_raw = await ws.recv()
-        first_msg = json.loads(first_raw)
+        first_msg = decode(first_raw)
         worker_id = first_msg.get("worker_id") or str(uuid.uuid4())[:8]
-        self._worker_senders[worker_id] = ws.send
+        self._attach_worker(worker_id, ws, ws.send)
         print(f"Worker {worker_id} connected")
+        await self._negotiate(worker_id, first_msg)
         self._process_message(worker_id, first_raw)
+        heartbeat = asyncio.create_task(self._heartbeat(worker_id, ws, ws.close))
 
         try:
             async for raw in ws:
+                if self._connections.get(worker_id) is not ws:
+                    break
                 self._process_message(worker_id, raw)
         except websockets.ConnectionClosed:
             pass
         finally:
-            self._cleanup_worker(worker_id)
+            heartbeat.cancel()
+            self._cleanup_worker(worker_id, ws)
 
     async def aiohttp_worker_handler(self, request: Any) -> Any:
         from aiohttp import web
@@ -100,140 +265,571 @@ class Hub:
         if first_msg_raw.type != web.WSMsgType.TEXT:
             await ws.close()
             return ws
-        first_msg = json.loads(first_msg_raw.data)
+        first_msg = decode(first_msg_raw.data)
         worker_id = first_msg.get("worker_id") or str(uuid.uuid4())[:8]
-        self._worker_senders[worker_id] = ws.send_str
+
+        async def _send(frame: str | bytes) -> None:
+            if isinstance(frame, bytes):
+                await ws.send_bytes(frame)
+            else:
+                await ws.send_str(frame)
+
+        self._attach_worker(worker_id, ws, _send)
         print(f"Worker {worker_id} connected (aiohttp)")
+        await self._negotiate(worker_id, first_msg)
         self._process_message(worker_id, first_msg_raw.data)
+        heartbeat = asyncio.create_task(self._heartbeat(worker_id, ws, ws.close))
 
         try:
             async for msg in ws:
-                if msg.type == web.WSMsgType.TEXT:
+                if self._connections.get(worker_id) is not ws:
+                    break
+                if msg.type in (web.WSMsgType.TEXT, web.WSMsgType.BINARY):
                     self._process_message(worker_id, msg.data)
                 elif msg.type in (web.WSMsgType.ERROR, web.WSMsgType.CLOSE):
                     break
         finally:
-            self._cleanup_worker(worker_id)
+            heartbeat.cancel()
+            self._cleanup_worker(worker_id, ws)
 
         return ws
 
-    def _process_message(self, worker_id: str, raw: str) -> None:
-        msg = json.loads(raw)
+    def _attach_worker(self, worker_id: str, conn: Any, send: Callable[[str | bytes], Awaitable[None]]) -> None:
+        # A worker that reconnects before its old socket is noticed as dead
+        # replaces it; the old connection's calls are lost/re-dispatched.
+        if worker_id in self._connections:
+            self._cleanup_worker(worker_id, self._connections[worker_id])
+        self._connections[worker_id] = conn
+        self._worker_senders[worker_id] = send
+        self._codecs[worker_id] = Codec(JSON)
+        self._last_seen[worker_id] = time.monotonic()
+
+    async def _negotiate(self, worker_id: str, register: dict[str, Any]) -> None:
+        # Workers that list encodings get told which one this connection uses
+        # before anything else is sent; older workers stay on JSON.
+        offered = register.get("encodings")
+        if not offered:
+            return
+        codec = negotiate(offered)
+        await self._worker_senders[worker_id](json.dumps({"type": "welcome", "encoding": codec.encoding}))
+        self._codecs[worker_id] = codec
+
+    async def _send(self, worker_id: str, msg: dict[str, Any]) -> None:
+        await self._worker_senders[worker_id](self._codecs[worker_id].encode(msg))
+
+    async def _heartbeat(self, worker_id: str, conn: Any, close: Callable[[], Awaitable[Any]]) -> None:
+        while self._connections.get(worker_id) is conn:
+            silent = time.monotonic() - self._last_seen.get(worker_id, 0.0)
+            if worker_id in self._ponged and silent > self.heartbeat_interval * self.heartbeat_misses:
+                print(f"Worker {worker_id} missed {self.heartbeat_misses} heartbeats, marking dead")
+                self._cleanup_worker(worker_id, conn)
+                await close()
+                return
+            try:
+                await self._send(worker_id, {
+                    "type": "ping",
+                    "ts": time.monotonic(),
+                    "interval": self.heartbeat_interval,
+                })
+            except Exception:
+                pass
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def _process_message(self, worker_id: str, raw: str | bytes) -> None:
+        msg = decode(raw)
         msg_type = msg.get("type")
+        self._last_seen[worker_id] = time.monotonic()
 
-        if msg_type == "register":
+        if msg_type == "pong":
+            self._ponged.add(worker_id)
+            sample = time.monotonic() - float(msg["ts"])
+            previous = self._rtt.get(worker_id)
+            self._rtt[worker_id] = sample if previous is None else 0.8 * previous + 0.2 * sample
+            self._policy.observe_rtt(worker_id, self._rtt[worker_id])
+
+        elif msg_type == "register":
             self._register_tools(worker_id, msg["tools"])
+            for name, traits in msg.get("traits", {}).items():
+                self._tool_traits.setdefault(name, {}).update(traits)
+            self._policy.add_worker(
+                worker_id,
+                self._worker_tools[worker_id],
+                capacity=int(msg.get("capacity", DEFAULT_CAPACITY)),
+            )
             self._worker_count += 1
             self._worker_ready.set()
             print(f"Worker {worker_id} registered {len(msg['tools'])} tool(s)")
+            self._drain_queues(worker_id)
 
         elif msg_type == "tool_result":
-            call_id = msg["call_id"]
-            finished_wid = self._call_to_worker.pop(call_id, None)
-            if finished_wid and not any(w == finished_wid for w in self._call_to_worker.values()):
-                self._busy_workers.discard(finished_wid)
-            fut = self._pending.pop(call_id, None)
-            if fut and not fut.done():
-                fut.set_result(msg["content"])
-
-    def _cleanup_worker(self, worker_id: str) -> None:
+            # Older workers send every result in one frame; it gets the same
+            # cap as a streamed one.
+            call = self._finish_call(msg["call_id"])
+            if call and not call.future.done():
+                content = msg["content"]
+                encoded = content.encode()
+                if len(encoded) > self.max_result_bytes:
+                    content = encoded[:self.max_result_bytes].decode(errors="ignore") + self._truncation_marker()
+                else:
+                    self._store_result(call, content, msg.get("token"))
+                call.future.set_result(content)
+
+        elif msg_type == "tool_result_chunk":
+            call = self._calls.get(msg["call_id"])
+            if call is not None:
+                self._append_chunk(call, msg["content"])
+
+        elif msg_type == "tool_result_end":
+            call = self._finish_call(msg["call_id"])
+            if call and not call.future.done():
+                content = "".join(call.parts)
+                if call.truncated or msg.get("truncated"):
+                    content += self._truncation_marker()
+                else:
+                    self._store_result(call, content, msg.get("token"))
+                call.future.set_result(content)
+
+        elif msg_type == "invalidate":
+            if self._cache is not None:
+                self._cache.invalidate(msg["key"], msg.get("token"))
+
+    def _store_result(self, call: _InFlight, content: str, token: str | None) -> None:
+        # Workers only send a token for a successful read they can later
+        # re-check; without one the result is not cached.
+        if self._cache is None or call.cache_key is None or token is None:
+            return
+        ttl = self._cache_ttl.get(call.tool_name, self.default_cache_ttl)
+        self._cache.put(call.cache_key, content, token, call.worker_id, ttl)
+
+    def _truncation_marker(self) -> str:
+        return f"\n[output truncated at {self.max_result_bytes} bytes]"
+
+    def _append_chunk(self, call: _InFlight, data: str) -> None:
+        # Workers already stop at max_bytes; this keeps the hub bounded even
+        # if one does not. Sizes are in UTF-8 bytes, as on the worker.
+        encoded = data.encode()
+        room = self.max_result_bytes - call.size
+        if len(encoded) > room:
+            encoded = encoded[:max(room, 0)]
+            data = encoded.decode(errors="ignore")
+            call.truncated = True
+        if not data:
+            return
+        call.parts.append(data)
+        call.size += len(encoded)
+        if call.on_progress is not None:
+            result = call.on_progress(data)
+            if inspect.isawaitable(result):
+                self._spawn(result)
+
+    def _spawn(self, aw: Awaitable[Any]) -> None:
+        task = asyncio.ensure_future(aw)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _start_call(
+        self,
+        call_id: str,
+        worker_id: str,
+        tool_name: str,
+        on_progress: Callable[[str], Any] | None = None,
+    ) -> _InFlight:
+        # The worker's slot was already reserved by _acquire_worker.
+        call = _InFlight(worker_id, tool_name, asyncio.get_event_loop().create_future(), on_progress)
+        self._calls[call_id] = call
+        self._worker_calls.setdefault(worker_id, set()).add(call_id)
+        return call
+
+    def _finish_call(self, call_id: str) -> _InFlight | None:
+        call = self._calls.pop(call_id, None)
+        if call is None:
+            return None
+        calls = self._worker_calls.get(call.worker_id)
+        if calls is not None:
+            calls.discard(call_id)
+        self._release_slot(call.worker_id)
+        return call
+
+    def _release_slot(self, worker_id: str) -> None:
+        self._policy.release(worker_id)
+        self._drain_queues(worker_id)
+
+    def _queue_depth(self, tool_name: str) -> int:
+        return sum(1 for _, _, fut in self._queues.get(tool_name, ()) if not fut.done())
+
+    def _drain_queues(self, worker_id: str) -> None:
+        # Hand free slots on this worker to the highest-priority waiters across
+        # every tool it serves. The slot is reserved before the waiter wakes so
+        # a newly arriving call cannot take it in between.
+        while worker_id in self._worker_senders and self._policy.has_capacity(worker_id):
+            best: list[tuple[int, int, asyncio.Future[str | None]]] | None = None
+            for tool_name in self._worker_tools.get(worker_id, ()):
+                queue = self._queues.get(tool_name)
+                while queue and queue[0][2].done():
+                    heapq.heappop(queue)
+                if queue and (best is None or queue[0][:2] < best[0][:2]):
+                    best = queue
+            if best is None:
+                return
+            _, _, fut = heapq.heappop(best)
+            self._policy.acquire(worker_id)
+            fut.set_result(worker_id)
+
+    def _cleanup_worker(self, worker_id: str, conn: Any = None) -> None:
+        # Both the heartbeat and the connection handler clean up; only the
+        # first one for the current connection does anything.
+        if conn is not None and self._connections.get(worker_id) is not conn:
+            return
+        self._connections.pop(worker_id, None)
+        self._last_seen.pop(worker_id, None)
+        self._rtt.pop(worker_id, None)
+        self._ponged.discard(worker_id)
         self._worker_senders.pop(worker_id, None)
-
-        empty_tools: list[str] = []
-        for tool_name, workers in self._tool_to_workers.items():
-            if worker_id in workers:
-                workers.remove(worker_id)
-                if not workers:
-                    empty_tools.append(tool_name)
-
-        for t in empty_tools:
-            del self._tool_to_workers[t]
-            self._tool_rr_index.pop(t, None)
-            self.conversation.tool_handlers.pop(t, None)
-            self.conversation.tools = [s for s in self.conversation.tools if s["name"] != t]
-            self._tool_schemas = [s for s in self._tool_schemas if s["name"] != t]
-
-        stale_sessions = [sid for sid, wid in self._session_affinity.items() if wid == worker_id]
-        for sid in stale_sessions:
-            del self._session_affinity[sid]
-
-        self._busy_workers.discard(worker_id)
-        stale_calls = [cid for cid, wid in self._call_to_worker.items() if wid == worker_id]
-        for cid in stale_calls:
-            del self._call_to_worker[cid]
-            fut = self._pending.pop(cid, None)
-            if fut and not fut.done():
-                fut.set_result(f"Error: worker '{worker_id}' disconnected")
-
-        self._worker_count -= 1
+        self._codecs.pop(worker_id, None)
+        self._policy.remove_worker(worker_id)
+        if self._cache is not None:
+            self._cache.drop_worker(worker_id)
+
+        registered = worker_id in self._worker_tools
+        for tool_name in self._worker_tools.pop(worker_id, []):
+            workers = self._tool_to_workers.get(tool_name)
+            if workers is None:
+                continue
+            workers.pop(worker_id, None)
+            if not workers:
+                del self._tool_to_workers[tool_name]
+                self._tool_schemas.pop(tool_name, None)
+                self.tools_version += 1
+                self.conversation.tool_handlers.pop(tool_name, None)
+                self.conversation.tools = [s for s in self.conversation.tools if s["name"] != tool_name]
+
+        for sid in self._worker_sessions.pop(worker_id, set()):
+            if self._session_affinity.get(sid) == worker_id:
+                del self._session_affinity[sid]
+
+        for cid in self._worker_calls.pop(worker_id, set()):
+            call = self._calls.pop(cid, None)
+            if call and not call.future.done():
+                call.future.set_result(_WorkerLost(worker_id))
+
+        # Calls queued for a tool nobody serves any more would wait forever.
+        for tool_name in list(self._queues):
+            if tool_name not in self._tool_to_workers:
+                for _, _, fut in self._queues.pop(tool_name):
+                    if not fut.done():
+                        fut.set_result(None)
+
+        if registered:
+            self._worker_count -= 1
         print(f"Worker {worker_id} disconnected")
 
     def _register_tools(self, worker_id: str, tool_schemas: list[dict[str, Any]]) -> None:
+        names = self._worker_tools.setdefault(worker_id, [])
         for schema in tool_schemas:
             name = schema["name"]
-            workers = self._tool_to_workers.setdefault(name, [])
-            if worker_id not in workers:
-                workers.append(worker_id)
+            self._tool_to_workers.setdefault(name, {})[worker_id] = None
+            if name not in names:
+                names.append(name)
 
-            if not any(s["name"] == name for s in self._tool_schemas):
-                self._tool_schemas.append(schema)
-                self._tool_rr_index[name] = 0
+            if name not in self._tool_schemas:
+                self._tool_schemas[name] = schema
+                self.tools_version += 1
 
                 async def _remote_handler(__name=name, **kwargs: Any) -> str:
-                    return await self._dispatch(__name, kwargs)
+                    return await self._dispatch(__name, kwargs, caller=self.conversation)
 
                 self.conversation.register_tool(schema, _remote_handler)
 
-    def _pick_worker(self, tool_name: str, session_id: str | None) -> str | None:
-        workers = self._tool_to_workers.get(tool_name)
-        if not workers:
-            return None
-
-        if session_id:
-            affinity_wid = self._session_affinity.get(session_id)
-            if affinity_wid and affinity_wid in workers and affinity_wid in self._worker_senders:
-                return affinity_wid
+    def _set_affinity(self, session_id: str, worker_id: str) -> None:
+        previous = self._session_affinity.get(session_id)
+        if previous is not None:
+            self._worker_sessions.get(previous, set()).discard(session_id)
+        self._session_affinity[session_id] = worker_id
+        self._worker_sessions.setdefault(worker_id, set()).add(session_id)
 
-        alive = [w for w in workers if w in self._worker_senders]
-        if not alive:
+    def _pick_worker(self, tool_name: str, session_id: str | None) -> str | None:
+        affinity_wid = self._session_affinity.get(session_id) if session_id else None
+        chosen = self._policy.pick(tool_name, preferred=affinity_wid)
+        if chosen is None or chosen not in self._worker_senders:
             return None
 
-        idx = self._tool_rr_index.get(tool_name, 0) % len(alive)
-        self._tool_rr_index[tool_name] = idx + 1
-        chosen = alive[idx]
-
-        if session_id:
-            self._session_affinity[session_id] = chosen
+        # Spill-over to another worker is temporary; keep the session's home
+        # worker unless it no longer serves this tool.
+        if session_id and (affinity_wid is None or affinity_wid not in self._tool_to_workers.get(tool_name, {})):
+            self._set_affinity(session_id, chosen)
 
         return chosen
 
-    async def _dispatch(self, tool_name: str, tool_input: dict[str, Any], session_id: str | None = None) -> str:
-        worker_id = self._pick_worker(tool_name, session_id)
+    async def _acquire_worker(
+        self,
+        tool_name: str,
+        session_id: str | None,
+        priority: int,
+        stats: _ToolStats,
+    ) -> str | None:
+        queue = self._queues.get(tool_name)
+        while queue and queue[0][2].done():
+            heapq.heappop(queue)
+        if not queue:
+            worker_id = self._pick_worker(tool_name, session_id)
+            if worker_id is None:
+                return None
+            if self._policy.has_capacity(worker_id):
+                self._policy.acquire(worker_id)
+                return worker_id
+
+        queue = self._queues.setdefault(tool_name, [])
+        if len(queue) >= self.max_queue:
+            queue[:] = [entry for entry in queue if not entry[2].done()]
+            heapq.heapify(queue)
+            if len(queue) >= self.max_queue:
+                raise _QueueFull
+
+        fut: asyncio.Future[str | None] = asyncio.get_event_loop().create_future()
+        heapq.heappush(queue, (priority, next(self._queue_seq), fut))
+        queued_at = time.monotonic()
+        try:
+            return await asyncio.wait_for(fut, timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # The slot may have been handed over just as we gave up.
+            if fut.done() and not fut.cancelled() and fut.result() is not None:
+                self._release_slot(fut.result())
+            raise
+        finally:
+            waited = time.monotonic() - queued_at
+            stats.queued += 1
+            stats.queue_wait_total += waited
+            stats.queue_wait_max = max(stats.queue_wait_max, waited)
+
+    async def _dispatch(
+        self,
+        tool_name: str,
+        tool_input: dict[str, Any],
+        session_id: str | None = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        on_progress: Callable[[str], Any] | None = None,
+        caller: Any = None,
+    ) -> str:
+        # caller: whatever issues the call (a Conversation); calls without a
+        # session or a caller never use the result cache.
+        if tool_name not in self._tool_to_workers:
+            return f"Error: no worker registered for tool '{tool_name}'"
+
+        stats = self._stats.setdefault(tool_name, _ToolStats())
+        key = session_id if session_id is not None else caller
+        if self._cache is not None and self._trait(tool_name, "cacheable"):
+            # A worker reports what a run_command changed only when that call
+            # returns, so while one from the same caller is still running
+            # (say, in the same turn) a cached read may already be stale.
+            if key is not None and not self._uncached_calls.get(key):
+                cached = self._cache.get(cache_key(tool_name, tool_input))
+                if cached is not None:
+                    stats.cache_hits += 1
+                    return cached
+            stats.cache_misses += 1
+        elif self._cache is not None and key is not None:
+            self._uncached_calls[key] = self._uncached_calls.get(key, 0) + 1
+            try:
+                return await self._dispatch_retrying(tool_name, tool_input, session_id, priority, stats, on_progress)
+            finally:
+                self._uncached_calls[key] -= 1
+                if not self._uncached_calls[key]:
+                    del self._uncached_calls[key]
+        return await self._dispatch_retrying(tool_name, tool_input, session_id, priority, stats, on_progress)
+
+    async def _dispatch_retrying(
+        self,
+        tool_name: str,
+        tool_input: dict[str, Any],
+        session_id: str | None,
+        priority: int,
+        stats: _ToolStats,
+        on_progress: Callable[[str], Any] | None = None,
+    ) -> str:
+        retries = 0
+        while True:
+            result = await self._dispatch_once(tool_name, tool_input, session_id, priority, stats, on_progress)
+            if not isinstance(result, _WorkerLost):
+                return result
+            # Every call of this attempt died with its worker. Retryable tools
+            # go back through admission to another live worker; each attempt
+            # uses a fresh call_id, so a late result from the old worker after
+            # it reconnects is unknown to the hub and dropped.
+            if not self._trait(tool_name, "retryable") or retries >= self.max_retries:
+                return f"Error: worker '{result.worker_id}' disconnected"
+            if tool_name not in self._tool_to_workers:
+                return f"Error: worker '{result.worker_id}' disconnected and no other worker serves '{tool_name}'"
+            retries += 1
+            stats.retried += 1
+            print(f"Re-dispatching {tool_name} after worker {result.worker_id} disconnected (retry {retries})")
+
+    async def _dispatch_once(
+        self,
+        tool_name: str,
+        tool_input: dict[str, Any],
+        session_id: str | None,
+        priority: int,
+        stats: _ToolStats,
+        on_progress: Callable[[str], Any] | None = None,
+    ) -> str | _WorkerLost:
+        try:
+            worker_id = await self._acquire_worker(tool_name, session_id, priority, stats)
+        except _QueueFull:
+            stats.rejected += 1
+            return f"Error: tool '{tool_name}' is overloaded ({self.max_queue} calls queued), try again later"
+        except asyncio.TimeoutError:
+            stats.rejected += 1
+            return f"Error: tool '{tool_name}' waited {self.queue_timeout:.0f}s for a free worker"
         if worker_id is None:
             return f"Error: no worker registered for tool '{tool_name}'"
 
-        send = self._worker_senders.get(worker_id)
-        if send is None:
+        if worker_id not in self._worker_senders:
+            self._release_slot(worker_id)
             return f"Error: worker for tool '{tool_name}' is disconnected"
 
+        # Calls are registered here before they are sent, so a cancel that
+        # arrives during a send still reaches them.
+        calls: dict[str, _InFlight] = {}
+        try:
+            await self._send_call(worker_id, tool_name, tool_input, calls, on_progress)
+            return await self._await_calls(tool_name, tool_input, calls, stats)
+        except asyncio.CancelledError:
+            for cid in calls:
+                self._cancel_call(cid)
+            raise
+
+    async def _await_calls(
+        self,
+        tool_name: str,
+        tool_input: dict[str, Any],
+        calls: dict[str, _InFlight],
+        stats: _ToolStats,
+    ) -> str | _WorkerLost:
+        call_id, call = next(iter(calls.items()))
+        worker_id = call.worker_id
+        deadline = call.sent_at + 120
+
+        if self._trait(tool_name, "idempotent"):
+            await asyncio.wait([call.future], timeout=self._hedge_delay(tool_name))
+            if not call.future.done() and await self._send_hedge(tool_name, tool_input, calls, exclude=worker_id):
+                stats.hedged += 1
+
+        lost: _WorkerLost | None = None
+        winner_id: str | None = None
+        while True:
+            for cid, c in calls.items():
+                if not c.future.done() or c.future.cancelled():
+                    continue
+                if isinstance(c.future.result(), _WorkerLost):
+                    lost = c.future.result()
+                elif winner_id is None:
+                    winner_id = cid
+            if winner_id is not None:
+                break
+            waiting = [c.future for c in calls.values() if not c.future.done()]
+            if not waiting:
+                return lost or _WorkerLost(call.worker_id)
+            done, _ = await asyncio.wait(
+                waiting,
+                timeout=max(0.0, deadline - time.monotonic()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                for cid in calls:
+                    self._cancel_call(cid)
+                return f"Error: tool '{tool_name}' timed out after 120s"
+
+        for cid in calls:
+            if cid != winner_id:
+                self._cancel_call(cid)
+        if winner_id != call_id:
+            stats.hedge_wins += 1
+
+        winner = calls[winner_id]
+        # From the first call: a hedge's win still includes the wait before
+        # it was sent, which is what the caller saw.
+        elapsed = time.monotonic() - call.sent_at
+        stats.calls += 1
+        stats.exec_total += elapsed
+        stats.exec_max = max(stats.exec_max, elapsed)
+        self._latency.setdefault(tool_name, LatencyHistogram()).record(elapsed)
+        return winner.future.result()
+
+    async def _send_call(
+        self,
+        worker_id: str,
+        tool_name: str,
+        tool_input: dict[str, Any],
+        calls: dict[str, _InFlight],
+        on_progress: Callable[[str], Any] | None = None,
+    ) -> None:
         call_id = str(uuid.uuid4())
-        fut: asyncio.Future[str] = asyncio.get_event_loop().create_future()
-        self._pending[call_id] = fut
-        self._call_to_worker[call_id] = worker_id
-        self._busy_workers.add(worker_id)
-
-        await send(json.dumps({
+        call = self._start_call(call_id, worker_id, tool_name, on_progress)
+        calls[call_id] = call
+        msg = {
             "type": "tool_call",
             "call_id": call_id,
             "name": tool_name,
             "input": tool_input,
-        }))
+            "max_bytes": self.max_result_bytes,
+        }
+        if self._cache is not None and self._trait(tool_name, "cacheable"):
+            # Asks the worker for a validity token and to report when it changes.
+            call.cache_key = cache_key(tool_name, tool_input)
+            msg["cache"] = True
+        try:
+            await self._send(worker_id, msg)
+        except Exception:
+            del calls[call_id]
+            self._finish_call(call_id)
+            raise
+
+    def _cancel_call(self, call_id: str) -> None:
+        # Nobody is waiting for this result any more: tell the worker to stop
+        # and hand the slot back now rather than when the output shows up.
+        call = self._finish_call(call_id)
+        if call is None:
+            return
+        if not call.future.done():
+            call.future.cancel()
+        self._spawn(self._notify(call.worker_id, {"type": "cancel", "call_id": call_id}))
+
+    async def _notify(self, worker_id: str, msg: dict[str, Any]) -> None:
+        if worker_id not in self._worker_senders:
+            return
+        try:
+            await self._send(worker_id, msg)
+        except Exception:
+            pass
 
+    def _trait(self, tool_name: str, key: str) -> bool:
+        if key in self._trait_overrides.get(tool_name, {}):
+            return bool(self._trait_overrides[tool_name][key])
+        return bool(self._tool_traits.get(tool_name, {}).get(key, False))
+
+    def _hedge_delay(self, tool_name: str) -> float:
+        hist = self._latency.get(tool_name)
+        if hist is None or len(hist) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return hist.percentile(self.hedge_percentile) or self.hedge_default_delay
+
+    async def _send_hedge(
+        self,
+        tool_name: str,
+        tool_input: dict[str, Any],
+        calls: dict[str, _InFlight],
+        exclude: str,
+    ) -> bool:
+        # Only hedge onto a worker that is idle enough to take it right away;
+        # queueing a duplicate would just add load.
+        worker_id = self._policy.pick(tool_name, exclude=exclude)
+        if worker_id is None or worker_id == exclude or worker_id not in self._worker_senders:
+            return False
+        if not self._policy.has_capacity(worker_id):
+            return False
+        self._policy.acquire(worker_id)
         try:
-            return await asyncio.wait_for(fut, timeout=120)
-        except asyncio.TimeoutError:
-            self._pending.pop(call_id, None)
-            self._call_to_worker.pop(call_id, None)
-            if not any(w == worker_id for w in self._call_to_worker.values()):
-                self._busy_workers.discard(worker_id)
-            return f"Error: tool '{tool_name}' timed out after 120s"
+            await self._send_call(worker_id, tool_name, tool_input, calls)
+        except Exception:
+            return False
+        return True
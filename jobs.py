@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+DEFAULT_WORKERS = 64
+MAX_PENDING = 10_000
+# Finished jobs (with their events) kept for clients to collect: at most
+# this many, holding at most this many characters of events between them.
+MAX_FINISHED_JOBS = 1000
+MAX_FINISHED_CHARS = 64 * 1024 * 1024
+# Characters of each tool result kept in a finished job's events.
+FINISHED_RESULT_PREVIEW = 2000
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    # One background agent run. Progress is an append-only list of events,
+    # numbered by position, so pollers ask for everything after the last
+    # one they saw.
+    def __init__(self, params: dict[str, Any]) -> None:
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.state = QUEUED
+        self.result: str | None = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.events: list[dict[str, Any]] = []
+        # Estimated characters held by the events, set once finished.
+        self.size = 0
+        self._task: asyncio.Task[str | None] | None = None
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    def publish(self, event: dict[str, Any]) -> None:
+        self.events.append({"seq": len(self.events), **event})
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def release_output(self, keep: int) -> None:
+        # Cuts tool results in the events to their first `keep` characters,
+        # marked "truncated" with their full "length", as session history
+        # previews are. The final text stays whole in "done" and `result`.
+        for i, event in enumerate(self.events):
+            if event["type"] != "tool_result":
+                continue
+            content = event["content"]
+            text = content if isinstance(content, str) else json.dumps(content, default=str)
+            if len(text) > keep:
+                self.events[i] = {**event, "content": text[:keep], "truncated": True, "length": len(text)}
+        self.size = sum(len(json.dumps(event, default=str)) for event in self.events)
+
+    async def wait(self, after: int, timeout: float) -> None:
+        # Returns once there are events past `after`, the job has finished,
+        # or the timeout passes.
+        if len(self.events) > after or self.finished:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "events": len(self.events),
+        }
+
+
+class JobManager:
+    # Runs jobs on a fixed number of worker tasks; submissions beyond that
+    # wait in a FIFO queue (bounded by max_pending). run(job) does the work,
+    # reporting progress through job.publish, and returns the final text.
+    def __init__(
+        self,
+        run: Callable[[Job], Awaitable[str | None]],
+        workers: int = DEFAULT_WORKERS,
+        max_pending: int = MAX_PENDING,
+    ) -> None:
+        self._run = run
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self._jobs: dict[str, Job] = {}
+        self._finished: deque[str] = deque()
+        self._finished_size = 0
+        self._queue: asyncio.Queue[Job] = asyncio.Queue()
+        self._workers: list[asyncio.Task[None]] = []
+        self.running = 0
+
+    def submit(self, params: dict[str, Any]) -> Job:
+        if self._queue.qsize() >= self.max_pending:
+            raise JobQueueFull
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        job = Job(params)
+        self._jobs[job.id] = job
+        job.publish({"type": QUEUED})
+        self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job | None:
+        job = self._jobs.get(job_id)
+        if job is None or job.finished:
+            return job
+        if job._task is not None:
+            # The worker marks it cancelled once the run has unwound.
+            job._task.cancel()
+        else:
+            self._finish(job, CANCELLED)
+            job.publish({"type": CANCELLED})
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if job.finished:
+                continue
+            job.state = RUNNING
+            job.started_at = time.time()
+            job.publish({"type": RUNNING})
+            self.running += 1
+            job._task = asyncio.create_task(self._run(job))
+            try:
+                # Waiting on the run rather than awaiting it keeps a job's
+                # cancellation from stopping the worker.
+                await asyncio.wait([job._task])
+            finally:
+                self.running -= 1
+            if job._task.cancelled():
+                self._finish(job, CANCELLED)
+                job.publish({"type": CANCELLED})
+            elif job._task.exception() is not None:
+                exc = job._task.exception()
+                self._finish(job, FAILED, error=f"{type(exc).__name__}: {exc}")
+                job.publish({"type": "error", "content": job.error})
+            else:
+                result = job._task.result()
+                self._finish(job, DONE if result is not None else CANCELLED, result=result)
+            job._task = None
+
+    def _finish(self, job: Job, state: str, result: str | None = None, error: str | None = None) -> None:
+        job.state = state
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        # Wakes pollers waiting on a run that ended without a final event.
+        changed, job._changed = job._changed, asyncio.Event()
+        changed.set()
+        job.release_output(FINISHED_RESULT_PREVIEW)
+        self._finished.append(job.id)
+        self._finished_size += job.size
+        while len(self._finished) > MAX_FINISHED_JOBS or (
+            self._finished_size > MAX_FINISHED_CHARS and len(self._finished) > 1
+        ):
+            old = self._jobs.pop(self._finished.popleft(), None)
+            if old is not None:
+                self._finished_size -= old.size
+
+    async def close(self) -> None:
+        for job in self._jobs.values():
+            if job._task is not None:
+                job._task.cancel()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def as_dict(self) -> dict[str, Any]:
+        states: dict[str, int] = {}
+        for job in self._jobs.values():
+            states[job.state] = states.get(job.state, 0) + 1
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self._queue.qsize(),
+            "jobs": states,
+        }
@@ -24,13 +24,24 @@ async def chat_mode(conv: Conversation) -> None:
             break
         if user_input.strip().lower() in ("quit", "exit"):
             break
-        response = await conv.send(user_input)
+        streamed = False
+
+        def _print_delta(text: str) -> None:
+            nonlocal streamed
+            if not streamed:
+                print("\nassistant> ", end="")
+                streamed = True
+            print(text, end="", flush=True)
+
+        response = await conv.send(user_input, on_text=_print_delta)
         while response.stop_reason == "tool_use":
+            if streamed:
+                print()
+                streamed = False
             await conv._handle_tool_use(response)
-            response = await conv.step()
-        for block in response.content:
-            if block.type == "text":
-                print(f"\nassistant> {block.text}\n")
+            response = await conv.step(on_text=_print_delta)
+        if streamed:
+            print("\n")
 
 
 async def agent_mode(conv: Conversation, prompt: str) -> None:
@@ -49,6 +60,7 @@ async def async_main(args: argparse.Namespace) -> None:
         model=args.model,
         system=args.system,
         max_tokens=args.max_tokens,
+        max_parallel_tools=args.max_parallel_tools,
     )
 
     hub = None
@@ -99,6 +111,12 @@ def main() -> None:
     parser.add_argument("--model", default="claude-sonnet-4-20250514")
     parser.add_argument("--system", default=None, help="System prompt")
     parser.add_argument("--max-tokens", type=int, default=8192)
+    parser.add_argument(
+        "--max-parallel-tools",
+        type=int,
+        default=None,
+        help="Maximum tool calls from one response to run at once (default: $MAX_PARALLEL_TOOLS or 8)",
+    )
     parser.add_argument(
         "--listen",
         default=None,
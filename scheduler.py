@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Hashable, Mapping
+
+import anthropic
+
+# Until the first response arrives with the account's limits, only this
+# many requests run at once; a cold start with hundreds of sessions would
+# otherwise all go out before anyone knows the quota.
+UNSEEDED_CONCURRENCY = 4
+MAX_RETRIES = 6
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# Statuses the SDK would retry itself; scheduled requests run with SDK
+# retries off so that backoff is coordinated here instead.
+RETRY_STATUSES = (408, 409, 429)
+
+_HEADER_PREFIX = "anthropic-ratelimit-"
+
+
+class TokenBucket:
+    # Refills continuously at capacity per minute. Unlimited until a limit
+    # is known, either configured or reported by the API. The level may go
+    # negative when actual usage turns out higher than what was reserved.
+    def __init__(self, per_minute: float | None = None) -> None:
+        self.capacity = per_minute
+        self.level = per_minute or 0.0
+        self._updated = time.monotonic()
+
+    @property
+    def limited(self) -> bool:
+        return self.capacity is not None
+
+    def refill(self, now: float) -> None:
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60.0)
+        self._updated = now
+
+    def wait(self, need: float) -> float:
+        # Seconds until need is available. Requests bigger than the bucket
+        # only wait for a full one, or they would never run.
+        if self.capacity is None or self.capacity <= 0:
+            return 0.0
+        need = min(need, self.capacity)
+        if self.level >= need:
+            return 0.0
+        return (need - self.level) * 60.0 / self.capacity
+
+    def take(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.level -= amount
+
+    def give(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + amount)
+
+    def seed(self, limit: float, remaining: float) -> None:
+        # The API's view wins when it is lower: it also counts requests
+        # from other processes on the same key.
+        if self.capacity is None:
+            self.level = remaining
+        else:
+            self.level = min(self.level, remaining)
+        self.capacity = limit
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "limit_per_minute": self.capacity,
+            "available": round(self.level) if self.capacity is not None else None,
+        }
+
+
+class _Ticket:
+    __slots__ = ("key", "priority", "tokens", "future", "queued_at")
+
+    def __init__(self, key: Hashable, priority: int, tokens: int, future: asyncio.Future[None]):
+        self.key = key
+        self.priority = priority
+        self.tokens = tokens
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+def _header(headers: Mapping[str, str], name: str) -> float | None:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def retry_after(exc: BaseException) -> float | None:
+    # None when the error is not worth retrying, otherwise the server's
+    # requested delay (0.0 when it did not say).
+    if isinstance(exc, anthropic.APIConnectionError):
+        return 0.0
+    if not isinstance(exc, anthropic.APIStatusError):
+        return None
+    # Errors sent inside an already-open stream carry status 200 and are
+    # never retried: part of the reply has been delivered.
+    status = exc.status_code
+    if status not in RETRY_STATUSES and status < 500:
+        return None
+    headers = exc.response.headers
+    ms = _header(headers, "retry-after-ms")
+    if ms is not None:
+        return ms / 1000.0
+    return _header(headers, "retry-after") or 0.0
+
+
+class LLMScheduler:
+    # Admits Messages API requests from every conversation in the process
+    # against shared request/token budgets. Waiting requests are served by
+    # priority (lower first), and round-robin across sessions within a
+    # priority so one busy session cannot starve the rest. Rate-limit and
+    # overload errors pause admission for everyone and the request is
+    # retried with jittered exponential backoff from the front of its
+    # session's queue.
+    def __init__(
+        self,
+        requests_per_minute: float | None = None,
+        input_tokens_per_minute: float | None = None,
+        output_tokens_per_minute: float | None = None,
+        max_retries: int = MAX_RETRIES,
+        base_backoff: float = BASE_BACKOFF,
+        max_backoff: float = MAX_BACKOFF,
+    ) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.input_tokens = TokenBucket(input_tokens_per_minute)
+        self.output_tokens = TokenBucket(output_tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._seeded = any(b.limited for b in (self.requests, self.input_tokens, self.output_tokens))
+        self._queues: dict[int, OrderedDict[Hashable, deque[_Ticket]]] = {}
+        self._paused_until = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+        self.in_flight = 0
+        self.admitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @classmethod
+    def from_env(cls) -> LLMScheduler:
+        def _limit(name: str) -> float | None:
+            value = os.environ.get(name)
+            return float(value) if value else None
+
+        return cls(
+            requests_per_minute=_limit("ANTHROPIC_RPM"),
+            input_tokens_per_minute=_limit("ANTHROPIC_ITPM"),
+            output_tokens_per_minute=_limit("ANTHROPIC_OTPM"),
+        )
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[anthropic.types.Message]],
+        key: Hashable = None,
+        priority: int = 0,
+        tokens: int = 0,
+        retryable: Callable[[], bool] | None = None,
+    ) -> anthropic.types.Message:
+        # tokens: estimated input tokens, reserved on admission and settled
+        # against the usage the response reports. retryable is asked before
+        # each retry; a streamed call that already delivered part of its
+        # reply says no, since a new attempt would send it again.
+        attempt = 0
+        front = False
+        while True:
+            await self._admit(key, priority, tokens, front)
+            try:
+                response = await call()
+            except BaseException as exc:
+                self.in_flight -= 1
+                self.input_tokens.give(tokens)
+                delay = retry_after(exc) if isinstance(exc, Exception) else None
+                if delay is None or attempt >= self.max_retries or (retryable is not None and not retryable()):
+                    if isinstance(exc, Exception):
+                        self.failed += 1
+                    self._pump()
+                    raise
+                headers = getattr(getattr(exc, "response", None), "headers", None)
+                if headers is not None:
+                    self.observe(headers)
+                self._backoff(exc, delay, attempt)
+                attempt += 1
+                front = True
+                continue
+            self.in_flight -= 1
+            self.completed += 1
+            # A response without limit headers (e.g. through a proxy) leaves
+            # nothing to meter against.
+            self._seeded = True
+            self._settle(response, tokens)
+            self._pump()
+            return response
+
+    def observe(self, headers: Mapping[str, str]) -> None:
+        # Seeds the buckets from the anthropic-ratelimit-* response headers.
+        seeded = False
+        for name, bucket in (
+            ("requests", self.requests),
+            ("input-tokens", self.input_tokens),
+            ("output-tokens", self.output_tokens),
+        ):
+            limit = _header(headers, f"{_HEADER_PREFIX}{name}-limit")
+            remaining = _header(headers, f"{_HEADER_PREFIX}{name}-remaining")
+            if limit is None or remaining is None:
+                continue
+            bucket.refill(time.monotonic())
+            bucket.seed(limit, remaining)
+            seeded = True
+        if seeded and not self._seeded:
+            self._seeded = True
+            self._pump()
+
+    def _backoff(self, exc: BaseException, delay: float, attempt: int) -> None:
+        status = getattr(exc, "status_code", None)
+        if status == 429:
+            self.throttled += 1
+        self.retries += 1
+        if delay <= 0:
+            # Full jitter, so sessions throttled together come back spread out.
+            delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        print(f"LLM request failed ({type(exc).__name__}), retrying in {delay:.1f}s (attempt {attempt + 1})")
+
+    def _settle(self, response: anthropic.types.Message, reserved: int) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        # Cache reads do not count towards the input-token limit.
+        actual = (usage.input_tokens or 0) + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+        self.input_tokens.give(reserved - actual)
+        self.output_tokens.take(usage.output_tokens or 0)
+
+    async def _admit(self, key: Hashable, priority: int, tokens: int, front: bool) -> None:
+        fut: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        ticket = _Ticket(key, priority, tokens, fut)
+        sessions = self._queues.setdefault(priority, OrderedDict())
+        queue = sessions.get(key)
+        if queue is None:
+            queue = sessions[key] = deque()
+        if front:
+            queue.appendleft(ticket)
+            sessions.move_to_end(key, last=False)
+        else:
+            queue.append(ticket)
+        self._pump()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Admitted just as the caller gave up: hand the budget back.
+            if fut.done() and not fut.cancelled():
+                self.in_flight -= 1
+                self.requests.give(1)
+                self.input_tokens.give(tokens)
+                self._pump()
+            raise
+        finally:
+            waited = time.monotonic() - ticket.queued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def _head(self) -> tuple[OrderedDict[Hashable, deque[_Ticket]], _Ticket] | None:
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            while sessions:
+                key, queue = next(iter(sessions.items()))
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if queue:
+                    return sessions, queue[0]
+                del sessions[key]
+        return None
+
+    def _pump(self) -> None:
+        # Admits waiting requests while the budgets allow, then sleeps until
+        # the next one could go. Requests are admitted strictly in queue
+        # order: a large request is not overtaken by smaller ones behind it.
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        for bucket in (self.requests, self.input_tokens, self.output_tokens):
+            bucket.refill(now)
+        while True:
+            head = self._head()
+            if head is None:
+                return
+            if not self._seeded and self.in_flight >= UNSEEDED_CONCURRENCY:
+                # A completion pumps again.
+                return
+            sessions, ticket = head
+            wait = max(
+                self._paused_until - now,
+                self.requests.wait(1),
+                self.input_tokens.wait(ticket.tokens),
+                self.output_tokens.wait(1),
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._pump)
+                return
+            queue = sessions[ticket.key]
+            queue.popleft()
+            if queue:
+                sessions.move_to_end(ticket.key)
+            else:
+                del sessions[ticket.key]
+            self.requests.take(1)
+            self.input_tokens.take(ticket.tokens)
+            self.in_flight += 1
+            self.admitted += 1
+            ticket.future.set_result(None)
+
+    def queue_depth(self) -> dict[int, int]:
+        return {
+            priority: sum(sum(1 for t in queue if not t.future.done()) for queue in sessions.values())
+            for priority, sessions in self._queues.items()
+        }
+
+    def as_dict(self) -> dict[str, Any]:
+        depth = self.queue_depth()
+        return {
+            "queued": sum(depth.values()),
+            "queued_by_priority": {str(p): n for p, n in sorted(depth.items())},
+            "waiting_sessions": sum(len(sessions) for sessions in self._queues.values()),
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 1),
+            "wait_avg_ms": round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+            "requests": self.requests.as_dict(),
+            "input_tokens": self.input_tokens.as_dict(),
+            "output_tokens": self.output_tokens.as_dict(),
+        }
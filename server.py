@@ -4,21 +4,43 @@ from __future__ import annotations
 import asyncio
 import json
 import os
+from typing import Any, Awaitable, Callable
 
 from aiohttp import web
 
+from batch import DEFAULT_CONCURRENCY, BatchJob, BatchStore, parse_items, parse_jsonl
+from clients import close_clients
 from conversation import Conversation
-from hub import Hub
-from sessions import SessionStore
+from conversations import DEFAULT_MAX_BYTES, DEFAULT_MAX_ENTRIES, ConversationCache
+from hub import PRIORITY_BATCH, PRIORITY_INTERACTIVE, Hub
+from jobs import DEFAULT_WORKERS, Job, JobManager, JobQueueFull
+from scheduler import LLMScheduler
+from sessiondb import SqliteSessionStore
+from sessions import AsyncSessionStore, SessionStore
 
 from dotenv import load_dotenv
 load_dotenv()
 
 DEFAULT_MODEL = "claude-sonnet-4-20250514"
 DEFAULT_MAX_TOKENS = 8192
+# Request bodies may carry thousands of batch prompts.
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+JSONL_TYPES = ("application/x-ndjson", "application/jsonl", "application/json-lines")
+# Longest a GET /jobs/{id} long-poll is held, and the SSE keep-alive interval.
+MAX_POLL_WAIT = 60.0
+SSE_KEEPALIVE = 15.0
+# History pages: default and largest page size, and how much of a tool
+# result is sent before the client asks for the whole message.
+HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 500
+TOOL_RESULT_PREVIEW = 2000
 
 hub: Hub | None = None
-store: SessionStore | None = None
+store: AsyncSessionStore | None = None
+scheduler: LLMScheduler | None = None
+batches: BatchStore | None = None
+jobs: JobManager | None = None
+conversations: ConversationCache | None = None
 
 
 def get_hub() -> Hub:
@@ -26,11 +48,39 @@ def get_hub() -> Hub:
     return hub
 
 
-def get_store() -> SessionStore:
-    assert store is not None, "SessionStore not initialized"
+def get_store() -> AsyncSessionStore:
+    assert store is not None, "AsyncSessionStore not initialized"
     return store
 
 
+def get_scheduler() -> LLMScheduler:
+    assert scheduler is not None, "LLMScheduler not initialized"
+    return scheduler
+
+
+def get_batches() -> BatchStore:
+    assert batches is not None, "BatchStore not initialized"
+    return batches
+
+
+def get_jobs() -> JobManager:
+    assert jobs is not None, "JobManager not initialized"
+    return jobs
+
+
+def get_conversations() -> ConversationCache:
+    assert conversations is not None, "ConversationCache not initialized"
+    return conversations
+
+
+def _schedule(conv: Conversation, priority: int, session_id: str | None = None) -> None:
+    # Every model request of the server goes through the one scheduler, so
+    # sessions share the account's rate limits fairly.
+    conv.scheduler = get_scheduler()
+    conv.schedule_key = session_id
+    conv.priority = priority
+
+
 async def healthz(request: web.Request) -> web.Response:
     h = get_hub()
     if h.worker_count > 0:
@@ -51,10 +101,100 @@ async def prompt_handler(request: web.Request) -> web.Response:
     max_tokens = body.get("max_tokens", DEFAULT_MAX_TOKENS)
 
     conv = Conversation(model=model, system=system, max_tokens=max_tokens)
-    h.register_tools_on(conv)
+    h.register_tools_on(conv, priority=PRIORITY_BATCH)
+    _schedule(conv, PRIORITY_BATCH)
 
     result = await conv.run_until_done(prompt_text)
-    return web.json_response({"result": result})
+    return web.json_response({"result": result, "usage": conv.usage})
+
+
+async def _run_batch_item(job: BatchJob, item: dict[str, Any]) -> tuple[str, dict[str, int]]:
+    conv = Conversation(
+        model=item.get("model", DEFAULT_MODEL),
+        system=item.get("system"),
+        max_tokens=item.get("max_tokens", DEFAULT_MAX_TOKENS),
+    )
+    get_hub().register_tools_on(conv, priority=PRIORITY_BATCH)
+    # The whole job is one party to the scheduler's fair queuing, so a big
+    # batch shares the rate limit with other sessions instead of taking it.
+    _schedule(conv, PRIORITY_BATCH, f"batch:{job.id}")
+    result = await conv.run_until_done(item["prompt"])
+    return result, conv.usage
+
+
+async def _read_batch(request: web.Request) -> tuple[list[Any], dict[str, Any]]:
+    # Prompts come as JSON {"prompts": [...], ...}, a JSONL body, or a
+    # multipart upload with the JSONL in a "file" field. Options may also
+    # be given in the query string.
+    options: dict[str, Any] = dict(request.query)
+    if request.content_type == "multipart/form-data":
+        entries: list[Any] = []
+        async for part in await request.multipart():
+            if part.name == "file":
+                entries += parse_jsonl((await part.read()).decode())
+            elif part.name:
+                options[part.name] = await part.text()
+        return entries, options
+    if request.content_type in JSONL_TYPES:
+        return parse_jsonl(await request.text()), options
+    try:
+        body = await request.json()
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e.msg}") from None
+    if not isinstance(body, dict) or not isinstance(body.get("prompts"), list):
+        raise ValueError("missing 'prompts' list")
+    options.update({k: v for k, v in body.items() if k != "prompts"})
+    return body["prompts"], options
+
+
+async def _stream_batch(request: web.Request, job: BatchJob, after: int) -> web.StreamResponse:
+    # NDJSON: a status line, one line per finished item in completion order
+    # (those with an "index"), then a final status line once the job is
+    # done. A client that drops out reconnects with
+    # GET /prompts/batch/{job_id}?after=<result lines received>.
+    resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson", "X-Batch-Job": job.id})
+    await resp.prepare(request)
+    try:
+        await resp.write((json.dumps(job.header()) + "\n").encode())
+        async for record in job.results(after):
+            await resp.write((json.dumps(record) + "\n").encode())
+        await resp.write((json.dumps(job.header()) + "\n").encode())
+        await resp.write_eof()
+    except ConnectionResetError:
+        pass
+    return resp
+
+
+async def batch_prompts_handler(request: web.Request) -> web.StreamResponse:
+    try:
+        entries, options = await _read_batch(request)
+        items = parse_items(entries)
+        concurrency = int(options.get("concurrency", DEFAULT_CONCURRENCY))
+        defaults = {"model": options.get("model"), "system": options.get("system")}
+        if options.get("max_tokens") is not None:
+            defaults["max_tokens"] = int(options["max_tokens"])
+    except (ValueError, UnicodeDecodeError) as e:
+        return web.Response(status=400, text=str(e))
+    if not items:
+        return web.Response(status=400, text="no prompts given")
+    for item in items:
+        for key, value in defaults.items():
+            if value is not None:
+                item.setdefault(key, value)
+
+    job = await get_batches().create(items, concurrency)
+    return await _stream_batch(request, job, 0)
+
+
+async def batch_results_handler(request: web.Request) -> web.StreamResponse:
+    job = await get_batches().get(request.match_info["id"])
+    if job is None:
+        return web.Response(status=404, text="batch job not found")
+    try:
+        after = int(request.query.get("after", "0"))
+    except ValueError:
+        return web.Response(status=400, text="'after' must be an integer")
+    return await _stream_batch(request, job, after)
 
 
 def _parse_ws_message(raw: str) -> tuple[str, str | None]:
@@ -70,53 +210,190 @@ def _parse_ws_message(raw: str) -> tuple[str, str | None]:
     return "message", raw
 
 
+def _progress_forwarder(ws: web.WebSocketResponse) -> Callable[[str | None, str, str], Awaitable[None]]:
+    async def _forward(tool_use_id: str | None, name: str, chunk: str) -> None:
+        if ws.closed:
+            return
+        try:
+            await ws.send_str(json.dumps({
+                "type": "tool_progress",
+                "tool_use_id": tool_use_id,
+                "name": name,
+                "content": chunk,
+            }))
+        except ConnectionResetError:
+            pass
+    return _forward
+
+
+def _ws_sender(ws: web.WebSocketResponse) -> Callable[[dict[str, Any]], Awaitable[None]]:
+    async def _send(event: dict[str, Any]) -> None:
+        await ws.send_str(json.dumps(event))
+    return _send
+
+
 async def run_agent_loop(
     conv: Conversation,
-    ws: web.WebSocketResponse,
+    send: Callable[[dict[str, Any]], Awaitable[None]],
     user_text: str,
-    store: SessionStore | None = None,
+    store: AsyncSessionStore | None = None,
     session_id: str | None = None,
-) -> None:
-    snapshot = len(conv.messages)
+) -> str | None:
+    # send() receives each event (delta, tool_use, tool_result, usage, done,
+    # cancelled). Returns the final text, or None if cancelled.
+    # Compaction may drop messages from the front mid-run; counting those
+    # keeps the rollback point aligned.
+    snapshot = len(conv.messages) + conv.context.dropped_messages
+
+    async def _send_delta(text: str) -> None:
+        await send({"type": "delta", "content": text})
+
+    # Tools start while the message is still streaming, so they are
+    # announced as they start rather than once it is complete.
+    async def _send_tool_use(block: Any) -> None:
+        await send({
+            "type": "tool_use",
+            "id": block.id,
+            "name": block.name,
+            "input": block.input,
+        })
+
+    async def _send_usage() -> None:
+        await send({
+            "type": "usage",
+            "turn": conv.last_usage,
+            "session": conv.usage,
+            "context": conv.context.as_dict(),
+        })
+
+    # Sent as each call finishes, not once the whole turn is done.
+    async def _send_result(r: dict) -> None:
+        await send({
+            "type": "tool_result",
+            "tool_use_id": r["tool_use_id"],
+            "content": r.get("content", ""),
+        })
+
     try:
-        response = await conv.send(user_text)
+        response = await conv.send(user_text, on_text=_send_delta, on_tool_use=_send_tool_use)
+        await _send_usage()
 
         while response.stop_reason == "tool_use":
-            for block in response.content:
-                if block.type == "tool_use":
-                    await ws.send_str(json.dumps({
-                        "type": "tool_use",
-                        "name": block.name,
-                        "input": block.input,
-                    }))
-            await conv._handle_tool_use(response)
-
-            results = conv.messages[-1]["content"] if conv.messages else []
-            for r in results:
-                if isinstance(r, dict) and r.get("type") == "tool_result":
-                    await ws.send_str(json.dumps({
-                        "type": "tool_result",
-                        "tool_use_id": r["tool_use_id"],
-                        "content": r.get("content", ""),
-                    }))
-
-            response = await conv.step()
-
-        text_parts = [b.text for b in response.content if b.type == "text"]
-        await ws.send_str(json.dumps({
-            "type": "done",
-            "content": "\n".join(text_parts),
-        }))
+            await conv._handle_tool_use(response, on_result=_send_result)
+
+            response = await conv.step(on_text=_send_delta, on_tool_use=_send_tool_use)
+            await _send_usage()
+
+        text = "\n".join(b.text for b in response.content if b.type == "text")
+        await send({"type": "done", "content": text})
 
         if store and session_id:
             store.save(session_id, conv)
+        return text
 
     except asyncio.CancelledError:
-        conv.messages = conv.messages[:snapshot]
+        conv.cancel_tools()
+        conv.messages = conv.messages[:max(0, snapshot - conv.context.dropped_messages)]
         try:
-            await ws.send_str(json.dumps({"type": "cancelled"}))
+            await send({"type": "cancelled"})
         except Exception:
             pass
+        return None
+
+
+async def _run_job(job: Job) -> str | None:
+    h = get_hub()
+    params = job.params
+    session_id = params.get("session_id")
+
+    async def _publish(event: dict[str, Any]) -> None:
+        # Token deltas are left out: pollers get tool activity and the
+        # final text, not a growing pile of fragments.
+        if event["type"] != "delta":
+            job.publish(event)
+
+    if session_id is None:
+        conv = Conversation(
+            model=params.get("model", DEFAULT_MODEL),
+            system=params.get("system"),
+            max_tokens=params.get("max_tokens", DEFAULT_MAX_TOKENS),
+        )
+        h.register_tools_on(conv, priority=PRIORITY_BATCH)
+        _schedule(conv, PRIORITY_BATCH)
+        return await run_agent_loop(conv, _publish, params["prompt"])
+
+    # Jobs on the same session run one after another.
+    async with get_conversations().use(session_id) as conv:
+        _schedule(conv, PRIORITY_BATCH, session_id)
+        return await run_agent_loop(conv, _publish, params["prompt"], store=get_store(), session_id=session_id)
+
+
+async def create_job(request: web.Request) -> web.Response:
+    body = await request.json()
+    prompt_text = body.get("prompt", "")
+    if not prompt_text:
+        return web.Response(status=400, text="missing 'prompt' field")
+    session_id = body.get("session_id")
+    if session_id is not None and not await get_store().exists(session_id):
+        return web.Response(status=404, text="session not found")
+
+    params = {"prompt": prompt_text, "session_id": session_id}
+    for key in ("model", "system", "max_tokens"):
+        if body.get(key) is not None:
+            params[key] = body[key]
+    try:
+        job = get_jobs().submit(params)
+    except JobQueueFull:
+        return web.Response(status=503, text="too many queued jobs, try again later")
+    return web.json_response(job.as_dict(), status=202, headers={"Location": f"/jobs/{job.id}"})
+
+
+async def _stream_job(request: web.Request, job: Job, after: int) -> web.StreamResponse:
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await resp.prepare(request)
+    try:
+        while True:
+            for event in job.events[after:]:
+                await resp.write(f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+            after = len(job.events)
+            if job.finished:
+                break
+            await job.wait(after, SSE_KEEPALIVE)
+            if len(job.events) == after and not job.finished:
+                await resp.write(b": keep-alive\n\n")
+        await resp.write(f"event: end\ndata: {json.dumps(job.as_dict())}\n\n".encode())
+        await resp.write_eof()
+    except ConnectionResetError:
+        pass
+    return resp
+
+
+async def get_job(request: web.Request) -> web.StreamResponse:
+    # Server-sent events when asked for (Accept: text/event-stream),
+    # otherwise a long-poll: events after `after`, waiting up to `wait`
+    # seconds for the first new one.
+    job = get_jobs().get(request.match_info["id"])
+    if job is None:
+        return web.Response(status=404, text="job not found")
+    try:
+        after = int(request.headers.get("Last-Event-ID", -1)) + 1
+        after = int(request.query.get("after", after))
+        wait = min(float(request.query.get("wait", "0")), MAX_POLL_WAIT)
+    except ValueError:
+        return web.Response(status=400, text="'after' and 'wait' must be numbers")
+    after = max(0, after)
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        return await _stream_job(request, job, after)
+    if wait > 0:
+        await job.wait(after, wait)
+    return web.json_response({**job.as_dict(), "next": len(job.events), "events": job.events[after:]})
+
+
+async def cancel_job(request: web.Request) -> web.Response:
+    job = get_jobs().cancel(request.match_info["id"])
+    if job is None:
+        return web.Response(status=404, text="job not found")
+    return web.json_response(job.as_dict(), status=202)
 
 
 async def ws_chat_handler(request: web.Request) -> web.WebSocketResponse:
@@ -129,7 +406,8 @@ async def ws_chat_handler(request: web.Request) -> web.WebSocketResponse:
     max_tokens = int(request.query.get("max_tokens", str(DEFAULT_MAX_TOKENS)))
 
     conv = Conversation(model=model, system=system, max_tokens=max_tokens)
-    h.register_tools_on(conv)
+    h.register_tools_on(conv, priority=PRIORITY_INTERACTIVE, on_progress=_progress_forwarder(ws))
+    _schedule(conv, PRIORITY_INTERACTIVE)
 
     current_task: asyncio.Task | None = None
 
@@ -151,7 +429,7 @@ async def ws_chat_handler(request: web.Request) -> web.WebSocketResponse:
             elif kind == "message" and content:
                 await _cancel_current()
                 current_task = asyncio.create_task(
-                    run_agent_loop(conv, ws, content)
+                    run_agent_loop(conv, _ws_sender(ws), content)
                 )
         elif msg.type in (web.WSMsgType.ERROR, web.WSMsgType.CLOSE):
             break
@@ -170,12 +448,24 @@ async def workers_handler(request: web.Request) -> web.Response:
     return web.json_response(h.get_workers_info())
 
 
+async def stats_handler(request: web.Request) -> web.Response:
+    h = get_hub()
+    return web.json_response({
+        "tools": h.get_stats(),
+        "cache": h.get_cache_stats(),
+        "llm": get_scheduler().as_dict(),
+        "jobs": get_jobs().as_dict(),
+        "sessions": get_store().as_dict(),
+        "conversations": get_conversations().as_dict(),
+    })
+
+
 # --- Session routes ---
 
 async def create_session(request: web.Request) -> web.Response:
     s = get_store()
     body = await request.json() if request.content_length else {}
-    session_id = s.create(
+    session_id = await s.create(
         model=body.get("model", DEFAULT_MODEL),
         system=body.get("system"),
         max_tokens=body.get("max_tokens", DEFAULT_MAX_TOKENS),
@@ -185,53 +475,124 @@ async def create_session(request: web.Request) -> web.Response:
 
 async def list_sessions(request: web.Request) -> web.Response:
     s = get_store()
-    return web.json_response(s.list_all())
+    return web.json_response(await s.list_all())
 
 
 async def get_session(request: web.Request) -> web.Response:
     s = get_store()
     session_id = request.match_info["id"]
-    if not s.exists(session_id):
+    if not await s.exists(session_id):
+        return web.Response(status=404, text="session not found")
+    return web.json_response(await s.get(session_id))
+
+
+def _preview(message: dict[str, Any], limit: int) -> dict[str, Any]:
+    # Cuts long tool results to their first `limit` characters, marked with
+    # "truncated" and the full "length".
+    content = message["content"]
+    if limit <= 0 or not isinstance(content, list):
+        return message
+    blocks = []
+    for block in content:
+        text = block.get("content") if isinstance(block, dict) and block.get("type") == "tool_result" else None
+        if isinstance(text, str) and len(text) > limit:
+            block = {**block, "content": text[:limit], "truncated": True, "length": len(text)}
+        blocks.append(block)
+    return {**message, "content": blocks}
+
+
+async def session_messages(request: web.Request) -> web.Response:
+    # GET /sessions/{id}/messages?before=<seq>&limit=N pages back through
+    # the history (newest first page by default); ?after=<seq> fetches what
+    # was added since. Tool results are previews unless preview=0.
+    s = get_store()
+    session_id = request.match_info["id"]
+    if not await s.exists(session_id):
+        return web.Response(status=404, text="session not found")
+    try:
+        before = request.query.get("before")
+        after = request.query.get("after")
+        cursor = {
+            "before": None if before is None else int(before),
+            "after": None if after is None else int(after),
+        }
+        limit = min(max(1, int(request.query.get("limit", HISTORY_PAGE))), MAX_HISTORY_PAGE)
+        preview = int(request.query.get("preview", TOOL_RESULT_PREVIEW))
+    except ValueError:
+        return web.Response(status=400, text="'before', 'after', 'limit' and 'preview' must be integers")
+    page = await s.page(session_id, limit=limit, **cursor)
+    page["messages"] = [_preview(message, preview) for message in page["messages"]]
+    return web.json_response(page)
+
+
+async def session_message(request: web.Request) -> web.Response:
+    s = get_store()
+    session_id = request.match_info["id"]
+    if not await s.exists(session_id):
+        return web.Response(status=404, text="session not found")
+    try:
+        seq = int(request.match_info["seq"])
+    except ValueError:
+        return web.Response(status=400, text="seq must be an integer")
+    message = await s.message(session_id, seq)
+    if message is None:
+        return web.Response(status=404, text="message not found")
+    return web.json_response(message)
+
+
+async def fork_session(request: web.Request) -> web.Response:
+    s = get_store()
+    session_id = request.match_info["id"]
+    if not await s.exists(session_id):
         return web.Response(status=404, text="session not found")
-    return web.json_response(s.get(session_id))
+    body = await request.json() if request.content_length else {}
+    at = body.get("at", request.query.get("at"))
+    try:
+        fork_id = await s.fork(session_id, at=None if at is None else int(at))
+    except ValueError as e:
+        return web.Response(status=400, text=str(e))
+    return web.json_response({"session_id": fork_id, "parent_id": session_id}, status=201)
 
 
 async def clear_session_history(request: web.Request) -> web.Response:
     s = get_store()
     session_id = request.match_info["id"]
-    if not s.exists(session_id):
+    if not await s.exists(session_id):
         return web.Response(status=404, text="session not found")
-    s.clear_history(session_id)
+    get_conversations().discard(session_id)
+    await s.clear_history(session_id)
     return web.Response(status=204)
 
 
 async def clear_all_history(request: web.Request) -> web.Response:
     s = get_store()
-    s.clear_all_history()
+    get_conversations().clear()
+    await s.clear_all_history()
     return web.Response(status=204)
 
 
 async def delete_all_sessions(request: web.Request) -> web.Response:
     s = get_store()
-    s.delete_all()
+    get_conversations().clear()
+    await s.delete_all()
     return web.Response(status=204)
 
 
 async def delete_session(request: web.Request) -> web.Response:
     s = get_store()
     session_id = request.match_info["id"]
-    if not s.exists(session_id):
+    if not await s.exists(session_id):
         return web.Response(status=404, text="session not found")
-    s.delete(session_id)
+    get_conversations().discard(session_id)
+    await s.delete(session_id)
     return web.Response(status=204)
 
 
 async def session_prompt_handler(request: web.Request) -> web.Response:
-    h = get_hub()
     s = get_store()
     session_id = request.match_info["id"]
 
-    if not s.exists(session_id):
+    if not await s.exists(session_id):
         return web.Response(status=404, text="session not found")
 
     body = await request.json()
@@ -239,30 +600,33 @@ async def session_prompt_handler(request: web.Request) -> web.Response:
     if not prompt_text:
         return web.Response(status=400, text="missing 'prompt' field")
 
-    conv = s.load(session_id)
-    h.register_tools_on(conv, session_id=session_id)
+    async with get_conversations().use(session_id) as conv:
+        _schedule(conv, PRIORITY_BATCH, session_id)
+        result = await conv.run_until_done(prompt_text)
+        s.save(session_id, conv)
+        usage = dict(conv.usage)
 
-    result = await conv.run_until_done(prompt_text)
-    s.save(session_id, conv)
-
-    return web.json_response({"result": result})
+    return web.json_response({"result": result, "usage": usage})
 
 
 async def session_chat_handler(request: web.Request) -> web.WebSocketResponse:
-    h = get_hub()
     s = get_store()
     session_id = request.match_info["id"]
 
     ws = web.WebSocketResponse()
     await ws.prepare(request)
 
-    if not s.exists(session_id):
+    if not await s.exists(session_id):
         await ws.send_str(json.dumps({"type": "error", "content": "session not found"}))
         await ws.close()
         return ws
 
-    conv = s.load(session_id)
-    h.register_tools_on(conv, session_id=session_id)
+    async def _run(content: str) -> str | None:
+        # The session's live conversation is shared with other sockets and
+        # jobs on it; each turn takes it for as long as it runs.
+        async with get_conversations().use(session_id, on_progress=_progress_forwarder(ws)) as conv:
+            _schedule(conv, PRIORITY_INTERACTIVE, session_id)
+            return await run_agent_loop(conv, _ws_sender(ws), content, store=s, session_id=session_id)
 
     current_task: asyncio.Task | None = None
 
@@ -283,9 +647,7 @@ async def session_chat_handler(request: web.Request) -> web.WebSocketResponse:
                 await _cancel_current()
             elif kind == "message" and content:
                 await _cancel_current()
-                current_task = asyncio.create_task(
-                    run_agent_loop(conv, ws, content, store=s, session_id=session_id)
-                )
+                current_task = asyncio.create_task(_run(content))
         elif msg.type in (web.WSMsgType.ERROR, web.WSMsgType.CLOSE):
             break
 
@@ -294,22 +656,51 @@ async def session_chat_handler(request: web.Request) -> web.WebSocketResponse:
     return ws
 
 
+async def _close_clients(app: web.Application) -> None:
+    await close_clients()
+
+
+async def _close_jobs(app: web.Application) -> None:
+    await get_jobs().close()
+
+
+async def _close_store(app: web.Application) -> None:
+    await get_store().close()
+
+
 def create_app() -> web.Application:
-    global hub, store
+    global hub, store, scheduler, batches, jobs, conversations
 
     conv = Conversation()
-    hub = Hub(conv)
-    store = SessionStore()
+    hub = Hub(conv, cache_max_bytes=int(os.environ.get("HUB_CACHE_BYTES", "0")))
+    # SESSION_DB selects the SQLite backend (see sessiondb.py to migrate).
+    db_path = os.environ.get("SESSION_DB")
+    store = AsyncSessionStore(SqliteSessionStore(db_path) if db_path else SessionStore())
+    scheduler = LLMScheduler.from_env()
+    batches = BatchStore(_run_batch_item)
+    conversations = ConversationCache(
+        store,
+        hub,
+        max_entries=int(os.environ.get("SESSION_CACHE_ENTRIES", str(DEFAULT_MAX_ENTRIES))),
+        max_bytes=int(os.environ.get("SESSION_CACHE_BYTES", str(DEFAULT_MAX_BYTES))),
+    )
+    jobs = JobManager(_run_job, workers=int(os.environ.get("JOB_WORKERS", str(DEFAULT_WORKERS))))
 
     static_dir = os.path.join(os.path.dirname(__file__), "static")
 
-    app = web.Application()
+    app = web.Application(client_max_size=MAX_REQUEST_BYTES)
     app.router.add_get("/", index_redirect)
     app.router.add_get("/healthz", healthz)
     app.router.add_post("/prompt", prompt_handler)
+    app.router.add_post("/prompts/batch", batch_prompts_handler)
+    app.router.add_get("/prompts/batch/{id}", batch_results_handler)
+    app.router.add_post("/jobs", create_job)
+    app.router.add_get("/jobs/{id}", get_job)
+    app.router.add_delete("/jobs/{id}", cancel_job)
     app.router.add_get("/ws/chat", ws_chat_handler)
     app.router.add_get("/ws/worker", hub.aiohttp_worker_handler)
     app.router.add_get("/api/workers", workers_handler)
+    app.router.add_get("/api/stats", stats_handler)
 
     app.router.add_post("/sessions", create_session)
     app.router.add_get("/sessions", list_sessions)
@@ -317,11 +708,17 @@ def create_app() -> web.Application:
     app.router.add_get("/sessions/{id}", get_session)
     app.router.add_delete("/sessions/{id}", delete_session)
     app.router.add_post("/sessions/{id}/prompt", session_prompt_handler)
+    app.router.add_get("/sessions/{id}/messages", session_messages)
+    app.router.add_get("/sessions/{id}/messages/{seq}", session_message)
+    app.router.add_post("/sessions/{id}/fork", fork_session)
     app.router.add_post("/sessions/{id}/clear", clear_session_history)
     app.router.add_get("/sessions/{id}/chat", session_chat_handler)
     app.router.add_post("/sessions/clear-all-history", clear_all_history)
 
     app.router.add_static("/static", static_dir)
+    app.on_cleanup.append(_close_jobs)
+    app.on_cleanup.append(_close_store)
+    app.on_cleanup.append(_close_clients)
 
     return app
 
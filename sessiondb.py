@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""SQLite session storage.
+
+SqliteSessionStore keeps the SessionStore model (a header per session, its
+own messages numbered by seq, fork pointers) in one SQLite database in WAL
+mode: session metadata in an indexed `sessions` table and messages in a
+`messages` table keyed by (session_id, seq). Listing, clearing and deleting
+sessions are single queries that never touch message bodies.
+
+Migrate a directory of JSON sessions: python sessiondb.py sessions sessions.db
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from sessions import SessionStore, _Journal, _serialize_messages, _synchronized
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    model TEXT NOT NULL,
+    system TEXT,
+    max_tokens INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    usage TEXT,
+    parent_id TEXT,
+    parent_at INTEGER,
+    start INTEGER NOT NULL,
+    next INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_parent ON sessions (parent_id);
+CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created_at);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+"""
+
+_COLUMNS = "session_id, name, model, system, max_tokens, created_at, usage, parent_id, parent_at, start, next"
+
+
+class SqliteSessionStore(SessionStore):
+    # One connection, used under the store lock from whichever executor
+    # thread runs the call. Each store method commits once at the end (in
+    # _write_header), so a save is one transaction. Assumes this process is
+    # the database's only writer.
+    def __init__(self, path: str = "sessions.db"):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._journals: OrderedDict[str, _Journal] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _rollback(self) -> None:
+        self._db.rollback()
+        super()._rollback()
+
+    def _open(self, session_id: str) -> _Journal:
+        row = self._db.execute(f"SELECT {_COLUMNS} FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            raise KeyError(session_id)
+        header = self._header(row)
+        forks = [fork_id for (fork_id,) in self._db.execute(
+            "SELECT session_id FROM sessions WHERE parent_id = ? ORDER BY session_id", (session_id,)
+        )]
+        if forks:
+            header["forks"] = forks
+        messages = [
+            {"role": role, "content": json.loads(content)}
+            for role, content in self._db.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (session_id, header["start"], header["next"]),
+            )
+        ]
+        return _Journal(header, messages, header["start"])
+
+    def _fresh(self, journal: _Journal) -> bool:
+        return True
+
+    @staticmethod
+    def _header(row: tuple) -> dict[str, Any]:
+        (session_id, name, model, system, max_tokens, created_at, usage, parent_id, parent_at, start, next_seq) = row
+        header: dict[str, Any] = {
+            "session_id": session_id,
+            "name": name,
+            "model": model,
+            "system": system,
+            "max_tokens": max_tokens,
+            "created_at": created_at,
+            "start": start,
+            "next": next_seq,
+        }
+        if usage is not None:
+            header["usage"] = json.loads(usage)
+        if parent_id is not None:
+            header["parent"] = {"session_id": parent_id, "at": parent_at}
+        return header
+
+    def _write_header(self, header: dict[str, Any]) -> None:
+        # Forks are not stored on the parent; they are the rows pointing at it.
+        parent = header.get("parent") or {}
+        usage = header.get("usage")
+        self._db.execute(
+            f"INSERT OR REPLACE INTO sessions ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                header["session_id"], header["name"], header["model"], header.get("system"),
+                header.get("max_tokens", 8192), header["created_at"],
+                json.dumps(usage) if usage is not None else None,
+                parent.get("session_id"), parent.get("at"), header["start"], header["next"],
+            ),
+        )
+        self._db.execute(
+            "DELETE FROM messages WHERE session_id = ? AND seq < ?", (header["session_id"], header["start"])
+        )
+        self._db.commit()
+
+    def _commit(self, journal: _Journal) -> None:
+        self._write_header(journal.header)
+        journal.first = journal.header["start"]
+
+    def _append_messages(self, session_id: str, messages: list[dict], seq: int) -> None:
+        self._db.executemany(
+            "INSERT OR REPLACE INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+            [(session_id, seq + i, msg["role"], json.dumps(msg["content"])) for i, msg in enumerate(messages)],
+        )
+
+    def _write_messages(self, session_id: str, messages: list[dict], start: int) -> None:
+        self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        self._append_messages(session_id, messages, start)
+
+    def _remove(self, session_id: str) -> None:
+        self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        self._db.commit()
+
+    @_synchronized
+    def import_session(self, header: dict[str, Any], messages: list[dict]) -> None:
+        # Copies a session as stored by another backend, seqs and fork
+        # pointer included.
+        header = {k: v for k, v in header.items() if k != "forks"}
+        self._journals.pop(header["session_id"], None)
+        self._write_messages(header["session_id"], _serialize_messages(messages), header["start"])
+        self._write_header(header)
+
+    @_synchronized
+    def list_all(self) -> list[dict[str, Any]]:
+        rows = self._db.execute(
+            "SELECT session_id, name, model, system, created_at, next - start + COALESCE(parent_at, 0),"
+            " parent_id, parent_at FROM sessions ORDER BY session_id"
+        ).fetchall()
+        return [
+            {
+                "session_id": session_id,
+                "name": name,
+                "model": model,
+                "system": system,
+                "created_at": created_at,
+                "message_count": message_count,
+                "parent": {"session_id": parent_id, "at": parent_at} if parent_id is not None else None,
+            }
+            for session_id, name, model, system, created_at, message_count, parent_id, parent_at in rows
+        ]
+
+    @_synchronized
+    def clear_all_history(self) -> None:
+        self._journals.clear()
+        self._db.execute(
+            "UPDATE sessions SET start = next, name = 'Agent-' || substr(session_id, 1, 4),"
+            " parent_id = NULL, parent_at = NULL"
+        )
+        self._db.execute("DELETE FROM messages")
+        self._db.commit()
+
+    @_synchronized
+    def delete_all(self) -> None:
+        self._journals.clear()
+        self._db.execute("DELETE FROM messages")
+        self._db.execute("DELETE FROM sessions")
+        self._db.commit()
+
+    @_synchronized
+    def exists(self, session_id: str) -> bool:
+        row = self._db.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row is not None
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def migrate(directory: str, path: str) -> int:
+    # Copies every session in a SessionStore directory into the database;
+    # returns how many were copied. The directory is left as it was.
+    # Legacy single-file sessions are read as they are, not converted.
+    source = SessionStore(directory)
+    target = SqliteSessionStore(path)
+    count = 0
+    try:
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".json"):
+                continue
+            target.import_session(*source._snapshot(filename[:-len(".json")]))
+            count += 1
+    finally:
+        target.close()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate JSON session files into a SQLite session database")
+    parser.add_argument("directory", nargs="?", default="sessions", help="SessionStore directory (default: sessions)")
+    parser.add_argument("database", nargs="?", default="sessions.db", help="SQLite database (default: sessions.db)")
+    args = parser.parse_args()
+    print(f"Migrated {migrate(args.directory, args.database)} sessions into {args.database}")
@@ -1,135 +1,671 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import json
 import os
+import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Any
+from typing import Any, Callable, TypeVar
 
+from context import starts_turn, trim_messages
 from conversation import Conversation
 
 
 MAX_MESSAGES = 1000
+# Sessions whose persisted history is kept in memory, so a save can tell
+# which messages are new without reading the log back.
+MAX_OPEN_JOURNALS = 256
+# A log is rewritten once messages dropped from the front of the history
+# outnumber the live ones (and there are at least this many).
+COMPACT_MIN_DEAD = 200
+# Longest a saved turn waits before AsyncSessionStore writes it; saves of
+# the same session within that window are written once.
+WRITE_BEHIND_DELAY = 0.5
 
+_F = TypeVar("_F", bound=Callable[..., Any])
+_T = TypeVar("_T")
 
-def _serialize_messages(messages: list[dict]) -> list[dict]:
-    serialized = []
-    for msg in messages:
-        role = msg["role"]
-        content = msg["content"]
-        if role == "assistant" and isinstance(content, list):
-            content = [
+
+def _synchronized(method: _F) -> _F:
+    # Store methods run on executor threads; one at a time per store. A
+    # method that fails part way leaves nothing cached that may not match
+    # what was stored.
+    @functools.wraps(method)
+    def _wrapper(self: SessionStore, *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            try:
+                return method(self, *args, **kwargs)
+            except BaseException:
+                self._rollback()
+                raise
+    return _wrapper  # type: ignore[return-value]
+
+
+def _serialize_message(msg: dict) -> dict:
+    # Messages that are already plain JSON are kept as they are (not
+    # copied), so history shared with a fork parent stays shared.
+    content = msg["content"]
+    if msg["role"] == "assistant" and isinstance(content, list) and any(
+        hasattr(block, "model_dump") for block in content
+    ):
+        return {
+            "role": "assistant",
+            "content": [
                 block.model_dump() if hasattr(block, "model_dump") else block
                 for block in content
-            ]
-        serialized.append({"role": role, "content": content})
-    return serialized
+            ],
+        }
+    return msg
+
+
+def _serialize_messages(messages: list[dict]) -> list[dict]:
+    return [_serialize_message(msg) for msg in messages]
+
+
+def _same_prefix(a: list[dict], b: list[dict], n: int) -> bool:
+    if len(a) < n or len(b) < n:
+        return False
+    return all(x is y or _serialize_message(x) == _serialize_message(y) for x, y in zip(a[:n], b[:n]))
+
+
+def _dropped(old: list[dict], new: list[dict]) -> int | None:
+    # How many messages were dropped from the front of `old` for the rest of
+    # it to be where `new` starts, or None if `new` does not continue `old`.
+    # Matched by identity first, then by value: after the journal has been
+    # reloaded, the saved messages are copies of the conversation's.
+    if not old or not new:
+        return len(old)
+    head = _serialize_message(new[0])
+    for same in (lambda msg: msg is new[0], lambda msg: _serialize_message(msg) == head):
+        for i, msg in enumerate(old):
+            if same(msg) and _same_prefix(new, old[i:], len(old) - i):
+                return i
+    return None
+
+
+def _split_legacy(data: dict[str, Any]) -> tuple[dict[str, Any], list[dict]]:
+    # Sessions used to be saved as one JSON document with all their messages;
+    # returns the header and messages it stands for.
+    header = {k: v for k, v in data.items() if k != "messages"}
+    parent = header.get("parent")
+    header["start"] = parent["at"] if parent else 0
+    header["next"] = header["start"] + len(data["messages"])
+    return header, data["messages"]
+
+
+class _Journal:
+    # What is stored for one session: its header and its own messages (the
+    # objects last saved, compared by identity on the next save). `first`
+    # is the lowest seq still physically in the log, `version` whatever the
+    # backend uses to notice changes made behind its back.
+    def __init__(self, header: dict[str, Any], messages: list[dict], first: int, version: int = 0) -> None:
+        self.header = header
+        self.messages = messages
+        self.first = first
+        self.version = version
 
 
 class SessionStore:
+    # Each session is a small header, {id}.json, replaced atomically on
+    # every change, and an append-only log, {id}.jsonl, with one message per
+    # line numbered by "seq". The history is the log records with
+    # header["start"] <= seq < header["next"]: a save appends the new
+    # messages and then commits the header, so records past "next" (from a
+    # save that crashed halfway) are ignored, and dropping messages from the
+    # front only moves "start". The log is rewritten (to a temp file, then
+    # renamed) when messages change in place or dead records pile up.
+    #
+    # A fork stores a pointer to its parent ({"session_id", "at"}) and only
+    # the messages added after the fork point; its history is the parent's
+    # first `at` messages followed by its own, and its seqs continue from
+    # `at`. The parent lists its forks under "forks" and turns them into
+    # standalone sessions before it drops or rewrites any message they share
+    # (trim, compaction, clear, delete).
+    #
+    # Other backends (sessiondb.SqliteSessionStore) keep the header/messages
+    # model and override the storage methods: _open, _fresh, _write_header,
+    # _append_messages, _write_messages, _remove and the bulk operations.
     def __init__(self, directory: str = "sessions"):
         self._dir = directory
         os.makedirs(self._dir, exist_ok=True)
+        self._journals: OrderedDict[str, _Journal] = OrderedDict()
+        self._lock = threading.RLock()
 
     def _path(self, session_id: str) -> str:
         return os.path.join(self._dir, f"{session_id}.json")
 
+    def _log_path(self, session_id: str) -> str:
+        return os.path.join(self._dir, f"{session_id}.jsonl")
+
+    def _read_header(self, session_id: str) -> dict[str, Any]:
+        with open(self._path(session_id), "r") as f:
+            data = json.load(f)
+        if "messages" in data:
+            data = self._migrate(data)
+        return data
+
+    def _migrate(self, data: dict[str, Any]) -> dict[str, Any]:
+        header, messages = _split_legacy(data)
+        self._write_messages(header["session_id"], messages, header["start"])
+        self._write_header(header)
+        return header
+
+    def _snapshot(self, session_id: str) -> tuple[dict[str, Any], list[dict]]:
+        # The session's header and own messages as stored, read without
+        # converting a legacy file or touching the open journals.
+        with open(self._path(session_id), "r") as f:
+            data = json.load(f)
+        if "messages" in data:
+            return _split_legacy(data)
+        return data, self._read_log(session_id, data["start"], data["next"])[0]
+
+    def _write_header(self, header: dict[str, Any]) -> None:
+        path = self._path(header["session_id"])
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(header, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _append_messages(self, session_id: str, messages: list[dict], seq: int) -> None:
+        if not messages:
+            return
+        with open(self._log_path(session_id), "a+b") as f:
+            # A crash may have left a partial last line; start a new one.
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            # Line by line: no single call holds the GIL for the whole batch.
+            for i, msg in enumerate(messages):
+                f.write((json.dumps({"seq": seq + i, **msg}) + "\n").encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_messages(self, session_id: str, messages: list[dict], start: int) -> None:
+        path = self._log_path(session_id)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            for i, msg in enumerate(messages):
+                f.write(json.dumps({"seq": start + i, **msg}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _read_log(self, session_id: str, start: int, end: int) -> tuple[list[dict], int]:
+        # The messages with start <= seq < end (a seq written twice keeps its
+        # last record), and the lowest seq in the file.
+        records: dict[int, dict] = {}
+        first = start
+        if os.path.exists(self._log_path(session_id)):
+            with open(self._log_path(session_id), "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    seq = record.pop("seq")
+                    first = min(first, seq)
+                    if start <= seq < end:
+                        records[seq] = record
+        return [records[seq] for seq in range(start, end) if seq in records], first
+
+    def _open(self, session_id: str) -> _Journal:
+        header = self._read_header(session_id)
+        messages, first = self._read_log(session_id, header["start"], header["next"])
+        return _Journal(header, messages, first, os.stat(self._path(session_id)).st_mtime_ns)
+
+    def _fresh(self, journal: _Journal) -> bool:
+        return journal.version == os.stat(self._path(journal.header["session_id"])).st_mtime_ns
+
+    def _remove(self, session_id: str) -> None:
+        os.remove(self._path(session_id))
+        if os.path.exists(self._log_path(session_id)):
+            os.remove(self._log_path(session_id))
+
+    def _rollback(self) -> None:
+        self._journals.clear()
+
+    def _journal(self, session_id: str) -> _Journal:
+        journal = self._journals.get(session_id)
+        if journal is not None and self._fresh(journal):
+            self._journals.move_to_end(session_id)
+            return journal
+        journal = self._open(session_id)
+        self._journals[session_id] = journal
+        while len(self._journals) > MAX_OPEN_JOURNALS:
+            self._journals.popitem(last=False)
+        return journal
+
+    def _commit(self, journal: _Journal) -> None:
+        header = journal.header
+        dead = header["start"] - journal.first
+        if dead >= COMPACT_MIN_DEAD and dead > header["next"] - header["start"]:
+            self._replace(journal, journal.messages, header["start"])
+        self._write_header(header)
+        journal.version = os.stat(self._path(header["session_id"])).st_mtime_ns
+
+    def _replace(self, journal: _Journal, messages: list[dict], start: int) -> None:
+        # Rewrites the stored messages as exactly `messages`, numbered from
+        # `start`.
+        self._write_messages(journal.header["session_id"], _serialize_messages(messages), start)
+        journal.messages = list(messages)
+        journal.first = start
+        journal.header["start"] = start
+        journal.header["next"] = start + len(messages)
+
+    def _history(self, session_id: str) -> list[dict]:
+        # The full message list of a session, following fork pointers.
+        journal = self._journal(session_id)
+        parent = journal.header.get("parent")
+        if parent is None:
+            return journal.messages
+        return self._history(parent["session_id"])[:parent["at"]] + journal.messages
+
+    def _detach(self, journal: _Journal, keep: list[dict] | None = None) -> None:
+        # Makes the session's forks standalone, except those whose shared
+        # prefix is unchanged in `keep` (the session's new history).
+        header = journal.header
+        old = self._history(header["session_id"])
+        remaining = []
+        for fork_id in header.get("forks", []):
+            if not self.exists(fork_id):
+                continue
+            fork = self._journal(fork_id)
+            parent = fork.header.get("parent")
+            if parent is None or parent["session_id"] != header["session_id"]:
+                continue
+            if keep is not None and _same_prefix(old, keep, parent["at"]):
+                remaining.append(fork_id)
+                continue
+            self._replace(fork, old[:parent["at"]] + fork.messages, fork.header["start"] - parent["at"])
+            del fork.header["parent"]
+            self._commit(fork)
+        if remaining:
+            header["forks"] = remaining
+        else:
+            header.pop("forks", None)
+
+    def _unlink_parent(self, journal: _Journal) -> None:
+        parent = journal.header.pop("parent", None)
+        if parent is None or not self.exists(parent["session_id"]):
+            return
+        parent_journal = self._journal(parent["session_id"])
+        forks = parent_journal.header.get("forks", [])
+        if journal.header["session_id"] in forks:
+            forks.remove(journal.header["session_id"])
+            if not forks:
+                parent_journal.header.pop("forks")
+            self._commit(parent_journal)
+
+    @_synchronized
     def create(
         self,
         model: str = "claude-sonnet-4-20250514",
         system: str | None = None,
         max_tokens: int = 8192,
+        parent: dict[str, Any] | None = None,
     ) -> str:
         session_id = str(uuid.uuid4())
         name = f"Agent-{session_id[:4]}"
-        data = {
+        start = parent["at"] if parent else 0
+        header = {
             "session_id": session_id,
             "name": name,
             "model": model,
             "system": system,
             "max_tokens": max_tokens,
             "created_at": datetime.now(timezone.utc).isoformat(),
-            "messages": [],
+            "start": start,
+            "next": start,
         }
-        with open(self._path(session_id), "w") as f:
-            json.dump(data, f, indent=2)
+        if parent is not None:
+            header["parent"] = parent
+        self._write_messages(session_id, [], start)
+        self._write_header(header)
         return session_id
 
+    @_synchronized
+    def fork(self, session_id: str, at: int | None = None) -> str:
+        # New session continuing from the first `at` messages (all of them
+        # by default). `at` must fall on a turn boundary.
+        journal = self._journal(session_id)
+        history = self._history(session_id)
+        if at is None:
+            at = len(history)
+        if not 0 <= at <= len(history):
+            raise ValueError(f"fork point must be between 0 and {len(history)}")
+        if at < len(history) and not starts_turn(history[at]):
+            raise ValueError(f"message {at} does not start a turn")
+        header = journal.header
+        fork_id = self.create(
+            model=header["model"],
+            system=header.get("system"),
+            max_tokens=header.get("max_tokens", 8192),
+            parent={"session_id": session_id, "at": at},
+        )
+        name = header.get("name", "")
+        if not name.startswith("Agent-"):
+            fork = self._journal(fork_id)
+            fork.header["name"] = f"{name} (fork)"
+            self._commit(fork)
+        header.setdefault("forks", []).append(fork_id)
+        self._commit(journal)
+        return fork_id
+
+    @_synchronized
     def load(self, session_id: str) -> Conversation:
-        with open(self._path(session_id), "r") as f:
-            data = json.load(f)
+        header = self._journal(session_id).header
         conv = Conversation(
-            model=data["model"],
-            system=data.get("system"),
-            max_tokens=data.get("max_tokens", 8192),
+            model=header["model"],
+            system=header.get("system"),
+            max_tokens=header.get("max_tokens", 8192),
         )
-        conv.messages = data["messages"]
+        # A shallow copy: the message objects are shared with other forks
+        # of the same parent (and with the prompt-cache prefix they sent).
+        conv.messages = list(self._history(session_id))
+        conv.usage.update(header.get("usage", {}))
         return conv
 
     def save(self, session_id: str, conv: Conversation) -> None:
-        with open(self._path(session_id), "r") as f:
-            data = json.load(f)
-        data["messages"] = _serialize_messages(conv.messages)
-        if len(data["messages"]) > MAX_MESSAGES:
-            data["messages"] = data["messages"][-MAX_MESSAGES:]
-        if data.get("name", "").startswith("Agent-") and data["messages"]:
-            for msg in data["messages"]:
+        self.save_messages(session_id, conv.messages, conv.usage)
+
+    @_synchronized
+    def save_messages(self, session_id: str, messages: list[dict], usage: dict[str, int]) -> None:
+        # Appends the messages added since the last save. Dropping messages
+        # from the front only moves the header's "start"; any other change to
+        # saved messages (compaction eliding a tool result) rewrites the log.
+        journal = self._journal(session_id)
+        header = journal.header
+        messages = trim_messages(messages, MAX_MESSAGES)
+        if header.get("forks"):
+            self._detach(journal, keep=messages)
+        parent = header.get("parent")
+        if parent is not None and not _same_prefix(messages, self._history(parent["session_id"]), parent["at"]):
+            # The shared prefix was trimmed or compacted away.
+            self._unlink_parent(journal)
+            self._replace(journal, messages, header["start"] - parent["at"])
+        else:
+            own = messages[parent["at"]:] if parent is not None else messages
+            old = journal.messages
+            dropped = _dropped(old, own)
+            if dropped is None:
+                self._replace(journal, own, header["start"])
+            else:
+                kept = len(old) - dropped
+                self._append_messages(session_id, _serialize_messages(own[kept:]), header["next"])
+                header["start"] += dropped
+                header["next"] += len(own) - kept
+                journal.messages = list(own)
+        header["usage"] = usage
+        if header.get("name", "").startswith("Agent-") and messages:
+            for msg in messages:
                 if msg["role"] == "user" and isinstance(msg["content"], str):
-                    data["name"] = msg["content"][:30].strip()
+                    header["name"] = msg["content"][:30].strip()
                     break
-        with open(self._path(session_id), "w") as f:
-            json.dump(data, f, indent=2)
+        self._commit(journal)
 
+    @_synchronized
     def get(self, session_id: str) -> dict[str, Any]:
-        with open(self._path(session_id), "r") as f:
-            return json.load(f)
+        data = dict(self._journal(session_id).header)
+        data["messages"] = _serialize_messages(self._history(session_id))
+        return data
+
+    def _first_seq(self, session_id: str) -> int:
+        # The seq of the first message in the full history.
+        header = self._journal(session_id).header
+        parent = header.get("parent")
+        return header["start"] - (parent["at"] if parent is not None else 0)
 
+    @_synchronized
+    def page(
+        self,
+        session_id: str,
+        before: int | None = None,
+        after: int | None = None,
+        limit: int = 50,
+    ) -> dict[str, Any]:
+        # Up to `limit` messages, each with its "seq": those right after seq
+        # `after`, or else those right before seq `before` (the newest by
+        # default). "first" and "next" bound the whole history.
+        history = self._history(session_id)
+        first = self._first_seq(session_id)
+        end = first + len(history)
+        if after is not None:
+            lo = max(first, after + 1)
+            hi = min(end, lo + limit)
+        else:
+            hi = min(end, before if before is not None else end)
+            lo = max(first, hi - limit)
+        return {
+            "first": first,
+            "next": end,
+            "messages": [{"seq": seq, **_serialize_message(history[seq - first])} for seq in range(lo, hi)],
+        }
+
+    @_synchronized
+    def message(self, session_id: str, seq: int) -> dict[str, Any] | None:
+        history = self._history(session_id)
+        index = seq - self._first_seq(session_id)
+        if not 0 <= index < len(history):
+            return None
+        return {"seq": seq, **_serialize_message(history[index])}
+
+    @_synchronized
     def list_all(self) -> list[dict[str, Any]]:
+        # Headers only; message bodies are never read.
         sessions = []
         for filename in sorted(os.listdir(self._dir)):
             if not filename.endswith(".json"):
                 continue
-            with open(os.path.join(self._dir, filename), "r") as f:
-                data = json.load(f)
+            header = self._read_header(filename[:-len(".json")])
+            parent = header.get("parent")
             sessions.append({
-                "session_id": data["session_id"],
-                "name": data.get("name", data["session_id"][:8]),
-                "model": data["model"],
-                "system": data.get("system"),
-                "created_at": data["created_at"],
-                "message_count": len(data["messages"]),
+                "session_id": header["session_id"],
+                "name": header.get("name", header["session_id"][:8]),
+                "model": header["model"],
+                "system": header.get("system"),
+                "created_at": header["created_at"],
+                "message_count": header["next"] - header["start"] + (parent["at"] if parent else 0),
+                "parent": parent,
             })
         return sessions
 
+    @_synchronized
     def clear_history(self, session_id: str) -> None:
-        with open(self._path(session_id), "r") as f:
-            data = json.load(f)
-        data["messages"] = []
-        data["name"] = f"Agent-{session_id[:4]}"
-        with open(self._path(session_id), "w") as f:
-            json.dump(data, f, indent=2)
+        journal = self._journal(session_id)
+        self._detach(journal)
+        self._unlink_parent(journal)
+        self._replace(journal, [], journal.header["next"])
+        journal.header["name"] = f"Agent-{session_id[:4]}"
+        self._commit(journal)
 
+    @_synchronized
     def clear_all_history(self) -> None:
+        # Every history becomes empty, so fork links have nothing to share.
+        self._journals.clear()
         for filename in sorted(os.listdir(self._dir)):
             if not filename.endswith(".json"):
                 continue
-            path = os.path.join(self._dir, filename)
-            with open(path, "r") as f:
-                data = json.load(f)
-            data["messages"] = []
-            data["name"] = f"Agent-{data['session_id'][:4]}"
-            with open(path, "w") as f:
-                json.dump(data, f, indent=2)
+            header = self._read_header(filename[:-len(".json")])
+            header["start"] = header["next"]
+            header["name"] = f"Agent-{header['session_id'][:4]}"
+            header.pop("parent", None)
+            header.pop("forks", None)
+            self._write_messages(header["session_id"], [], header["start"])
+            self._write_header(header)
 
+    @_synchronized
     def delete(self, session_id: str) -> None:
-        path = self._path(session_id)
-        if os.path.exists(path):
-            os.remove(path)
+        if self.exists(session_id):
+            journal = self._journal(session_id)
+            self._detach(journal)
+            self._unlink_parent(journal)
+            self._journals.pop(session_id, None)
+            self._remove(session_id)
 
+    @_synchronized
     def delete_all(self) -> None:
+        self._journals.clear()
         for filename in os.listdir(self._dir):
-            if filename.endswith(".json"):
+            if filename.endswith((".json", ".jsonl", ".tmp")):
                 os.remove(os.path.join(self._dir, filename))
 
+    @_synchronized
     def exists(self, session_id: str) -> bool:
         return os.path.exists(self._path(session_id))
+
+    def close(self) -> None:
+        pass
+
+
+class AsyncSessionStore:
+    # A SessionStore for the event loop: every call runs on one dedicated
+    # I/O thread. save() only snapshots the history (a list copy) and
+    # schedules the write, delay seconds later; saves of the same session
+    # before then replace the snapshot, so a burst of turns is written once.
+    # Reading a session first writes its pending save, clearing or deleting
+    # it drops the save, and flush() writes everything pending (call it, or
+    # close(), on shutdown).
+    def __init__(self, store: SessionStore, delay: float = WRITE_BEHIND_DELAY) -> None:
+        self.store = store
+        self.delay = delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-io")
+        self._pending: dict[str, tuple[list[dict], dict[str, int]]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._writing: dict[str, asyncio.Task[None]] = {}
+        self.saves = 0
+        self.writes = 0
+        self.failed_writes = 0
+
+    async def _run(self, fn: Callable[..., _T], *args: Any, **kwargs: Any) -> _T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def save(self, session_id: str, conv: Conversation) -> None:
+        self.saves += 1
+        self._pending[session_id] = (list(conv.messages), dict(conv.usage))
+        if session_id not in self._timers:
+            self._timers[session_id] = asyncio.get_running_loop().call_later(
+                self.delay, self._start_write, session_id
+            )
+
+    def _start_write(self, session_id: str) -> None:
+        self._timers.pop(session_id, None)
+        # A write already running picks up the new snapshot when it is done.
+        if session_id not in self._writing and session_id in self._pending:
+            self._writing[session_id] = asyncio.ensure_future(self._write(session_id))
+
+    async def _write(self, session_id: str) -> None:
+        try:
+            while session_id in self._pending:
+                messages, usage = self._pending.pop(session_id)
+                try:
+                    await self._run(self.store.save_messages, session_id, messages, usage)
+                    self.writes += 1
+                except Exception as e:
+                    self.failed_writes += 1
+                    print(f"Saving session {session_id} failed: {e}")
+        finally:
+            self._writing.pop(session_id, None)
+
+    async def flush(self, session_id: str | None = None) -> None:
+        if session_id is None:
+            session_ids = set(self._pending) | set(self._writing)
+        else:
+            session_ids = {session_id}
+        for sid in session_ids:
+            timer = self._timers.pop(sid, None)
+            if timer is not None:
+                timer.cancel()
+            self._start_write(sid)
+        tasks = [self._writing[sid] for sid in session_ids if sid in self._writing]
+        if tasks:
+            await asyncio.gather(*(asyncio.shield(task) for task in tasks))
+
+    async def _discard(self, session_id: str | None = None) -> None:
+        # Drops pending saves (of one session or all) and waits out writes
+        # already running.
+        session_ids = [session_id] if session_id is not None else list(self._pending)
+        for sid in session_ids:
+            self._pending.pop(sid, None)
+            timer = self._timers.pop(sid, None)
+            if timer is not None:
+                timer.cancel()
+        if session_id is None:
+            tasks = list(self._writing.values())
+        else:
+            tasks = [self._writing[session_id]] if session_id in self._writing else []
+        if tasks:
+            await asyncio.gather(*(asyncio.shield(task) for task in tasks))
+
+    async def create(self, **kwargs: Any) -> str:
+        return await self._run(self.store.create, **kwargs)
+
+    async def fork(self, session_id: str, at: int | None = None) -> str:
+        await self.flush(session_id)
+        return await self._run(self.store.fork, session_id, at)
+
+    async def load(self, session_id: str) -> Conversation:
+        await self.flush(session_id)
+        return await self._run(self.store.load, session_id)
+
+    async def get(self, session_id: str) -> dict[str, Any]:
+        await self.flush(session_id)
+        return await self._run(self.store.get, session_id)
+
+    async def page(
+        self,
+        session_id: str,
+        before: int | None = None,
+        after: int | None = None,
+        limit: int = 50,
+    ) -> dict[str, Any]:
+        await self.flush(session_id)
+        return await self._run(self.store.page, session_id, before, after, limit)
+
+    async def message(self, session_id: str, seq: int) -> dict[str, Any] | None:
+        await self.flush(session_id)
+        return await self._run(self.store.message, session_id, seq)
+
+    async def list_all(self) -> list[dict[str, Any]]:
+        await self.flush()
+        return await self._run(self.store.list_all)
+
+    async def clear_history(self, session_id: str) -> None:
+        await self._discard(session_id)
+        await self._run(self.store.clear_history, session_id)
+
+    async def clear_all_history(self) -> None:
+        await self._discard()
+        await self._run(self.store.clear_all_history)
+
+    async def delete(self, session_id: str) -> None:
+        await self._discard(session_id)
+        await self._run(self.store.delete, session_id)
+
+    async def delete_all(self) -> None:
+        await self._discard()
+        await self._run(self.store.delete_all)
+
+    async def exists(self, session_id: str) -> bool:
+        return session_id in self._pending or await self._run(self.store.exists, session_id)
+
+    async def close(self) -> None:
+        await self.flush()
+        await self._run(self.store.close)
+        self._executor.shutdown(wait=False)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "writing": len(self._writing),
+            "saves": self.saves,
+            "writes": self.writes,
+            "failed_writes": self.failed_writes,
+        }
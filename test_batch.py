@@ -0,0 +1,77 @@
+"""Tests for batch jobs in batch.py.
+
+Run: python -m pytest test_batch.py
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import Any
+
+from batch import BatchJob, BatchStore, parse_items
+
+
+async def _echo(job: BatchJob, item: dict[str, Any]) -> tuple[str, dict[str, int]]:
+    await asyncio.sleep(0)
+    if item["prompt"] == "fail":
+        raise RuntimeError("boom")
+    return item["prompt"].upper(), {"output_tokens": 1}
+
+
+async def _collect(job: BatchJob, after: int = 0) -> list[dict[str, Any]]:
+    async def collect() -> list[dict[str, Any]]:
+        return [record async for record in job.results(after)]
+    return await asyncio.wait_for(collect(), timeout=5)
+
+
+def test_job_records_results_and_resumes_from_its_file(tmp_path):
+    async def main() -> None:
+        store = BatchStore(_echo, str(tmp_path))
+        items = parse_items(["a", "fail", {"prompt": "c", "id": "x"}])
+        job = await store.create(items, concurrency=2)
+        records = await _collect(job)
+
+        assert job.done and job.failed == 1
+        assert sorted(r["index"] for r in records) == [0, 1, 2]
+        assert {r["id"]: r.get("result") for r in records} == {"0": "A", "1": None, "x": "C"}
+        with open(tmp_path / f"{job.id}.jsonl") as f:
+            lines = [json.loads(line) for line in f]
+        assert lines[0]["items"] == items
+        assert lines[1:] == records
+
+        reloaded = await BatchStore(_echo, str(tmp_path)).get(job.id)
+        assert reloaded is not None and reloaded.done
+        assert await _collect(reloaded, after=2) == records[2:]
+
+    asyncio.run(main())
+
+
+def test_failed_write_ends_the_job_and_a_later_get_resumes_it(tmp_path, monkeypatch):
+    async def main() -> None:
+        store = BatchStore(_echo, str(tmp_path))
+        real_append = BatchJob._append
+        writes = 0
+
+        def append(self: BatchJob, records: list[dict[str, Any]]) -> None:
+            nonlocal writes
+            writes += 1
+            if writes == 2:
+                raise OSError(28, "No space left on device")
+            real_append(self, records)
+
+        monkeypatch.setattr(BatchJob, "_append", append)
+        job = await store.create(parse_items([f"p{i}" for i in range(20)]), concurrency=1)
+        records = await _collect(job)
+
+        assert job.done
+        assert "No space left" in job.header()["error"]
+        assert len(records) == len(job.finished) < 20
+
+        monkeypatch.setattr(BatchJob, "_append", real_append)
+        resumed = await store.get(job.id)
+        assert resumed is not job
+        assert len(await _collect(resumed)) == 20
+        assert resumed.error is None
+        assert sorted(r["index"] for r in resumed.finished) == list(range(20))
+
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""Tests for history trimming and compaction in context.py.
+
+Run: python -m pytest test_context.py
+"""
+from __future__ import annotations
+
+from context import ContextManager, starts_turn, trim_messages
+
+
+def _tool_turn(n: int, calls: int, output: str) -> list[dict]:
+    messages = [{"role": "user", "content": f"task {n}"}]
+    for i in range(calls):
+        tool_id = f"t{n}-{i}"
+        messages += [
+            {"role": "assistant", "content": [{"type": "tool_use", "id": tool_id, "name": "read_file", "input": {}}]},
+            {"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_id, "content": output}]},
+        ]
+    messages.append({"role": "assistant", "content": [{"type": "text", "text": f"done {n}"}]})
+    return messages
+
+
+def _assert_pairs_intact(messages: list[dict]) -> None:
+    assert starts_turn(messages[0])
+    for i, message in enumerate(messages):
+        if message["role"] != "user" or isinstance(message["content"], str):
+            continue
+        for block in message["content"]:
+            if block["type"] == "tool_result":
+                previous = messages[i - 1]
+                assert i > 0 and previous["role"] == "assistant"
+                assert block["tool_use_id"] in {b.get("id") for b in previous["content"]}
+
+
+def test_trim_cuts_at_a_turn_start():
+    messages = _tool_turn(0, 3, "x") + _tool_turn(1, 3, "y")
+    trimmed = trim_messages(messages, 9)
+    assert trimmed == messages[8:]
+    _assert_pairs_intact(trimmed)
+
+
+def test_trim_keeps_the_last_turn_whole_when_it_exceeds_the_limit():
+    messages = _tool_turn(0, 1, "x") + _tool_turn(1, 20, "y")
+    assert trim_messages(messages, 10) == messages[4:]
+    assert trim_messages(_tool_turn(0, 20, "y"), 10) == _tool_turn(0, 20, "y")
+
+
+def test_compact_under_budget_returns_history_untouched():
+    manager = ContextManager(budget=100_000)
+    messages = _tool_turn(0, 2, "small")
+    assert manager.compact(messages) is messages
+    assert manager.compactions == 0
+
+
+def test_compact_elides_old_tool_results_first():
+    manager = ContextManager(budget=3_000, keep_recent=4, elide_over=500)
+    messages = _tool_turn(0, 4, "a" * 4_000) + _tool_turn(1, 1, "recent")
+    compacted = manager.compact(messages)
+
+    assert len(compacted) == len(messages)
+    assert manager.elided_results > 0 and manager.dropped_messages == 0
+    assert "elided" in compacted[2]["content"][0]["content"]
+    assert compacted[-4:] == messages[-4:]
+    assert messages[2]["content"][0]["content"] == "a" * 4_000
+    assert manager.last_estimate <= manager.budget
+    _assert_pairs_intact(compacted)
+
+
+def test_compact_drops_whole_turns_from_the_front():
+    manager = ContextManager(budget=2_000, keep_recent=4, elide_over=10_000)
+    messages = []
+    for n in range(6):
+        messages += _tool_turn(n, 2, str(n) * 1_500)
+    compacted = manager.compact(messages)
+
+    assert manager.dropped_messages > 0
+    assert compacted == messages[manager.dropped_messages:]
+    assert manager.last_estimate == int(manager.measure(compacted) * manager.ratio)
+    _assert_pairs_intact(compacted)
+
+
+def test_compact_never_touches_recent_messages_or_splits_a_turn():
+    # Everything but the last turn would have to go, but it starts inside
+    # the protected tail, so only earlier turns are dropped.
+    manager = ContextManager(budget=500, keep_recent=10, elide_over=10_000)
+    messages = _tool_turn(0, 1, "x" * 3_000) + _tool_turn(1, 6, "y" * 300)
+    compacted = manager.compact(messages)
+
+    assert compacted == messages[4:]
+    _assert_pairs_intact(compacted)
+
+
+def test_observe_corrects_the_estimate_ratio():
+    manager = ContextManager()
+    manager.compact(_tool_turn(0, 1, "x" * 4_000))
+    raw = manager.last_estimate
+    manager.observe({"input_tokens": raw, "cache_read_input_tokens": raw})
+    assert 1.0 < manager.ratio < 2.0
@@ -0,0 +1,349 @@
+"""Tests for streamed requests in conversation.py against a fake client.
+
+Run: python -m pytest test_conversation.py
+"""
+from __future__ import annotations
+
+import asyncio
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+pytest.importorskip("anthropic")
+
+import anthropic
+from anthropic.types import Message, TextBlock, ToolUseBlock, Usage
+
+from conversation import Conversation
+from scheduler import LLMScheduler
+
+
+def _message(content: list[Any], stop_reason: str = "end_turn") -> Message:
+    return Message(
+        id="msg",
+        type="message",
+        role="assistant",
+        model="claude-sonnet-4-20250514",
+        content=content,
+        stop_reason=stop_reason,
+        stop_sequence=None,
+        usage=Usage(input_tokens=10, output_tokens=5),
+    )
+
+
+def _text(text: str) -> SimpleNamespace:
+    return SimpleNamespace(type="text", text=text)
+
+
+def _tool_stop(block: ToolUseBlock) -> SimpleNamespace:
+    return SimpleNamespace(type="content_block_stop", index=0, content_block=block)
+
+
+class FakeStream:
+    # Plays a script of stream events. An exception in the script is raised
+    # at that point and an asyncio.Event holds the stream until it is set.
+    def __init__(self, script: list[Any], final: Message | None) -> None:
+        self.script = script
+        self.final = final
+        self.response = SimpleNamespace(headers={})
+
+    async def __aenter__(self) -> FakeStream:
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        return None
+
+    async def __aiter__(self):
+        for step in self.script:
+            if isinstance(step, BaseException):
+                raise step
+            if isinstance(step, asyncio.Event):
+                await step.wait()
+                continue
+            yield step
+
+    async def get_final_message(self) -> Message:
+        return self.final
+
+
+class FakeClient:
+    # Answers each messages.stream() call with the next scripted reply; a
+    # reply that is an exception fails the request before the stream opens.
+    def __init__(self, *replies: Any) -> None:
+        self.replies = list(replies)
+        self.requests: list[dict[str, Any]] = []
+        self.messages = self
+
+    def with_options(self, **options: Any) -> FakeClient:
+        return self
+
+    def stream(self, **kwargs: Any) -> FakeStream:
+        self.requests.append(kwargs)
+        reply = self.replies.pop(0)
+        if isinstance(reply, BaseException):
+            raise reply
+        return reply
+
+
+def _scheduled(client: FakeClient) -> Conversation:
+    sched = LLMScheduler(requests_per_minute=600, base_backoff=0.01, max_backoff=0.01)
+    return Conversation(client=client, scheduler=sched)
+
+
+def test_scheduler_retries_a_stream_that_failed_before_any_output():
+    async def main():
+        client = FakeClient(
+            anthropic.APIConnectionError(request=None),
+            FakeStream([_text("Hel"), _text("lo")], _message([TextBlock(type="text", text="Hello")])),
+        )
+        conv = _scheduled(client)
+        seen: list[str] = []
+        response = await conv.send("hi", on_text=seen.append)
+
+        assert len(client.requests) == 2 and conv.scheduler.retries == 1
+        assert seen == ["Hel", "lo"]
+        assert response.content[0].text == "Hello"
+
+    asyncio.run(main())
+
+
+def test_scheduler_does_not_retry_a_stream_that_already_sent_text():
+    async def main():
+        client = FakeClient(
+            FakeStream([_text("Hel"), anthropic.APIConnectionError(request=None)], None),
+            FakeStream([_text("Hello")], _message([TextBlock(type="text", text="Hello")])),
+        )
+        conv = _scheduled(client)
+        seen: list[str] = []
+        with pytest.raises(anthropic.APIConnectionError):
+            await conv.send("hi", on_text=seen.append)
+
+        assert seen == ["Hel"]
+        assert len(client.requests) == 1 and conv.scheduler.retries == 0
+        assert conv.scheduler.as_dict()["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+def _tool(tool_id: str, path: str) -> ToolUseBlock:
+    return ToolUseBlock(type="tool_use", id=tool_id, name="read_file", input={"path": path})
+
+
+class SlowTools:
+    # A read_file handler that records each call and blocks until released.
+    def __init__(self) -> None:
+        self.started: list[str] = []
+        self.cancelled: list[str] = []
+        self.release: dict[str, asyncio.Event] = {}
+
+    async def read_file(self, path: str) -> str:
+        self.started.append(path)
+        release = self.release.setdefault(path, asyncio.Event())
+        try:
+            await release.wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(path)
+            raise
+        return f"contents of {path}"
+
+
+async def _until(condition) -> None:
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0)
+    raise AssertionError("condition not reached")
+
+
+def test_tools_start_before_the_message_ends_and_results_keep_their_order():
+    async def main():
+        tools = SlowTools()
+        first, second = _tool("t1", "a.txt"), _tool("t2", "b.txt")
+        message_stop = asyncio.Event()
+        client = FakeClient(FakeStream(
+            [_text("Reading."), _tool_stop(first), _tool_stop(second), message_stop],
+            _message([TextBlock(type="text", text="Reading."), first, second], stop_reason="tool_use"),
+        ))
+        conv = Conversation(client=client, tool_handlers={"read_file": tools.read_file})
+        announced: list[str] = []
+        turn = asyncio.ensure_future(conv.send("read both", on_text=lambda text: None,
+                                               on_tool_use=lambda block: announced.append(block.id)))
+
+        await _until(lambda: len(tools.started) == 2)
+        assert tools.started == ["a.txt", "b.txt"]
+        assert announced == ["t1", "t2"]
+        assert not turn.done()
+
+        message_stop.set()
+        response = await turn
+        assert response.stop_reason == "tool_use"
+
+        finished: list[str] = []
+        collect = asyncio.ensure_future(
+            conv._handle_tool_use(response, on_result=lambda result: finished.append(result["tool_use_id"]))
+        )
+        tools.release["b.txt"].set()
+        await _until(lambda: finished == ["t2"])
+        tools.release["a.txt"].set()
+        await collect
+
+        # Already running calls were picked up, not started again.
+        assert tools.started == ["a.txt", "b.txt"]
+        assert finished == ["t2", "t1"]
+        results = conv.messages[-1]["content"]
+        assert [r["tool_use_id"] for r in results] == ["t1", "t2"]
+        assert results[0]["content"] == "contents of a.txt"
+
+    asyncio.run(main())
+
+
+def test_a_failed_stream_cancels_the_tools_it_started():
+    async def main():
+        tools = SlowTools()
+        hold = asyncio.Event()
+        client = FakeClient(FakeStream(
+            [_tool_stop(_tool("t1", "a.txt")), hold, anthropic.APIConnectionError(request=None)],
+            None,
+        ))
+        conv = Conversation(client=client, tool_handlers={"read_file": tools.read_file})
+        turn = asyncio.ensure_future(conv.send("read", on_text=lambda text: None))
+
+        await _until(lambda: tools.started == ["a.txt"])
+        hold.set()
+        with pytest.raises(anthropic.APIConnectionError):
+            await turn
+        await _until(lambda: tools.cancelled == ["a.txt"])
+        assert conv._tool_batch is None
+
+    asyncio.run(main())
+
+
+def test_a_reply_that_stops_short_cancels_its_tools():
+    async def main():
+        tools = SlowTools()
+        block = _tool("t1", "a.txt")
+        hold = asyncio.Event()
+        client = FakeClient(FakeStream([_tool_stop(block), hold], _message([block], stop_reason="max_tokens")))
+        conv = Conversation(client=client, tool_handlers={"read_file": tools.read_file})
+        turn = asyncio.ensure_future(conv.send("read", on_text=lambda text: None))
+
+        await _until(lambda: tools.started == ["a.txt"])
+        hold.set()
+        response = await turn
+        assert response.stop_reason == "max_tokens"
+        await _until(lambda: tools.cancelled == ["a.txt"])
+        assert conv._tool_batch is None
+
+    asyncio.run(main())
+
+
+def _breakpoints(kwargs: dict[str, Any]) -> list[str]:
+    # Where cache_control appears in the request, as "tools[i]", "system[i]"
+    # or "messages[i]".
+    found = [f"tools[{i}]" for i, tool in enumerate(kwargs.get("tools", [])) if "cache_control" in tool]
+    system = kwargs.get("system")
+    if isinstance(system, list):
+        found += [f"system[{i}]" for i, block in enumerate(system) if "cache_control" in block]
+    for i, message in enumerate(kwargs["messages"]):
+        if isinstance(message["content"], list):
+            found += [f"messages[{i}]" for block in message["content"]
+                      if isinstance(block, dict) and "cache_control" in block]
+    return found
+
+
+def _history() -> list[dict[str, Any]]:
+    return [
+        {"role": "user", "content": "first"},
+        {"role": "assistant", "content": [{"type": "text", "text": "ok"}]},
+        {"role": "user", "content": "read it"},
+        {"role": "assistant", "content": [{"type": "tool_use", "id": "t1", "name": "read_file", "input": {}}]},
+        {"role": "user", "content": [
+            {"type": "text", "text": "note"},
+            {"type": "tool_result", "tool_use_id": "t1", "content": "data"},
+        ]},
+    ]
+
+
+TOOLS = [
+    {"name": "read_file", "description": "Read a file", "input_schema": {"type": "object"}},
+    {"name": "list_directory", "description": "List a directory", "input_schema": {"type": "object"}},
+]
+
+
+def test_request_kwargs_place_breakpoints_on_tools_system_and_last_two_user_turns():
+    conv = Conversation(system="be brief", tools=[dict(tool) for tool in TOOLS])
+    conv.messages = _history()
+    kwargs = conv._request_kwargs()
+
+    assert _breakpoints(kwargs) == ["tools[1]", "system[0]", "messages[2]", "messages[4]"]
+    assert kwargs["system"] == [{"type": "text", "text": "be brief", "cache_control": {"type": "ephemeral"}}]
+    assert kwargs["messages"][2]["content"] == [
+        {"type": "text", "text": "read it", "cache_control": {"type": "ephemeral"}},
+    ]
+    # The breakpoint goes on the last block; earlier blocks are untouched.
+    assert kwargs["messages"][4]["content"][0] == {"type": "text", "text": "note"}
+    assert kwargs["messages"][4]["content"][1]["tool_use_id"] == "t1"
+
+    # Neither the history nor the tool list is modified.
+    assert conv.messages == _history()
+    assert conv.tools == TOOLS
+
+
+def test_request_kwargs_without_system_or_tools_mark_only_user_turns():
+    conv = Conversation()
+    conv.messages = _history()
+    kwargs = conv._request_kwargs()
+    assert "system" not in kwargs and "tools" not in kwargs
+    assert _breakpoints(kwargs) == ["messages[2]", "messages[4]"]
+
+    conv.messages = _history()[:1]
+    assert _breakpoints(conv._request_kwargs()) == ["messages[0]"]
+
+
+def test_request_kwargs_stay_within_the_breakpoint_limit_on_long_histories():
+    conv = Conversation(system="be brief", tools=list(TOOLS))
+    for n in range(10):
+        conv.messages += [
+            {"role": "user", "content": f"q{n}"},
+            {"role": "assistant", "content": [{"type": "text", "text": f"a{n}"}]},
+        ]
+    conv.messages.append({"role": "user", "content": ""})
+    kwargs = conv._request_kwargs()
+    # An empty user message cannot hold a breakpoint and is skipped.
+    assert _breakpoints(kwargs) == ["tools[1]", "system[0]", "messages[16]", "messages[18]"]
+
+
+def test_request_kwargs_without_prompt_caching_pass_everything_through():
+    conv = Conversation(system="be brief", tools=list(TOOLS), prompt_caching=False)
+    conv.messages = _history()
+    kwargs = conv._request_kwargs()
+    assert kwargs["system"] == "be brief"
+    assert kwargs["tools"] == TOOLS and kwargs["messages"] == conv.messages
+    assert _breakpoints(kwargs) == []
+
+
+def test_max_parallel_tools_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv("MAX_PARALLEL_TOOLS", "2")
+    assert Conversation(max_parallel_tools=5).max_parallel_tools == 5
+
+    async def main():
+        tools = SlowTools()
+        blocks = [_tool(f"t{i}", f"{i}.txt") for i in range(3)]
+        conv = Conversation(tool_handlers={"read_file": tools.read_file})
+        assert conv.max_parallel_tools == 2
+
+        collect = asyncio.ensure_future(conv._handle_tool_use(_message(blocks, stop_reason="tool_use")))
+        await _until(lambda: len(tools.started) == 2)
+        for _ in range(20):
+            await asyncio.sleep(0)
+        assert tools.started == ["0.txt", "1.txt"]
+
+        tools.release["0.txt"].set()
+        await _until(lambda: len(tools.started) == 3)
+        for path in ("1.txt", "2.txt"):
+            tools.release[path].set()
+        await collect
+        assert [r["tool_use_id"] for r in conv.messages[-1]["content"]] == ["t0", "t1", "t2"]
+
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+"""Tests for the live conversation cache in conversations.py.
+
+Run: python -m pytest test_conversations.py
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("websockets")
+
+from conversation import Conversation
+from conversations import ConversationCache
+
+
+class FakeStore:
+    def __init__(self) -> None:
+        self.loads = 0
+        self.flushed: list[str | None] = []
+        self.gate: asyncio.Event | None = None
+
+    async def load(self, session_id: str) -> Conversation:
+        self.loads += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        conv = Conversation()
+        conv.messages = [{"role": "user", "content": session_id}]
+        return conv
+
+    async def flush(self, session_id: str | None = None) -> None:
+        self.flushed.append(session_id)
+
+
+class FakeHub:
+    tools_version = 0
+
+    def register_tools_on(self, conv: Conversation, **kwargs: Any) -> None:
+        pass
+
+
+def _cache(store: FakeStore, **kwargs: Any) -> ConversationCache:
+    return ConversationCache(store, FakeHub(), **kwargs)  # type: ignore[arg-type]
+
+
+def test_reuses_the_conversation_and_evicts_least_recently_used():
+    async def main() -> None:
+        store = FakeStore()
+        cache = _cache(store, max_entries=2)
+        async with cache.use("a") as a:
+            pass
+        async with cache.use("a") as again:
+            assert again is a
+        async with cache.use("b"):
+            pass
+        async with cache.use("c"):
+            pass
+
+        assert store.loads == 3 and len(cache) == 2
+        assert cache.evictions == 1 and store.flushed == ["a"]
+        assert cache.as_dict()["hits"] == 1
+
+    asyncio.run(main())
+
+
+def test_failed_run_drops_the_entry():
+    async def main() -> None:
+        store = FakeStore()
+        cache = _cache(store)
+        with pytest.raises(RuntimeError):
+            async with cache.use("a"):
+                raise RuntimeError("turn failed")
+        assert len(cache) == 0
+        async with cache.use("a"):
+            pass
+        assert store.loads == 2
+
+    asyncio.run(main())
+
+
+def test_entry_is_not_evicted_while_a_caller_waits_for_its_load():
+    async def main() -> None:
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        # Nothing unused may stay cached, so any gap in the waiter's
+        # reference would evict the entry.
+        cache = _cache(store, max_entries=0)
+        seen: dict[str, Conversation] = {}
+        release = asyncio.Event()
+
+        async def loader() -> None:
+            async with cache.use("s") as conv:
+                seen["loader"] = conv
+
+        async def waiter() -> None:
+            async with cache.use("s") as conv:
+                seen["waiter"] = conv
+                await release.wait()
+
+        tasks = [asyncio.create_task(loader()), asyncio.create_task(waiter())]
+        await asyncio.sleep(0)
+        store.gate.set()
+        while "waiter" not in seen:
+            await asyncio.sleep(0.01)
+
+        # A third run while the waiter still holds the session waits for it
+        # and shares its conversation rather than loading a second copy.
+        async def third() -> Conversation:
+            async with cache.use("s") as conv:
+                return conv
+
+        later = asyncio.create_task(third())
+        await asyncio.sleep(0.01)
+        assert not later.done()
+        release.set()
+        assert await later is seen["waiter"] is seen["loader"]
+        assert store.loads == 1
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_does_not_pin_the_entry():
+    async def main() -> None:
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        cache = _cache(store, max_entries=0)
+
+        async def use() -> None:
+            async with cache.use("s"):
+                pass
+
+        loader = asyncio.create_task(use())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(use())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        store.gate.set()
+        await loader
+        assert waiter.cancelled()
+        assert len(cache) == 0 and cache.evictions == 1
+
+    asyncio.run(main())
@@ -0,0 +1,465 @@
+"""Tests for hub dispatch against in-process fake workers.
+
+Run: python -m pytest test_hub.py
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from typing import Any
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("websockets")
+
+from conversation import Conversation
+from hub import PRIORITY_BATCH, PRIORITY_INTERACTIVE, Hub
+
+
+class FakeWorker:
+    # Attached to the hub like a connection; records the frames the hub
+    # sends and answers calls only when told to.
+    def __init__(
+        self,
+        hub: Hub,
+        worker_id: str,
+        tools: list[str],
+        capacity: int = 1,
+        traits: dict[str, dict[str, Any]] | None = None,
+    ) -> None:
+        self.hub = hub
+        self.id = worker_id
+        self.calls: dict[str, dict[str, Any]] = {}
+        self.cancelled: list[str] = []
+        self.pings = 0
+        # While set and not open, frames from the hub are held up in send.
+        self.gate: asyncio.Event | None = None
+        hub._attach_worker(worker_id, self, self._receive)
+        self.send({
+            "type": "register",
+            "worker_id": worker_id,
+            "tools": [{"name": name, "description": name, "input_schema": {"type": "object"}} for name in tools],
+            "capacity": capacity,
+            "traits": traits or {},
+        })
+
+    async def _receive(self, frame: str | bytes) -> None:
+        if self.gate is not None:
+            await self.gate.wait()
+        msg = json.loads(frame)
+        if msg["type"] == "tool_call":
+            self.calls[msg["call_id"]] = msg
+        elif msg["type"] == "cancel":
+            self.cancelled.append(msg["call_id"])
+        elif msg["type"] == "ping":
+            self.pings += 1
+
+    async def close(self) -> None:
+        pass
+
+    def send(self, msg: dict[str, Any]) -> None:
+        self.hub._process_message(self.id, json.dumps(msg))
+
+    def reply(self, call_id: str, content: str, **extra: Any) -> None:
+        self.send({"type": "tool_result", "call_id": call_id, "content": content, **extra})
+
+    def call_ids(self, tool_name: str | None = None) -> list[str]:
+        return [cid for cid, msg in self.calls.items() if tool_name is None or msg["name"] == tool_name]
+
+    def disconnect(self) -> None:
+        self.hub._cleanup_worker(self.id, self)
+
+
+def run(coro: Any) -> Any:
+    return asyncio.run(coro)
+
+
+async def settle() -> None:
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def make_hub(**kwargs: Any) -> Hub:
+    return Hub(Conversation(), **kwargs)
+
+
+def test_queued_calls_run_by_priority_when_a_slot_frees():
+    async def main() -> None:
+        hub = make_hub()
+        worker = FakeWorker(hub, "w1", ["echo"])
+        first = asyncio.create_task(hub._dispatch("echo", {"n": 0}))
+        await settle()
+        batch = asyncio.create_task(hub._dispatch("echo", {"n": 1}, priority=PRIORITY_BATCH))
+        await settle()
+        chat = asyncio.create_task(hub._dispatch("echo", {"n": 2}, priority=PRIORITY_INTERACTIVE))
+        await settle()
+        assert len(worker.calls) == 1
+        assert hub.get_stats()["echo"]["queue_depth"] == 2
+
+        worker.reply(worker.call_ids()[0], "zero")
+        await settle()
+        assert await first == "zero"
+        assert [msg["input"]["n"] for msg in worker.calls.values()] == [0, 2]
+
+        worker.reply(worker.call_ids()[1], "two")
+        await settle()
+        assert await chat == "two"
+        assert [msg["input"]["n"] for msg in worker.calls.values()] == [0, 2, 1]
+        worker.reply(worker.call_ids()[2], "one")
+        assert await batch == "one"
+        assert hub.get_stats()["echo"]["queued"] == 2
+
+    run(main())
+
+
+def test_full_queue_rejects_new_calls():
+    async def main() -> None:
+        hub = make_hub(max_queue=1)
+        worker = FakeWorker(hub, "w1", ["echo"])
+        running = asyncio.create_task(hub._dispatch("echo", {}))
+        queued = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+
+        result = await hub._dispatch("echo", {})
+        assert "overloaded" in result
+        assert hub.get_stats()["echo"]["rejected"] == 1
+
+        worker.reply(worker.call_ids()[0], "a")
+        await settle()
+        worker.reply(worker.call_ids()[1], "b")
+        assert (await running, await queued) == ("a", "b")
+
+    run(main())
+
+
+def test_queue_timeout_gives_up_and_keeps_the_slot_free():
+    async def main() -> None:
+        hub = make_hub(queue_timeout=0.05)
+        worker = FakeWorker(hub, "w1", ["echo"])
+        running = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+
+        result = await hub._dispatch("echo", {})
+        assert "waited" in result
+        assert hub.get_stats()["echo"]["rejected"] == 1
+        assert hub.get_stats()["echo"]["queue_depth"] == 0
+
+        worker.reply(worker.call_ids()[0], "done")
+        assert await running == "done"
+        assert hub._policy.outstanding("w1") == 0
+
+    run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main() -> None:
+        hub = make_hub()
+        worker = FakeWorker(hub, "w1", ["echo"])
+        running = asyncio.create_task(hub._dispatch("echo", {"n": 0}))
+        await settle()
+        waiter = asyncio.create_task(hub._dispatch("echo", {"n": 1}))
+        await settle()
+        waiter.cancel()
+        await settle()
+
+        worker.reply(worker.call_ids()[0], "done")
+        assert await running == "done"
+        await settle()
+        assert len(worker.calls) == 1
+        assert hub._policy.outstanding("w1") == 0
+
+    run(main())
+
+
+def test_new_worker_drains_the_queue():
+    async def main() -> None:
+        hub = make_hub()
+        busy = FakeWorker(hub, "w1", ["echo"])
+        running = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+        queued = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+
+        fresh = FakeWorker(hub, "w2", ["echo"])
+        await settle()
+        assert len(fresh.calls) == 1
+        fresh.reply(fresh.call_ids()[0], "from w2")
+        assert await queued == "from w2"
+        busy.reply(busy.call_ids()[0], "from w1")
+        assert await running == "from w1"
+
+    run(main())
+
+
+def test_worker_disconnect_fails_its_calls_and_drains_elsewhere():
+    async def main() -> None:
+        hub = make_hub()
+        workers = [FakeWorker(hub, "w1", ["echo"]), FakeWorker(hub, "w2", ["echo"])]
+        tasks = [asyncio.create_task(hub._dispatch("echo", {"n": n})) for n in range(3)]
+        await settle()
+        lost, survivor = sorted(workers, key=lambda w: next(iter(w.calls.values()))["input"]["n"])
+        assert len(lost.calls) == len(survivor.calls) == 1
+
+        lost.disconnect()
+        assert "disconnected" in await tasks[0]
+        await settle()
+        assert len(survivor.calls) == 1
+
+        survivor.reply(survivor.call_ids()[0], "one")
+        assert await tasks[1] == "one"
+        await settle()
+        assert survivor.calls[survivor.call_ids()[-1]]["input"] == {"n": 2}
+        survivor.reply(survivor.call_ids()[-1], "two")
+        assert await tasks[2] == "two"
+
+    run(main())
+
+
+def test_last_worker_disconnect_fails_queued_calls():
+    async def main() -> None:
+        hub = make_hub()
+        worker = FakeWorker(hub, "w1", ["echo"])
+        running = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+        queued = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+
+        worker.disconnect()
+        assert "disconnected" in await running
+        assert "no worker registered" in await queued
+        assert "echo" not in hub._tool_to_workers
+
+    run(main())
+
+
+IDEMPOTENT = {"echo": {"idempotent": True}}
+
+
+def test_hedge_win_cancels_the_first_call_and_counts_its_wait():
+    async def main() -> None:
+        hub = make_hub(hedge_default_delay=0.05)
+        slow = FakeWorker(hub, "w1", ["echo"], traits=IDEMPOTENT)
+        task = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+        fast = FakeWorker(hub, "w2", ["echo"], traits=IDEMPOTENT)
+        assert len(slow.calls) == 1
+        while not fast.calls:
+            await asyncio.sleep(0.005)
+
+        fast.reply(fast.call_ids()[0], "hedge")
+        assert await task == "hedge"
+        await settle()
+        assert slow.cancelled == slow.call_ids()
+        stats = hub.get_stats()["echo"]
+        assert (stats["hedged"], stats["hedge_wins"], stats["calls"]) == (1, 1, 1)
+        # Measured from the first call, not from when the hedge went out.
+        assert hub._latency["echo"].percentile(0.5) >= 0.05
+        assert hub._policy.outstanding("w1") == hub._policy.outstanding("w2") == 0
+
+    run(main())
+
+
+def test_hedge_loss_cancels_the_hedge():
+    async def main() -> None:
+        hub = make_hub(hedge_default_delay=0.05)
+        first = FakeWorker(hub, "w1", ["echo"], traits=IDEMPOTENT)
+        task = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+        second = FakeWorker(hub, "w2", ["echo"], traits=IDEMPOTENT)
+        await asyncio.sleep(0.1)
+        assert len(second.calls) == 1
+
+        first.reply(first.call_ids()[0], "first")
+        assert await task == "first"
+        await settle()
+        assert second.cancelled == second.call_ids()
+        assert first.cancelled == []
+        stats = hub.get_stats()["echo"]
+        assert (stats["hedged"], stats["hedge_wins"]) == (1, 0)
+        assert hub._policy.outstanding("w2") == 0
+
+    run(main())
+
+
+def test_cancel_during_hedge_send_cancels_both_calls():
+    async def main() -> None:
+        hub = make_hub(hedge_default_delay=0.05)
+        first = FakeWorker(hub, "w1", ["echo"], traits=IDEMPOTENT)
+        task = asyncio.create_task(hub._dispatch("echo", {}))
+        await settle()
+        second = FakeWorker(hub, "w2", ["echo"], traits=IDEMPOTENT)
+        second.gate = asyncio.Event()
+        await asyncio.sleep(0.1)
+        assert hub._policy.outstanding("w2") == 1
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert hub._calls == {}
+        assert hub._policy.outstanding("w1") == hub._policy.outstanding("w2") == 0
+        second.gate.set()
+        await settle()
+        assert first.cancelled == first.call_ids()
+        assert len(second.cancelled) == 1
+
+    run(main())
+
+
+CACHEABLE = {"read_file": {"cacheable": True}}
+
+
+def _cached_hub(**kwargs: Any) -> tuple[Hub, FakeWorker]:
+    hub = make_hub(cache_max_bytes=1 << 20, **kwargs)
+    return hub, FakeWorker(hub, "w1", ["read_file", "run_command"], capacity=4, traits=CACHEABLE)
+
+
+async def _read(hub: Hub, worker: FakeWorker, caller: Any, reply: str | None = None, token: str = "t1") -> str:
+    # Dispatches a read and, if it reaches the worker, answers it.
+    before = len(worker.calls)
+    task = asyncio.create_task(hub._dispatch("read_file", {"path": "a"}, caller=caller))
+    await settle()
+    if len(worker.calls) > before:
+        call_id = worker.call_ids()[-1]
+        assert worker.calls[call_id]["cache"] is True
+        worker.reply(call_id, reply or f"read {before}", token=token)
+    return await task
+
+
+def test_cache_hit_skips_the_worker():
+    async def main() -> None:
+        hub, worker = _cached_hub()
+        caller = object()
+        assert await _read(hub, worker, caller, "contents") == "contents"
+        assert await _read(hub, worker, caller) == "contents"
+        assert len(worker.calls) == 1
+        stats = hub.get_stats()["read_file"]
+        assert (stats["cache_hits"], stats["cache_misses"]) == (1, 1)
+
+    run(main())
+
+
+def test_invalidate_drops_only_the_matching_token():
+    async def main() -> None:
+        hub, worker = _cached_hub()
+        caller = object()
+        key = 'read_file:{"path":"a"}'
+        await _read(hub, worker, caller, "v1", token="t1")
+        worker.send({"type": "invalidate", "key": key, "token": "t0"})
+        assert await _read(hub, worker, caller) == "v1"
+
+        worker.send({"type": "invalidate", "key": key, "token": "t1"})
+        assert await _read(hub, worker, caller, "v2", token="t2") == "v2"
+        assert len(worker.calls) == 2
+        assert hub.get_cache_stats()["invalidations"] == 1
+
+    run(main())
+
+
+def test_cached_results_expire_after_their_ttl():
+    async def main() -> None:
+        hub, worker = _cached_hub(cache_ttl={"read_file": 0.05})
+        caller = object()
+        await _read(hub, worker, caller, "v1")
+        assert await _read(hub, worker, caller) == "v1"
+        await asyncio.sleep(0.1)
+        assert await _read(hub, worker, caller, "v2") == "v2"
+
+    run(main())
+
+
+def test_cache_is_skipped_while_the_callers_uncached_call_runs():
+    async def main() -> None:
+        hub, worker = _cached_hub()
+        conv, other = object(), object()
+        await _read(hub, worker, conv, "old")
+
+        command = asyncio.create_task(hub._dispatch("run_command", {"command": "edit a"}, caller=conv))
+        await settle()
+        assert await _read(hub, worker, conv, "new", token="t2") == "new"
+        assert await _read(hub, worker, other) == "new"
+
+        worker.reply(worker.call_ids("run_command")[0], "ok")
+        assert await command == "ok"
+        assert hub._uncached_calls == {}
+        assert await _read(hub, worker, conv) == "new"
+
+    run(main())
+
+
+def test_session_id_keys_the_guard_across_conversations():
+    async def main() -> None:
+        hub, worker = _cached_hub()
+        await _read(hub, worker, object(), "old")
+        command = asyncio.create_task(hub._dispatch("run_command", {}, session_id="s1", caller=object()))
+        await settle()
+        read = asyncio.create_task(hub._dispatch("read_file", {"path": "a"}, session_id="s1", caller=object()))
+        await settle()
+        assert len(worker.call_ids("read_file")) == 2
+        worker.reply(worker.call_ids("read_file")[-1], "new", token="t2")
+        worker.reply(worker.call_ids("run_command")[0], "ok")
+        assert (await read, await command) == ("new", "ok")
+
+    run(main())
+
+
+def test_calls_without_a_caller_never_use_the_cache():
+    async def main() -> None:
+        hub, worker = _cached_hub()
+        await _read(hub, worker, object(), "cached")
+        assert await _read(hub, worker, None, "fresh") == "fresh"
+        assert len(worker.calls) == 2
+
+    run(main())
+
+
+def test_single_frame_results_are_capped_and_not_cached():
+    async def main() -> None:
+        hub = make_hub(max_result_bytes=10, cache_max_bytes=1 << 20)
+        worker = FakeWorker(hub, "w1", ["read_file"], traits=CACHEABLE)
+        caller = object()
+        assert await _read(hub, worker, caller, "x" * 50) == "x" * 10 + "\n[output truncated at 10 bytes]"
+        assert await _read(hub, worker, caller, "short") == "short"
+        assert len(worker.calls) == 2
+
+    run(main())
+
+
+def test_streamed_results_are_capped_in_bytes():
+    async def main() -> None:
+        hub = make_hub(max_result_bytes=10)
+        worker = FakeWorker(hub, "w1", ["run_command"])
+        progress: list[str] = []
+        task = asyncio.create_task(hub._dispatch("run_command", {}, on_progress=progress.append))
+        await settle()
+        call_id = worker.call_ids()[0]
+        worker.send({"type": "tool_result_chunk", "call_id": call_id, "seq": 0, "content": "ab"})
+        # Four two-byte characters fit in the remaining eight bytes.
+        worker.send({"type": "tool_result_chunk", "call_id": call_id, "seq": 1, "content": "éééééé"})
+        worker.send({"type": "tool_result_chunk", "call_id": call_id, "seq": 2, "content": "more"})
+        worker.send({"type": "tool_result_end", "call_id": call_id})
+        result = await task
+        assert result == "abéééé\n[output truncated at 10 bytes]"
+        assert progress == ["ab", "éééé"]
+
+    run(main())
+
+
+def test_heartbeat_only_times_out_workers_that_answer_pings():
+    async def main() -> None:
+        hub = make_hub(heartbeat_interval=0.01, heartbeat_misses=2)
+        old = FakeWorker(hub, "old", ["echo"])
+        new = FakeWorker(hub, "new", ["echo"])
+        beats = [asyncio.create_task(hub._heartbeat(w.id, w, w.close)) for w in (old, new)]
+        await asyncio.sleep(0.01)
+        new.send({"type": "pong", "ts": time.monotonic()})
+
+        await asyncio.sleep(0.1)
+        assert old.pings > 2
+        assert "old" in hub._worker_senders
+        assert "new" not in hub._worker_senders
+        assert beats[1].done()
+        beats[0].cancel()
+
+    run(main())
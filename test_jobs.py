@@ -0,0 +1,212 @@
+"""Tests for background jobs: jobs.py and the /jobs routes in server.py.
+
+Run: python -m pytest test_jobs.py
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import Any
+
+import pytest
+
+import jobs
+from jobs import CANCELLED, DONE, FAILED, QUEUED, RUNNING, Job, JobManager, JobQueueFull
+
+
+async def _agent(job: Job) -> str | None:
+    # Stands in for the agent loop: a tool call, then the final text.
+    gate = job.params.get("gate")
+    if gate is not None:
+        await gate.wait()
+    if job.params["prompt"] == "fail":
+        raise RuntimeError("model error")
+    job.publish({"type": "tool_use", "id": "t1", "name": "read_file", "input": {}})
+    job.publish({"type": "tool_result", "tool_use_id": "t1", "content": job.params.get("output", "ok")})
+    text = job.params["prompt"].upper()
+    job.publish({"type": DONE, "content": text})
+    return text
+
+
+async def _finished(job: Job) -> None:
+    while not job.finished:
+        await job.wait(len(job.events), 1)
+
+
+def _types(job: Job) -> list[str]:
+    return [event["type"] for event in job.events]
+
+
+def test_job_runs_through_its_states():
+    async def main() -> None:
+        manager = JobManager(_agent, workers=1)
+        job = manager.submit({"prompt": "hi"})
+        assert job.state == QUEUED
+        await _finished(job)
+
+        assert (job.state, job.result, job.error) == (DONE, "HI", None)
+        assert _types(job) == [QUEUED, RUNNING, "tool_use", "tool_result", DONE]
+        assert [event["seq"] for event in job.events] == list(range(5))
+        assert job.started_at is not None and job.finished_at >= job.started_at
+        failed = manager.submit({"prompt": "fail"})
+        await _finished(failed)
+        assert failed.state == FAILED and "model error" in failed.error
+        assert failed.events[-1] == {"seq": 2, "type": "error", "content": failed.error}
+        await manager.close()
+
+    asyncio.run(main())
+
+
+def test_jobs_queue_in_order_and_reject_past_max_pending():
+    async def main() -> None:
+        gate = asyncio.Event()
+        manager = JobManager(_agent, workers=1, max_pending=2)
+        first = manager.submit({"prompt": "a", "gate": gate})
+        await asyncio.sleep(0)
+        queued = [manager.submit({"prompt": p}) for p in ("b", "c")]
+        with pytest.raises(JobQueueFull):
+            manager.submit({"prompt": "d"})
+        assert first.state == RUNNING and all(job.state == QUEUED for job in queued)
+
+        gate.set()
+        await _finished(queued[-1])
+        assert first.finished_at <= queued[0].started_at <= queued[1].started_at
+        await manager.close()
+
+    asyncio.run(main())
+
+
+def test_cancel_queued_and_running_jobs():
+    async def main() -> None:
+        gate = asyncio.Event()
+        manager = JobManager(_agent, workers=1)
+        running = manager.submit({"prompt": "a", "gate": gate})
+        await asyncio.sleep(0)
+        queued = manager.submit({"prompt": "b"})
+
+        manager.cancel(queued.id)
+        assert queued.state == CANCELLED and _types(queued) == [QUEUED, CANCELLED]
+        manager.cancel(running.id)
+        await _finished(running)
+        assert running.state == CANCELLED and _types(running) == [QUEUED, RUNNING, CANCELLED]
+
+        # The worker survives the cancellation and skips the cancelled job.
+        after = manager.submit({"prompt": "c"})
+        await _finished(after)
+        assert after.state == DONE and queued.started_at is None
+        assert manager.cancel(after.id) is after and after.state == DONE
+        await manager.close()
+
+    asyncio.run(main())
+
+
+def test_finished_jobs_keep_tool_result_previews_within_budget(monkeypatch):
+    monkeypatch.setattr(jobs, "MAX_FINISHED_CHARS", 30_000)
+
+    async def main() -> None:
+        manager = JobManager(_agent, workers=4)
+        submitted = [manager.submit({"prompt": f"p{i}", "output": "x" * 100_000}) for i in range(20)]
+        for job in submitted:
+            await _finished(job)
+
+        kept = [job for job in submitted if manager.get(job.id) is not None]
+        assert 0 < len(kept) < len(submitted)
+        assert sum(job.size for job in kept) <= 30_000
+        result = next(event for event in kept[-1].events if event["type"] == "tool_result")
+        assert result["truncated"] is True and result["length"] == 100_000
+        assert len(result["content"]) == jobs.FINISHED_RESULT_PREVIEW
+        assert kept[-1].events[-1]["content"] == kept[-1].result
+        await manager.close()
+
+    asyncio.run(main())
+
+
+# --- HTTP routes ---
+
+def _client(manager: JobManager, monkeypatch: pytest.MonkeyPatch) -> Any:
+    test_utils = pytest.importorskip("aiohttp.test_utils")
+    pytest.importorskip("anthropic")
+    pytest.importorskip("websockets")
+    import server
+    from aiohttp import web
+
+    monkeypatch.setattr(server, "jobs", manager)
+    app = web.Application()
+    app.router.add_get("/jobs/{id}", server.get_job)
+    app.router.add_delete("/jobs/{id}", server.cancel_job)
+    return test_utils.TestClient(test_utils.TestServer(app))
+
+
+def _sse_events(text: str) -> list[tuple[str | None, str, dict[str, Any]]]:
+    events = []
+    for chunk in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in chunk.splitlines() if not line.startswith(":"))
+        events.append((fields.get("id"), fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_long_poll_returns_events_after_the_cursor(monkeypatch):
+    async def main() -> None:
+        gate = asyncio.Event()
+        manager = JobManager(_agent, workers=1)
+        job = manager.submit({"prompt": "hi", "gate": gate})
+        async with _client(manager, monkeypatch) as client:
+            await asyncio.sleep(0)
+            resp = await client.get(f"/jobs/{job.id}")
+            body = await resp.json()
+            assert body["state"] == RUNNING and body["next"] == 2
+            assert [event["type"] for event in body["events"]] == [QUEUED, RUNNING]
+
+            poll = asyncio.ensure_future(client.get(f"/jobs/{job.id}?after=2&wait=5"))
+            await asyncio.sleep(0.05)
+            assert not poll.done()
+            gate.set()
+            body = await (await poll).json()
+            assert body["events"][0]["seq"] == 2 and body["next"] >= 3
+
+            await _finished(job)
+            body = await (await client.get(f"/jobs/{job.id}?after={body['next']}&wait=5")).json()
+            assert body["state"] == DONE and body["result"] == "HI" and body["next"] == 5
+            assert (await client.get("/jobs/missing")).status == 404
+            assert (await client.get(f"/jobs/{job.id}?after=x")).status == 400
+        await manager.close()
+
+    asyncio.run(main())
+
+
+def test_sse_resumes_from_last_event_id(monkeypatch):
+    async def main() -> None:
+        manager = JobManager(_agent, workers=1)
+        job = manager.submit({"prompt": "hi"})
+        await _finished(job)
+        async with _client(manager, monkeypatch) as client:
+            headers = {"Accept": "text/event-stream"}
+            resp = await client.get(f"/jobs/{job.id}", headers=headers)
+            full = _sse_events(await resp.text())
+            assert [name for _, name, _ in full] == [QUEUED, RUNNING, "tool_use", "tool_result", DONE, "end"]
+            assert [seq for seq, _, _ in full[:-1]] == ["0", "1", "2", "3", "4"]
+
+            resp = await client.get(f"/jobs/{job.id}", headers={**headers, "Last-Event-ID": "2"})
+            resumed = _sse_events(await resp.text())
+            assert [seq for seq, _, _ in resumed[:-1]] == ["3", "4"]
+            assert resumed[-1][2]["state"] == DONE
+        await manager.close()
+
+    asyncio.run(main())
+
+
+def test_delete_cancels_a_running_job(monkeypatch):
+    async def main() -> None:
+        manager = JobManager(_agent, workers=1)
+        job = manager.submit({"prompt": "hi", "gate": asyncio.Event()})
+        async with _client(manager, monkeypatch) as client:
+            await asyncio.sleep(0)
+            resp = await client.delete(f"/jobs/{job.id}")
+            assert resp.status == 202
+            await _finished(job)
+            body = await (await client.get(f"/jobs/{job.id}")).json()
+            assert body["state"] == CANCELLED and body["events"][-1]["type"] == CANCELLED
+            assert (await client.delete("/jobs/missing")).status == 404
+        await manager.close()
+
+    asyncio.run(main())
@@ -0,0 +1,337 @@
+"""Tests for admission, fairness and backoff in scheduler.py.
+
+Run: python -m pytest test_scheduler.py
+"""
+from __future__ import annotations
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("anthropic")
+
+import anthropic
+
+import scheduler
+from scheduler import LLMScheduler, TokenBucket, retry_after
+
+
+class FakeClock:
+    # Stands in for the time module inside scheduler.py; the event loop
+    # keeps the real one.
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(scheduler, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def jitter(monkeypatch):
+    # Records the backoff ranges and always picks the top of the range.
+    ranges: list[tuple[float, float]] = []
+
+    def uniform(low: float, high: float) -> float:
+        ranges.append((low, high))
+        return high
+
+    monkeypatch.setattr(scheduler, "random", SimpleNamespace(uniform=uniform))
+    return ranges
+
+
+def _status_error(status: int, headers: dict[str, str] | None = None) -> anthropic.APIStatusError:
+    response = SimpleNamespace(status_code=status, headers=headers or {}, request=None)
+    return anthropic.APIStatusError(f"status {status}", response=response, body=None)
+
+
+async def _settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def _blocked(requests_per_minute: float = 60, **kwargs) -> LLMScheduler:
+    # A scheduler whose request bucket is empty: with 60/min, advancing the
+    # clock by one second admits exactly one call.
+    sched = LLMScheduler(requests_per_minute=requests_per_minute, **kwargs)
+    sched.requests.level = 0
+    return sched
+
+
+async def _admit_one(sched: LLMScheduler, clock: FakeClock) -> None:
+    clock.now += 1.0
+    sched._pump()
+    await _settle()
+
+
+def test_token_bucket_refills_waits_and_seeds(clock):
+    bucket = TokenBucket(600)
+    assert bucket.limited and bucket.wait(600) == 0.0
+    bucket.take(600)
+    assert bucket.wait(100) == pytest.approx(10.0)
+    # Requests bigger than the bucket only wait for a full one.
+    assert bucket.wait(10_000) == pytest.approx(60.0)
+
+    bucket.refill(clock.now + 5.0)
+    assert bucket.level == pytest.approx(50.0)
+    bucket.refill(clock.now + 1_000.0)
+    assert bucket.level == 600
+
+    # The API reports less left than we think: its view wins.
+    bucket.seed(1_000, 200)
+    assert (bucket.capacity, bucket.level) == (1_000, 200)
+
+    unlimited = TokenBucket()
+    unlimited.take(1_000_000)
+    assert not unlimited.limited and unlimited.wait(1_000_000) == 0.0
+    unlimited.seed(50, 10)
+    assert (unlimited.capacity, unlimited.level) == (50, 10)
+
+
+def test_lower_priority_number_is_admitted_first(clock):
+    async def main():
+        sched = _blocked()
+        order: list[str] = []
+
+        def call(name: str):
+            async def _call():
+                order.append(name)
+                return SimpleNamespace(usage=None)
+            return _call
+
+        tasks = [asyncio.ensure_future(sched.run(call("batch"), key="b", priority=10))]
+        await _settle()
+        tasks.append(asyncio.ensure_future(sched.run(call("chat"), key="c", priority=0)))
+        await _settle()
+        assert sched.queue_depth() == {10: 1, 0: 1}
+
+        await _admit_one(sched, clock)
+        assert order == ["chat"]
+        await _admit_one(sched, clock)
+        assert order == ["chat", "batch"]
+        await asyncio.gather(*tasks)
+        assert sched.as_dict()["completed"] == 2
+
+    asyncio.run(main())
+
+
+def test_sessions_take_turns_within_a_priority(clock):
+    async def main():
+        sched = _blocked()
+        order: list[str] = []
+
+        def call(name: str):
+            async def _call():
+                order.append(name)
+                return SimpleNamespace(usage=None)
+            return _call
+
+        tasks = []
+        for name, key in (("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b"), ("b2", "b")):
+            tasks.append(asyncio.ensure_future(sched.run(call(name), key=key)))
+            await _settle()
+        assert sched.as_dict()["waiting_sessions"] == 2
+
+        for _ in range(5):
+            await _admit_one(sched, clock)
+        assert order == ["a1", "b1", "a2", "b2", "a3"]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+
+def test_large_request_is_not_overtaken_by_smaller_ones(clock):
+    async def main():
+        sched = LLMScheduler(input_tokens_per_minute=600)
+        sched.input_tokens.level = 0
+        order: list[str] = []
+
+        def call(name: str):
+            async def _call():
+                order.append(name)
+                return SimpleNamespace(usage=None)
+            return _call
+
+        big = asyncio.ensure_future(sched.run(call("big"), key="a", tokens=300))
+        await _settle()
+        small = asyncio.ensure_future(sched.run(call("small"), key="b", tokens=10))
+        await _settle()
+
+        # Enough for the small one, not for the big one at the head.
+        clock.now += 10.0
+        sched._pump()
+        await _settle()
+        assert order == []
+
+        clock.now += 20.0
+        sched._pump()
+        await _settle()
+        assert order == ["big"]
+        clock.now += 1.0
+        sched._pump()
+        await asyncio.gather(big, small)
+        assert order == ["big", "small"]
+
+    asyncio.run(main())
+
+
+def test_unseeded_scheduler_limits_concurrency_until_limits_are_known(clock):
+    async def main():
+        sched = LLMScheduler()
+        release = asyncio.Event()
+        started = 0
+
+        async def call():
+            nonlocal started
+            started += 1
+            await release.wait()
+            return SimpleNamespace(usage=None)
+
+        tasks = [asyncio.ensure_future(sched.run(call, key=i)) for i in range(6)]
+        await _settle()
+        assert started == scheduler.UNSEEDED_CONCURRENCY
+        assert sched.as_dict()["queued"] == 6 - scheduler.UNSEEDED_CONCURRENCY
+
+        sched.observe({
+            "anthropic-ratelimit-requests-limit": "100",
+            "anthropic-ratelimit-requests-remaining": "90",
+        })
+        await _settle()
+        assert started == 6
+        assert sched.requests.as_dict() == {"limit_per_minute": 100, "available": 88}
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+
+def test_rate_limit_pauses_everyone_and_retries_with_jittered_backoff(clock, jitter):
+    async def main():
+        sched = LLMScheduler(requests_per_minute=600, base_backoff=1.0, max_backoff=3.0)
+        attempts = 0
+        order: list[str] = []
+
+        async def flaky():
+            nonlocal attempts
+            attempts += 1
+            order.append("retry" if attempts > 1 else "first")
+            if attempts <= 3:
+                raise _status_error(429)
+            return SimpleNamespace(usage=None)
+
+        async def other():
+            order.append("other")
+            return SimpleNamespace(usage=None)
+
+        task = asyncio.ensure_future(sched.run(flaky, key="a"))
+        await _settle()
+        assert attempts == 1 and jitter == [(0, 1.0)]
+        assert sched.as_dict()["paused_for_s"] == 1.0
+
+        # Admission is paused for every session, not just the failing one.
+        bystander = asyncio.ensure_future(sched.run(other, key="b"))
+        await _settle()
+        assert order == ["first"]
+
+        # The retry goes ahead of the session that was waiting.
+        await _admit_one(sched, clock)
+        assert order == ["first", "retry", "other"]
+        assert jitter == [(0, 1.0), (0, 2.0)]
+        clock.now += 2.0
+        sched._pump()
+        await _settle()
+        # The backoff ceiling caps the range.
+        assert attempts == 3 and jitter[-1] == (0, 3.0)
+
+        clock.now += 3.0
+        sched._pump()
+        await asyncio.gather(task, bystander)
+        assert attempts == 4
+        stats = sched.as_dict()
+        assert (stats["throttled"], stats["retries"], stats["failed"]) == (3, 3, 0)
+
+    asyncio.run(main())
+
+
+def test_server_retry_after_is_used_without_jitter(clock, jitter):
+    async def main():
+        sched = LLMScheduler(requests_per_minute=600)
+        attempts = 0
+
+        async def call():
+            nonlocal attempts
+            attempts += 1
+            if attempts == 1:
+                raise _status_error(529, {"retry-after": "7"})
+            return SimpleNamespace(usage=None)
+
+        task = asyncio.ensure_future(sched.run(call))
+        await _settle()
+        assert jitter == [] and sched.as_dict()["paused_for_s"] == 7.0
+        assert sched.as_dict()["throttled"] == 0
+
+        clock.now += 6.0
+        sched._pump()
+        await _settle()
+        assert attempts == 1
+        clock.now += 1.0
+        sched._pump()
+        await task
+        assert attempts == 2
+
+    asyncio.run(main())
+
+
+def test_errors_that_are_not_retried_fail_at_once(clock, jitter):
+    async def main():
+        sched = LLMScheduler(requests_per_minute=600, max_retries=1)
+        attempts = 0
+
+        async def bad_request():
+            nonlocal attempts
+            attempts += 1
+            raise _status_error(400)
+
+        with pytest.raises(anthropic.APIStatusError):
+            await sched.run(bad_request)
+        assert attempts == 1
+
+        async def overloaded():
+            nonlocal attempts
+            attempts += 1
+            raise _status_error(529)
+
+        attempts = 0
+        task = asyncio.ensure_future(sched.run(overloaded))
+        await _settle()
+        clock.now += 10.0
+        sched._pump()
+        with pytest.raises(anthropic.APIStatusError):
+            await task
+        assert attempts == 2
+
+        # The caller can veto a retry, e.g. once part of a reply went out.
+        attempts = 0
+        with pytest.raises(anthropic.APIStatusError):
+            await sched.run(overloaded, retryable=lambda: False)
+        assert attempts == 1
+        assert sched.as_dict()["failed"] == 3
+
+    asyncio.run(main())
+
+
+def test_retry_after_classifies_errors():
+    assert retry_after(anthropic.APIConnectionError(request=None)) == 0.0
+    assert retry_after(_status_error(429, {"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+    assert retry_after(_status_error(503, {"retry-after": "2"})) == 2.0
+    assert retry_after(_status_error(408)) == 0.0
+    assert retry_after(_status_error(400)) is None
+    assert retry_after(_status_error(200)) is None
+    assert retry_after(ValueError("boom")) is None
@@ -0,0 +1,243 @@
+"""Tests for the session journal format in sessions.py.
+
+Run: python -m pytest test_sessions.py
+"""
+from __future__ import annotations
+
+import json
+
+import pytest
+
+pytest.importorskip("anthropic")
+
+import sessions
+from sessions import SessionStore
+
+
+def _turn(conv, text: str) -> None:
+    conv.messages += [
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": [{"type": "text", "text": f"{text}!"}]},
+    ]
+
+
+def _log(directory, session_id: str) -> list[dict]:
+    with open(directory / f"{session_id}.jsonl") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _header(directory, session_id: str) -> dict:
+    with open(directory / f"{session_id}.json") as f:
+        return json.load(f)
+
+
+def test_save_after_journal_reload_appends_only_new_messages(tmp_path):
+    store = SessionStore(str(tmp_path))
+    sid = store.create()
+    conv = store.load(sid)
+    for i in range(8):
+        _turn(conv, f"q{i}")
+    store.save(sid, conv)
+
+    # The saved messages are no longer the conversation's objects.
+    store._journals.clear()
+    _turn(conv, "q8")
+    _turn(conv, "q9")
+    store.save(sid, conv)
+
+    log = _log(tmp_path, sid)
+    assert len(log) == 20
+    assert [record["seq"] for record in log] == list(range(20))
+    header = _header(tmp_path, sid)
+    assert (header["start"], header["next"]) == (0, 20)
+
+
+def test_save_after_eviction_with_front_drop_moves_start(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, "MAX_OPEN_JOURNALS", 1)
+    store = SessionStore(str(tmp_path))
+    sid = store.create()
+    conv = store.load(sid)
+    for i in range(4):
+        _turn(conv, f"q{i}")
+    store.save(sid, conv)
+
+    store.load(store.create())  # evicts sid's journal
+    assert sid not in store._journals
+    conv.messages = conv.messages[2:]
+    _turn(conv, "q4")
+    store.save(sid, conv)
+
+    assert len(_log(tmp_path, sid)) == 10
+    header = _header(tmp_path, sid)
+    assert (header["start"], header["next"]) == (2, 10)
+    assert [m["content"] for m in store.load(sid).messages][::2] == ["q1", "q2", "q3", "q4"]
+
+
+def test_round_trip_through_header_and_log(tmp_path):
+    store = SessionStore(str(tmp_path))
+    sid = store.create(system="be brief")
+    conv = store.load(sid)
+    _turn(conv, "hello")
+    store.save(sid, conv)
+    _turn(conv, "again")
+    store.save(sid, conv)
+
+    header = _header(tmp_path, sid)
+    assert "messages" not in header
+    assert (header["start"], header["next"]) == (0, 4)
+    assert header["name"] == "hello"
+
+    # A crash mid-append leaves a torn line and records past "next".
+    with open(tmp_path / f"{sid}.jsonl", "a") as f:
+        f.write(json.dumps({"seq": 4, "role": "user", "content": "lost"}) + "\n")
+        f.write('{"seq": 5, "role": "user", "con')
+
+    loaded = SessionStore(str(tmp_path)).load(sid)
+    assert loaded.system == "be brief"
+    assert loaded.messages == conv.messages
+
+    _turn(loaded, "after crash")
+    store = SessionStore(str(tmp_path))
+    store.save(sid, loaded)
+    assert SessionStore(str(tmp_path)).load(sid).messages == loaded.messages
+
+
+def test_legacy_single_file_session_is_converted(tmp_path):
+    messages = [
+        {"role": "user", "content": "old"},
+        {"role": "assistant", "content": [{"type": "text", "text": "old!"}]},
+    ]
+    legacy = {
+        "session_id": "legacy",
+        "name": "old",
+        "model": "claude-sonnet-4-20250514",
+        "system": None,
+        "max_tokens": 8192,
+        "created_at": "2025-01-01T00:00:00+00:00",
+        "messages": messages,
+    }
+    with open(tmp_path / "legacy.json", "w") as f:
+        json.dump(legacy, f)
+
+    store = SessionStore(str(tmp_path))
+    assert store.list_all()[0]["message_count"] == 2
+    assert store.load("legacy").messages == messages
+
+    header = _header(tmp_path, "legacy")
+    assert "messages" not in header
+    assert (header["start"], header["next"]) == (0, 2)
+    assert [record["seq"] for record in _log(tmp_path, "legacy")] == [0, 1]
+
+
+def test_front_drop_rewrites_log_once_dead_records_pile_up(tmp_path):
+    store = SessionStore(str(tmp_path))
+    sid = store.create()
+    conv = store.load(sid)
+    for i in range(sessions.COMPACT_MIN_DEAD):
+        _turn(conv, f"q{i}")
+    store.save(sid, conv)
+
+    # A small drop only moves "start".
+    conv.messages = conv.messages[2:]
+    store.save(sid, conv)
+    assert len(_log(tmp_path, sid)) == 2 * sessions.COMPACT_MIN_DEAD
+    assert _header(tmp_path, sid)["start"] == 2
+
+    # Once most of the log is dead, it is rewritten with the live records.
+    conv.messages = conv.messages[-10:]
+    store.save(sid, conv)
+    log = _log(tmp_path, sid)
+    header = _header(tmp_path, sid)
+    assert [record["seq"] for record in log] == list(range(header["start"], header["next"]))
+    assert len(log) == 10
+    assert SessionStore(str(tmp_path)).load(sid).messages == conv.messages
+
+    # Editing a saved message in place rewrites the log too.
+    conv.messages[1] = {"role": "assistant", "content": "elided"}
+    store.save(sid, conv)
+    assert SessionStore(str(tmp_path)).load(sid).messages == conv.messages
+
+
+def test_fork_is_detached_before_parent_drops_shared_prefix(tmp_path):
+    store = SessionStore(str(tmp_path))
+    parent_id = store.create()
+    parent = store.load(parent_id)
+    _turn(parent, "a")
+    _turn(parent, "b")
+    store.save(parent_id, parent)
+
+    fork_id = store.fork(parent_id, at=2)
+    fork = store.load(fork_id)
+    _turn(fork, "c")
+    store.save(fork_id, fork)
+    assert _header(tmp_path, fork_id)["parent"] == {"session_id": parent_id, "at": 2}
+    assert [record["seq"] for record in _log(tmp_path, fork_id)] == [2, 3]
+
+    # Appending to the parent keeps the shared prefix, so the link stays.
+    _turn(parent, "d")
+    store.save(parent_id, parent)
+    assert _header(tmp_path, parent_id)["forks"] == [fork_id]
+
+    # Dropping the first turn changes it: the fork gets its own copy.
+    parent.messages = parent.messages[2:]
+    store.save(parent_id, parent)
+    assert "forks" not in _header(tmp_path, parent_id)
+    assert "parent" not in _header(tmp_path, fork_id)
+    assert [record["seq"] for record in _log(tmp_path, fork_id)] == [0, 1, 2, 3]
+
+    reloaded = SessionStore(str(tmp_path))
+    assert reloaded.load(fork_id).messages == fork.messages
+    reloaded.delete(parent_id)
+    assert reloaded.load(fork_id).messages == fork.messages
+
+
+def test_migrate_leaves_legacy_files_as_they_were(tmp_path):
+    sessiondb = pytest.importorskip("sessiondb")
+    directory = tmp_path / "sessions"
+    directory.mkdir()
+    store = SessionStore(str(directory))
+    sid = store.create()
+    conv = store.load(sid)
+    _turn(conv, "new")
+    store.save(sid, conv)
+    legacy = {
+        "session_id": "legacy",
+        "name": "old",
+        "model": "claude-sonnet-4-20250514",
+        "system": None,
+        "max_tokens": 8192,
+        "created_at": "2025-01-01T00:00:00+00:00",
+        "messages": [{"role": "user", "content": "old"}],
+    }
+    with open(directory / "legacy.json", "w") as f:
+        json.dump(legacy, f)
+    before = {path.name: path.read_bytes() for path in directory.iterdir()}
+
+    assert sessiondb.migrate(str(directory), str(tmp_path / "sessions.db")) == 2
+
+    assert {path.name: path.read_bytes() for path in directory.iterdir()} == before
+    target = sessiondb.SqliteSessionStore(str(tmp_path / "sessions.db"))
+    try:
+        assert target.load("legacy").messages == legacy["messages"]
+        assert target.load(sid).messages == conv.messages
+    finally:
+        target.close()
+
+
+def test_save_keeps_a_single_turn_longer_than_the_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, "MAX_MESSAGES", 10)
+    store = SessionStore(str(tmp_path))
+    sid = store.create()
+    conv = store.load(sid)
+    _turn(conv, "earlier")
+    conv.messages.append({"role": "user", "content": "one long turn"})
+    for i in range(10):
+        conv.messages += [
+            {"role": "assistant", "content": [{"type": "tool_use", "id": f"t{i}", "name": "run_command", "input": {}}]},
+            {"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"t{i}", "content": "ok"}]},
+        ]
+    store.save(sid, conv)
+
+    saved = SessionStore(str(tmp_path)).load(sid).messages
+    assert saved == conv.messages[2:]
+    assert saved[0]["content"] == "one long turn"
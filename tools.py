@@ -1,7 +1,48 @@
 from __future__ import annotations
 
+import codecs
 import os
+import selectors
+import signal
 import subprocess
+import threading
+import time
+from contextvars import ContextVar
+from typing import Iterator
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ToolCall:
+    # Handle for one in-flight call on a worker. Tools that start processes
+    # attach them here so a cancel from the hub can kill the whole group.
+    def __init__(self) -> None:
+        self.cancelled = False
+        self._process: subprocess.Popen | None = None
+        self._lock = threading.Lock()
+
+    def attach(self, process: subprocess.Popen) -> None:
+        with self._lock:
+            self._process = process
+            if self.cancelled:
+                _kill_group(process)
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            if self._process is not None:
+                _kill_group(self._process)
+
+
+current_call: ContextVar[ToolCall | None] = ContextVar("current_call", default=None)
+
+
+def _kill_group(process: subprocess.Popen) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (OSError, ProcessLookupError):
+        pass
 
 
 READ_FILE_SCHEMA = {
@@ -36,9 +77,14 @@ LIST_DIRECTORY_SCHEMA = {
 }
 
 
-def read_file(path: str) -> str:
+def iter_read_file(path: str) -> Iterator[str]:
     with open(path, "r") as f:
-        return f.read()
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def read_file(path: str) -> str:
+    return "".join(iter_read_file(path))
 
 
 def list_directory(path: str = ".") -> str:
@@ -70,27 +116,58 @@ RUN_COMMAND_SCHEMA = {
 }
 
 
-def run_command(command: str, working_directory: str = ".", timeout: int = 120) -> str:
+def iter_run_command(command: str, working_directory: str = ".", timeout: int = 120) -> Iterator[str]:
+    call = current_call.get()
     try:
-        result = subprocess.run(
+        # Own session/process group so a timeout or cancel also kills
+        # anything the shell spawned.
+        process = subprocess.Popen(
             command,
             shell=True,
             cwd=working_directory,
-            capture_output=True,
-            text=True,
-            timeout=timeout,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
         )
-        output = ""
-        if result.stdout:
-            output += result.stdout
-        if result.stderr:
-            output += result.stderr
-        output += f"\n[exit code: {result.returncode}]"
-        return output.strip()
-    except subprocess.TimeoutExpired:
-        return f"Error: command timed out after {timeout}s"
     except Exception as e:
-        return f"Error: {e}"
+        yield f"Error: {e}"
+        return
+    if call is not None:
+        call.attach(process)
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    deadline = time.monotonic() + timeout
+    fd = process.stdout.fileno()
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    _kill_group(process)
+                    process.wait()
+                    yield f"\nError: command timed out after {timeout}s"
+                    return
+                if not selector.select(remaining):
+                    continue
+                data = os.read(fd, CHUNK_SIZE)
+                if not data:
+                    break
+                yield decoder.decode(data)
+    finally:
+        # Also reached when the consumer stops early (size cap, cancel).
+        if process.poll() is None:
+            _kill_group(process)
+        process.stdout.close()
+    process.wait()
+    if call is not None and call.cancelled:
+        yield "\nError: cancelled"
+        return
+    yield decoder.decode(b"", final=True) + f"\n[exit code: {process.returncode}]"
+
+
+def run_command(command: str, working_directory: str = ".", timeout: int = 120) -> str:
+    return "".join(iter_run_command(command, working_directory, timeout)).strip()
 
 
 ALL_TOOLS = [
@@ -98,3 +175,43 @@ ALL_TOOLS = [
     (LIST_DIRECTORY_SCHEMA, list_directory),
     (RUN_COMMAND_SCHEMA, run_command),
 ]
+
+
+# Chunked variants the worker uses to stream large outputs to the hub.
+STREAMING_HANDLERS = {
+    "read_file": iter_read_file,
+    "run_command": iter_run_command,
+}
+
+
+# Dispatch hints sent to the hub at register time. They are kept out of the
+# schemas themselves because those are forwarded verbatim to the API.
+TOOL_TRAITS: dict[str, dict[str, bool]] = {
+    "read_file": {"idempotent": True, "retryable": True, "cacheable": True},
+    "list_directory": {"idempotent": True, "retryable": True, "cacheable": True},
+}
+
+
+def _stat_token(path: str) -> str | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def read_file_token(path: str) -> str | None:
+    return _stat_token(path)
+
+
+def list_directory_token(path: str = ".") -> str | None:
+    # A directory's mtime changes whenever an entry is added or removed.
+    return _stat_token(path)
+
+
+# Cheap checks for cacheable tools: a result stays valid while its token is
+# unchanged. Called with the tool's own input.
+VALIDITY_TOKENS = {
+    "read_file": read_file_token,
+    "list_directory": list_directory_token,
+}
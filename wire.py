@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import json
+from typing import Any
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+MSGPACK_ZSTD = "msgpack+zstd"
+
+# Binary frames start with a flag byte so compression can be decided per
+# frame: small messages (pings, cancels) are not worth compressing.
+_RAW = b"\x00"
+_ZSTD = b"\x01"
+COMPRESS_THRESHOLD = 4096
+
+
+def available_encodings() -> list[str]:
+    # Most preferred first; JSON always works.
+    encodings = []
+    if msgpack is not None:
+        if zstandard is not None:
+            encodings.append(MSGPACK_ZSTD)
+        encodings.append(MSGPACK)
+    encodings.append(JSON)
+    return encodings
+
+
+def negotiate(offered: list[str]) -> Codec:
+    for encoding in available_encodings():
+        if encoding in offered:
+            return Codec(encoding)
+    return Codec(JSON)
+
+
+class Codec:
+    def __init__(self, encoding: str = JSON) -> None:
+        if encoding not in available_encodings():
+            raise ValueError(f"unsupported encoding: {encoding}")
+        self.encoding = encoding
+        self._compressor = zstandard.ZstdCompressor(level=3) if encoding == MSGPACK_ZSTD else None
+
+    def encode(self, msg: dict[str, Any]) -> str | bytes:
+        if self.encoding == JSON:
+            return json.dumps(msg)
+        data = msgpack.packb(msg, use_bin_type=True)
+        if self._compressor is not None and len(data) > COMPRESS_THRESHOLD:
+            return _ZSTD + self._compressor.compress(data)
+        return _RAW + data
+
+
+_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+
+def decode(frame: str | bytes) -> dict[str, Any]:
+    # Text frames are always JSON (the register handshake, or a peer that
+    # never upgraded), so either side can decode before negotiation finishes.
+    if isinstance(frame, str):
+        return json.loads(frame)
+    flag, data = frame[:1], frame[1:]
+    if flag == _ZSTD:
+        if _decompressor is None:
+            raise ValueError("received zstd frame but zstandard is not installed")
+        data = _decompressor.decompress(data)
+    elif flag != _RAW:
+        raise ValueError(f"unknown frame flag: {flag!r}")
+    return msgpack.unpackb(data, raw=False)
@@ -3,13 +3,30 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import contextvars
+import functools
 import json
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import websockets
 from aiohttp import web
 
-from tools import ALL_TOOLS
+from cache import cache_key
+from dispatch import DEFAULT_CAPACITY
+from tools import ALL_TOOLS, CHUNK_SIZE, STREAMING_HANDLERS, TOOL_TRAITS, VALIDITY_TOKENS, ToolCall, current_call
+from wire import JSON, Codec, available_encodings, decode
+
+HEARTBEAT_MISSES = 3
+DEFAULT_MAX_RESULT_BYTES = 1024 * 1024
+# A streaming tool whose first chunk arrives this quickly is held back in case
+# it is the whole result, so small outputs still go out as one tool_result.
+STREAM_HOLD_SECONDS = 0.1
+# Most recent cacheable results whose validity this worker keeps re-checking
+# for the hub.
+TRACKED_RESULTS = 4096
 
 connected = False
 
@@ -30,58 +47,246 @@ async def run_health_server(port: int) -> None:
     print(f"Health server listening on 0.0.0.0:{port}")
 
 
-async def run_worker(server_url: str, worker_id: str) -> None:
+def current_tokens(entries: list[tuple[str, tuple[str, dict, str]]]) -> list[str | None]:
+    return [VALIDITY_TOKENS[name](**tool_input) for _, (name, tool_input, _) in entries]
+
+
+async def run_worker(server_url: str, worker_id: str, capacity: int = DEFAULT_CAPACITY) -> None:
     global connected
 
     schemas = [schema for schema, _ in ALL_TOOLS]
     handlers = {schema["name"]: handler for schema, handler in ALL_TOOLS}
+    executor = ThreadPoolExecutor(max_workers=capacity)
 
     while True:
         try:
             async with websockets.connect(server_url) as ws:
-                await ws.send(json.dumps({"type": "register", "tools": schemas, "worker_id": worker_id}))
+                await ws.send(json.dumps({
+                    "type": "register",
+                    "tools": schemas,
+                    "worker_id": worker_id,
+                    "capacity": capacity,
+                    "traits": {name: TOOL_TRAITS[name] for name in handlers if name in TOOL_TRAITS},
+                    "encodings": available_encodings(),
+                }))
                 connected = True
                 print(f"Worker {worker_id} registered {len(schemas)} tool(s) with hub at {server_url}")
 
-                async def handle_call(call_id: str, name: str, tool_input: dict, handler) -> None:
-                    loop = asyncio.get_event_loop()
+                loop = asyncio.get_running_loop()
+                # Replaced once the hub answers with a welcome naming the
+                # encoding for this connection.
+                codec = Codec(JSON)
+                running: dict[str, tuple[ToolCall, asyncio.Task]] = {}
+                tracked: OrderedDict[str, tuple[str, dict, str]] = OrderedDict()
+                check: asyncio.Task | None = None
+
+                def track(name: str, tool_input: dict, token: str) -> None:
+                    key = cache_key(name, tool_input)
+                    tracked[key] = (name, tool_input, token)
+                    tracked.move_to_end(key)
+                    if len(tracked) > TRACKED_RESULTS:
+                        tracked.popitem(last=False)
+
+                async def revalidate() -> None:
+                    # Re-stat everything the hub may be caching from this
+                    # worker and tell it which results went stale.
+                    if not tracked:
+                        return
+                    entries = list(tracked.items())
+                    tokens = await loop.run_in_executor(executor, current_tokens, entries)
+                    try:
+                        for (key, (_, _, token)), now in zip(entries, tokens):
+                            if now == token:
+                                continue
+                            if key in tracked and tracked[key][2] == token:
+                                del tracked[key]
+                            await ws.send(codec.encode({"type": "invalidate", "key": key, "token": token}))
+                    except websockets.ConnectionClosed:
+                        pass
+
+                async def send_chunk(call_id: str, seq: int, data: str) -> None:
+                    await ws.send(codec.encode({
+                        "type": "tool_result_chunk",
+                        "call_id": call_id,
+                        "seq": seq,
+                        "content": data,
+                    }))
+
+                def stream_chunks(
+                    call_id: str, call: ToolCall, chunks, max_bytes: int
+                ) -> tuple[int, str | None, bool, bool]:
+                    # Runs in the executor: pulls one chunk at a time from the
+                    # tool and blocks until the event loop has sent it, so only
+                    # one chunk is ever buffered.
+                    started = time.monotonic()
+                    seq = 0
+                    sent = 0
+                    held: str | None = None
+                    truncated = False
+                    failed = False
                     try:
-                        if asyncio.iscoroutinefunction(handler):
-                            result = await handler(**tool_input)
+                        for chunk in chunks:
+                            if call.cancelled:
+                                break
+                            if not chunk:
+                                continue
+                            size = len(chunk.encode("utf-8"))
+                            if sent + size > max_bytes:
+                                chunk = chunk.encode("utf-8")[: max(0, max_bytes - sent)].decode("utf-8", "ignore")
+                                size = len(chunk.encode("utf-8"))
+                                truncated = True
+                            sent += size
+                            if held is not None:
+                                asyncio.run_coroutine_threadsafe(send_chunk(call_id, seq, held), loop).result()
+                                seq += 1
+                                held = None
+                            if seq == 0 and not truncated and time.monotonic() - started < STREAM_HOLD_SECONDS:
+                                held = chunk
+                            elif chunk:
+                                asyncio.run_coroutine_threadsafe(send_chunk(call_id, seq, chunk), loop).result()
+                                seq += 1
+                            if truncated:
+                                break
+                    except Exception as e:
+                        error = f"Error: {e}"
+                        held = error if held is None else held + "\n" + error
+                        failed = True
+                    finally:
+                        close = getattr(chunks, "close", None)
+                        if close is not None:
+                            close()
+                    return seq, held, truncated, failed
+
+                async def handle_call(
+                    call_id: str,
+                    name: str,
+                    call: ToolCall,
+                    tool_input: dict,
+                    handler,
+                    max_bytes: int,
+                    want_token: bool = False,
+                ) -> None:
+                    ctx = contextvars.copy_context()
+                    ctx.run(current_call.set, call)
+                    streaming = STREAMING_HANDLERS.get(name)
+                    validity = VALIDITY_TOKENS.get(name)
+                    token: str | None = None
+                    try:
+                        if want_token and validity is not None:
+                            # Taken before the read: a change during the read
+                            # leaves the token stale and the next check
+                            # invalidates the result.
+                            try:
+                                token = await loop.run_in_executor(executor, functools.partial(validity, **tool_input))
+                            except TypeError:
+                                pass  # bad input; the handler reports it
+                        if streaming is not None:
+                            seq, held, truncated, failed = await loop.run_in_executor(
+                                executor,
+                                functools.partial(ctx.run, stream_chunks, call_id, call, streaming(**tool_input), max_bytes),
+                            )
                         else:
-                            result = await loop.run_in_executor(None, lambda: handler(**tool_input))
+                            if asyncio.iscoroutinefunction(handler):
+                                result = await handler(**tool_input)
+                            else:
+                                result = await loop.run_in_executor(
+                                    executor, functools.partial(ctx.run, handler, **tool_input)
+                                )
+                            if not isinstance(result, str):
+                                result = json.dumps(result)
+                            if len(result) <= CHUNK_SIZE:
+                                seq, held, truncated, failed = 0, result, False, False
+                            else:
+                                pieces = (result[i:i + CHUNK_SIZE] for i in range(0, len(result), CHUNK_SIZE))
+                                seq, held, truncated, failed = await loop.run_in_executor(
+                                    executor, stream_chunks, call_id, call, pieces, max_bytes
+                                )
+                    except asyncio.CancelledError:
+                        return
                     except Exception as e:
-                        result = f"Error: {e}"
-                    if not isinstance(result, str):
-                        result = json.dumps(result)
+                        seq, held, truncated, failed = 0, f"Error: {e}", False, True
+                    finally:
+                        running.pop(call_id, None)
+                    if call.cancelled:
+                        return
+                    if failed or truncated:
+                        token = None
                     try:
-                        await ws.send(json.dumps({
-                            "type": "tool_result",
-                            "call_id": call_id,
-                            "content": result,
-                        }))
+                        if validity is None:
+                            # Anything else (run_command) may have changed files
+                            # the hub has cached; report that before the result.
+                            await revalidate()
+                        if seq == 0:
+                            result_msg = {"type": "tool_result", "call_id": call_id, "content": held or ""}
+                        else:
+                            if held:
+                                await send_chunk(call_id, seq, held)
+                            result_msg = {"type": "tool_result_end", "call_id": call_id, "truncated": truncated}
+                        if token is not None:
+                            result_msg["token"] = token
+                            track(name, tool_input, token)
+                        await ws.send(codec.encode(result_msg))
                     except Exception as e:
                         print(f"Failed to send result for {call_id}: {e}")
                         await ws.close()
 
-                async for raw in ws:
-                    msg = json.loads(raw)
-                    if msg["type"] != "tool_call":
-                        continue
-
-                    call_id = msg["call_id"]
-                    name = msg["name"]
-                    tool_input = msg["input"]
-
-                    handler = handlers.get(name)
-                    if handler is None:
-                        await ws.send(json.dumps({
-                            "type": "tool_result",
-                            "call_id": call_id,
-                            "content": f"Error: unknown tool '{name}'",
-                        }))
-                    else:
-                        asyncio.create_task(handle_call(call_id, name, tool_input, handler))
+                try:
+                    hub_timeout: float | None = None
+                    while True:
+                        # Once the hub's heartbeat interval is known, a silent hub
+                        # (half-open connection) forces a reconnect.
+                        try:
+                            raw = await asyncio.wait_for(ws.recv(), timeout=hub_timeout)
+                        except asyncio.TimeoutError:
+                            raise ConnectionError(f"no heartbeat from hub for {hub_timeout:.0f}s")
+                        msg = decode(raw)
+                        if msg["type"] == "welcome":
+                            codec = Codec(msg["encoding"])
+                            continue
+                        if msg["type"] == "ping":
+                            hub_timeout = float(msg.get("interval", 5.0)) * HEARTBEAT_MISSES
+                            await ws.send(codec.encode({"type": "pong", "ts": msg["ts"]}))
+                            # Catches changes made behind the worker's back
+                            # within one heartbeat.
+                            if tracked and (check is None or check.done()):
+                                check = asyncio.create_task(revalidate())
+                            continue
+                        if msg["type"] == "cancel":
+                            entry = running.pop(msg["call_id"], None)
+                            if entry is not None:
+                                entry[0].cancel()
+                                entry[1].cancel()
+                            continue
+                        if msg["type"] != "tool_call":
+                            continue
+
+                        call_id = msg["call_id"]
+                        name = msg["name"]
+                        tool_input = msg["input"]
+
+                        handler = handlers.get(name)
+                        if handler is None:
+                            await ws.send(codec.encode({
+                                "type": "tool_result",
+                                "call_id": call_id,
+                                "content": f"Error: unknown tool '{name}'",
+                            }))
+                        else:
+                            call = ToolCall()
+                            max_bytes = int(msg.get("max_bytes", DEFAULT_MAX_RESULT_BYTES))
+                            task = asyncio.create_task(
+                                handle_call(call_id, name, call, tool_input, handler, max_bytes, bool(msg.get("cache")))
+                            )
+                            running[call_id] = (call, task)
+                finally:
+                    # The hub treats this connection's calls as lost, so
+                    # nothing they produce will be read.
+                    for call, task in running.values():
+                        call.cancel()
+                        task.cancel()
+                    running.clear()
+                    if check is not None:
+                        check.cancel()
 
         except (ConnectionRefusedError, websockets.ConnectionClosed, OSError) as e:
             connected = False
@@ -89,9 +294,9 @@ async def run_worker(server_url: str, worker_id: str) -> None:
             await asyncio.sleep(2)
 
 
-async def async_main(server_url: str, health_port: int, worker_id: str) -> None:
+async def async_main(server_url: str, health_port: int, worker_id: str, capacity: int) -> None:
     await run_health_server(health_port)
-    await run_worker(server_url, worker_id)
+    await run_worker(server_url, worker_id, capacity)
 
 
 def main() -> None:
@@ -99,11 +304,17 @@ def main() -> None:
     parser.add_argument("--server", default="ws://localhost:9600", help="WebSocket URL of the hub")
     parser.add_argument("--health-port", type=int, default=8080, help="Port for the /healthz endpoint")
     parser.add_argument("--id", default=None, help="Worker ID (default: random)")
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        default=DEFAULT_CAPACITY,
+        help="Maximum number of tool calls this worker runs concurrently",
+    )
     args = parser.parse_args()
 
     worker_id = args.id or str(uuid.uuid4())[:8]
     print(f"Starting worker {worker_id}, connecting to {args.server}")
-    asyncio.run(async_main(args.server, args.health_port, worker_id))
+    asyncio.run(async_main(args.server, args.health_port, worker_id, args.capacity))
 
 
 if __name__ == "__main__":